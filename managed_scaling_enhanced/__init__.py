@@ -1,4 +1,6 @@
 import sys
+import atexit
+import queue
 import logging.handlers
 from pathlib import Path
 from botocore.config import Config
@@ -20,6 +22,24 @@ file_handler.setLevel(logging.INFO)
 logging.getLogger().addHandler(file_handler)
 logging.getLogger().addHandler(stdout_handler)
 logging.getLogger().setLevel(logging.INFO)
+log_listener = None
+
+
+def start_log_listener():
+    """Move the root handlers behind a queue for `mse start`, so disk and stdout writes happen in a listener thread
+    instead of the control loop. Records are still formatted in the logging thread by `QueueHandler.prepare`."""
+    global log_listener
+    if log_listener:
+        return
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, stdout_handler, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.removeHandler(file_handler)
+    root_logger.removeHandler(stdout_handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
 
 boto3_config = Config(
     retries={
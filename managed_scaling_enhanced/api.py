@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import orjson
+import requests
+
+from managed_scaling_enhanced.database import Session
+from managed_scaling_enhanced.models import EMREvent
+from managed_scaling_enhanced.status import registry
+from managed_scaling_enhanced.planner import planner
+
+logger = logging.getLogger(__name__)
+
+api_url = os.getenv('MSE_API_URL', 'http://127.0.0.1:8765')
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health
+    GET  /clusters
+    GET  /clusters/<cluster_id>?decisions=N
+    GET  /clusters/<cluster_id>/events?limit=N&hours=H
+    GET  /cycles?limit=N
+    POST /clusters/<cluster_id>/config   {"cpu_usage_lower_bound": 0.3, ...}
+    """
+
+    def send_json(self, status, data):
+        body = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['health']:
+            self.send_json(200, {'status': 'ok'})
+        elif parts == ['clusters']:
+            self.send_json(200, registry.list())
+        elif parts == ['cycles']:
+            self.send_json(200, planner.list(int(parse_qs(url.query).get('limit', ['20'])[0])))
+        elif len(parts) == 3 and parts[0] == 'clusters' and parts[2] == 'events':
+            query = parse_qs(url.query)
+            since = datetime.utcnow() - timedelta(hours=float(query.get('hours', ['48'])[0]))
+            statement = EMREvent.recent_statement(parts[1], since=since, limit=int(query.get('limit', ['50'])[0]))
+            with Session() as session:
+                self.send_json(200, [event.to_dict() for event in session.scalars(statement)])
+        elif len(parts) == 2 and parts[0] == 'clusters':
+            decisions = int(parse_qs(url.query).get('decisions', ['10'])[0])
+            status = registry.get(parts[1], decisions=decisions)
+            if status is None:
+                self.send_json(404, {'error': f'Cluster {parts[1]} has not been evaluated by this process'})
+            else:
+                self.send_json(200, status)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+        if len(parts) != 3 or parts[0] != 'clusters' or parts[2] != 'config':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if registry.get(parts[1]) is None:
+            self.send_json(404, {'error': f'Cluster {parts[1]} has not been evaluated by this process'})
+            return
+        try:
+            changes = orjson.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            pending = registry.queue_config(parts[1], changes)
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        logger.info(f'Queued config changes for cluster {parts[1]}: {changes}')
+        self.send_json(202, {'cluster_id': parts[1], 'pending_config': pending})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_api_server(host, port):
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='mse-api').start()
+    logger.info(f'Status API listening on http://{host}:{port}')
+    return server
+
+
+def api_request(method, path, data=None):
+    """Call the API of a running daemon. Return None if no daemon is listening so callers can fall back to the DB."""
+    try:
+        response = requests.request(method, f'{api_url}{path}', json=data, timeout=1)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code == 404:
+        return None
+    if response.status_code == 400:
+        raise ValueError(response.json()['error'])
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from sqlalchemy import select
+
+from managed_scaling_enhanced.database import get_async_session
+from managed_scaling_enhanced.metrics import (get_instances, fetch_yarn_metrics, build_metric,
+                                              cpu_baselines_statement, compute_cpu_utilization, record_cpu_scrape,
+                                              lookback_metrics_statement, seed_window,
+                                              fetch_prometheus_cpu_utilization, fetch_yarn_cpu_utilization)
+from managed_scaling_enhanced.models import Cluster, CpuSource
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.run import (read_sqs, clean, allocate_groups, group_budgets, update_description,
+                                          cached_lookback_metrics, average_metrics, record_evaluation)
+from managed_scaling_enhanced.groups import group_allocator
+from managed_scaling_enhanced.scale import evaluate_and_scale
+from managed_scaling_enhanced.status import registry
+from managed_scaling_enhanced.scraper import scraper
+from managed_scaling_enhanced.profiling import profiler
+from managed_scaling_enhanced.checkpoint import checkpointer
+from managed_scaling_enhanced.sampler import sampler
+from managed_scaling_enhanced.planner import planner, CycleReport
+from managed_scaling_enhanced.cluster_cache import cluster_cache, check_version, StaleCluster
+from managed_scaling_enhanced.spool import spool
+from managed_scaling_enhanced.windows import metric_windows
+
+logger = logging.getLogger(__name__)
+evaluating = set()
+# Clusters to evaluate again once their evaluation finishes, after an EMR event or a concurrent change of their row
+rerun_requested = set()
+
+
+async def in_executor(executor, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def get_cpu_utilization_async(cluster: Cluster, session, http_session, executor):
+    if cluster.cpu_source == CpuSource.PROMETHEUS:
+        return await fetch_prometheus_cpu_utilization(http_session, cluster)
+    if cluster.cpu_source == CpuSource.YARN:
+        return await fetch_yarn_cpu_utilization(http_session, cluster)
+    instances = await in_executor(executor, get_instances, cluster)
+    cpu_usages, stats = await scraper.scrape(http_session, instances)
+    baselines = record_cpu_scrape(cluster, cpu_usages, stats)
+    if baselines is None:
+        baselines = (await session.scalars(cpu_baselines_statement(cluster))).all()
+    if not spool.add(session, *cpu_usages):
+        await session.commit()
+    return compute_cpu_utilization(cpu_usages, baselines)
+
+
+async def do_run_async(cluster: Cluster, dry_run, session, http_session, executor):
+    timer = profiler.timer(cluster.id)
+    emr_client = client_pool.emr(cluster)
+    response = await in_executor(executor, emr_client.describe_cluster, ClusterId=cluster.id)
+    timer.lap('describe_cluster')
+    if not update_description(cluster, response):
+        return
+    cluster.update_scaling_policy((await in_executor(
+        executor, emr_client.get_managed_scaling_policy, ClusterId=cluster.id))['ManagedScalingPolicy'])
+    if cluster.is_fleet:
+        cluster.instance_fleets = (await in_executor(
+            executor, emr_client.list_instance_fleets, ClusterId=cluster.id))['InstanceFleets']
+    else:
+        cluster.instance_groups = (await in_executor(
+            executor, emr_client.list_instance_groups, ClusterId=cluster.id))['InstanceGroups']
+    timer.lap('describe_topology')
+    await in_executor(executor, seed_window, cluster)
+    sampler.track(cluster)
+    metric = sampler.downsample(cluster) or build_metric(cluster, await fetch_yarn_metrics(http_session,
+                                                                                           cluster.master_dns_name))
+    if spool.add(session, metric):
+        metric_windows.add_metric(cluster, metric)
+    else:
+        await session.commit()
+    registry.record_metrics(cluster.id, metric=metric)
+    timer.lap('yarn_metrics')
+    cpu_utilization = await get_cpu_utilization_async(cluster, session, http_session, executor)
+    timer.lap('cpu_utilization')
+    lb_metrics = None if cpu_utilization is None else cached_lookback_metrics(cluster)
+    if cpu_utilization is not None and lb_metrics is None:
+        lb_metrics = (await session.scalars(lookback_metrics_statement(cluster))).all()
+    avg_metric = average_metrics(cluster, cpu_utilization, lb_metrics)
+    if avg_metric is None:
+        return
+    if not spool.add(session, avg_metric):
+        await session.commit()
+    registry.record_metrics(cluster.id, avg_metric=avg_metric)
+    timer.lap('avg_metrics')
+    # Without autoflush the changes of the evaluation are not written, and the row not locked, during the EMR calls
+    with session.sync_session.no_autoflush:
+        check_version(cluster, await session.scalar(select(Cluster.version).where(Cluster.id == cluster.id)))
+    # The decision may call EMR, so run it off the event loop. It only mutates the cluster object.
+    event = await in_executor(executor, evaluate_and_scale, cluster, avg_metric, dry_run)
+    timer.lap('resize')
+    if event is not None:
+        spool.add(session, event)
+    record_evaluation(cluster, event)
+
+
+async def checkout_cluster_async(session, cluster_id, probed=False):
+    version = None if probed else await session.scalar(select(Cluster.version).where(Cluster.id == cluster_id))
+    cluster = cluster_cache.checkout(cluster_id, version)
+    if cluster is None:
+        return await session.get(Cluster, cluster_id)
+    session.add(cluster)
+    return cluster
+
+
+async def run_cluster_async(cluster_id, dry_run, http_session, executor, semaphore, report: CycleReport = None,
+                            rerun=False):
+    """Evaluate a cluster unless it is already being evaluated. With `rerun`, a cluster already being evaluated is
+    evaluated again once that evaluation finishes, it may have described the cluster before an EMR event."""
+    if cluster_id in evaluating:
+        if rerun:
+            rerun_requested.add(cluster_id)
+        logger.info(f'Skipping cluster {cluster_id} because it is already being evaluated.')
+        return
+    evaluating.add(cluster_id)
+    try:
+        await evaluate_cluster_async(cluster_id, dry_run, http_session, executor, semaphore, report)
+        while cluster_id in rerun_requested:
+            rerun_requested.discard(cluster_id)
+            logger.info(f'Re-evaluating cluster {cluster_id}, a re-run was requested during its evaluation.')
+            await evaluate_cluster_async(cluster_id, dry_run, http_session, executor, semaphore)
+    finally:
+        evaluating.discard(cluster_id)
+
+
+async def evaluate_cluster_async(cluster_id, dry_run, http_session, executor, semaphore, report: CycleReport = None):
+    async with semaphore:
+        started = time.monotonic()
+        evaluated = False
+        try:
+            if report and not planner.should_run(report, cluster_id):
+                return
+            async with get_async_session()() as session:
+                logger.info(f'####################################### Start {cluster_id} ##########################################')
+                cluster = await checkout_cluster_async(session, cluster_id, probed=report is not None)
+                if cluster is None:
+                    return
+                config = registry.apply_pending_config(cluster)
+                if config:
+                    logger.info(f'Applied config changes to cluster {cluster_id}: {config}')
+                    await session.commit()
+                registry.record_cluster(cluster)
+                if not cluster.active:
+                    logger.info(f'Skipping cluster {cluster_id} because it is not active.')
+                    registry.record_result(cluster_id, 'not active')
+                    cluster_cache.checkin(cluster)
+                    return
+                evaluated = True
+                await do_run_async(cluster, dry_run, session, http_session, executor)
+                await session.commit()
+                cluster_cache.checkin(cluster)
+                logger.info(f'####################################### End {cluster_id} ##########################################\n\n\n')
+        except StaleCluster as e:
+            logger.info(f'{e} Evaluating it again.')
+            registry.record_result(cluster_id, 'changed during evaluation')
+            rerun_requested.add(cluster_id)
+        except Exception as e:
+            logger.exception(f'Cluster {cluster_id} error: {e}')
+            registry.record_result(cluster_id, 'error', error=str(e))
+        finally:
+            # Skipped clusters do not tell how long an evaluation takes
+            if report and evaluated:
+                planner.record(report, cluster_id, time.monotonic() - started)
+
+
+async def listen_events_async(event_queue, dry_run, http_session, executor, semaphore):
+    """Long poll the EMR event queue and re-evaluate affected clusters right away, once per queued cluster.
+    A cluster that is being evaluated is evaluated again after it."""
+    queued = set()
+
+    async def evaluate(cluster_id):
+        queued.discard(cluster_id)
+        await run_cluster_async(cluster_id, dry_run, http_session, executor, semaphore, rerun=True)
+
+    tasks = set()
+    while True:
+        try:
+            cluster_ids = await in_executor(executor, read_sqs, event_queue, wait_time_seconds=20)
+        except Exception as e:
+            logger.exception(f'Read event queue {event_queue} error: {e}')
+            await asyncio.sleep(5)
+            continue
+        for cluster_id in cluster_ids - queued:
+            queued.add(cluster_id)
+            logger.info(f'Re-evaluating cluster {cluster_id} triggered by EMR event.')
+            task = asyncio.create_task(evaluate(cluster_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+
+async def run_async(dry_run, event_queue, http_session, executor, semaphore, budget=None):
+    profiler.start_cycle()
+    report = planner.start_cycle(budget)
+    try:
+        # Clusters interleave on the event loop, so the cpu profile covers the whole cycle. Phase timings stay per
+        # cluster.
+        with profiler.profile('cycle'):
+            async with get_async_session()() as session:
+                versions = dict((await session.execute(select(Cluster.id, Cluster.version))).all())
+                group_allocator.start_cycle(await session.run_sync(group_budgets))
+            cluster_cache.refresh(versions)
+            metric_windows.prune(versions)
+            cluster_ids = list(versions)
+            # Clusters acquire the semaphore in submission order, the most urgent ones first
+            await asyncio.gather(*[run_cluster_async(cluster_id, dry_run, http_session, executor, semaphore, report)
+                                   for cluster_id in planner.plan(cluster_ids)])
+            # Members of budgeted groups are scaled from the executor, their decisions wait for the whole group
+            await in_executor(executor, allocate_groups, dry_run)
+            if event_queue:
+                await in_executor(executor, read_sqs, event_queue)
+            async with get_async_session()() as session:
+                # clean table
+                await session.run_sync(clean)
+                await session.commit()
+    finally:
+        group_allocator.end_cycle()
+        planner.end_cycle(report)
+        checkpointer.save()
+        profiler.end_cycle()
+
+
+async def start_async(schedule_interval, dry_run, event_queue, run_once=False, concurrency=20, max_workers=8,
+                      budget=None):
+    """Drive every cluster from one event loop. EMR and SQS calls run in a small thread pool,
+    YARN and node_exporter requests share one aiohttp session."""
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mse-aws')
+    semaphore = asyncio.Semaphore(concurrency)
+    listener = None
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as http_session:
+            if event_queue and not run_once:
+                listener = asyncio.create_task(listen_events_async(event_queue, dry_run, http_session,
+                                                                   executor, semaphore))
+                event_queue = None
+            while True:
+                started = time.monotonic()
+                try:
+                    await run_async(dry_run, event_queue, http_session, executor, semaphore, budget=budget)
+                except Exception as e:
+                    logger.exception(f'Run error: {e}')
+                if run_once:
+                    break
+                await asyncio.sleep(max(0.0, schedule_interval - (time.monotonic() - started)))
+    finally:
+        if listener:
+            listener.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,66 @@
+import threading
+
+import boto3
+from botocore.credentials import DeferredRefreshableCredentials
+from botocore.session import get_session
+
+from managed_scaling_enhanced import boto3_config
+
+
+def account_of(role_arn):
+    """Account id of a role arn like arn:aws:iam::123456789012:role/name, None for the default credentials."""
+    return role_arn.split(':')[4] if role_arn else None
+
+
+class ClientPool:
+    """boto3 clients shared by all threads, one per service, region and assumed role.
+    Region None is the default region and role None the default credentials of the process."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.clients = {}
+
+    def session(self, region=None, role_arn=None):
+        with self.lock:
+            key = (region, role_arn)
+            if key not in self.sessions:
+                if role_arn:
+                    self.sessions[key] = self.assume_role_session(region, role_arn)
+                else:
+                    self.sessions[key] = boto3.Session(region_name=region)
+            return self.sessions[key]
+
+    def assume_role_session(self, region, role_arn):
+        sts = self.client('sts', region)
+
+        def refresh():
+            credentials = sts.assume_role(RoleArn=role_arn,
+                                          RoleSessionName='managed-scaling-enhanced')['Credentials']
+            return {'access_key': credentials['AccessKeyId'],
+                    'secret_key': credentials['SecretAccessKey'],
+                    'token': credentials['SessionToken'],
+                    'expiry_time': credentials['Expiration'].isoformat()}
+
+        botocore_session = get_session()
+        # Credentials are fetched on first use and refreshed before they expire
+        botocore_session._credentials = DeferredRefreshableCredentials(refresh_using=refresh,
+                                                                       method='sts-assume-role')
+        return boto3.Session(botocore_session=botocore_session, region_name=region)
+
+    def client(self, service, region=None, role_arn=None):
+        with self.lock:
+            key = (service, region, role_arn)
+            if key not in self.clients:
+                self.clients[key] = self.session(region, role_arn).client(service, config=boto3_config)
+            return self.clients[key]
+
+    def register(self, client, service, region=None, role_arn=None):
+        with self.lock:
+            self.clients[(service, region, role_arn)] = client
+
+    def emr(self, cluster):
+        return self.client('emr', cluster.region, cluster.role_arn)
+
+
+client_pool = ClientPool()
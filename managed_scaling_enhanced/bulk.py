@@ -0,0 +1,134 @@
+import enum
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from fnmatch import fnmatch
+from typing import Optional
+
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.models import Cluster
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BulkResult:
+    cluster_id: str
+    changes: dict = field(default_factory=dict)
+    result: str = 'unchanged'
+    error: Optional[str] = None
+
+    def to_dict(self):
+        return {'Cluster ID': self.cluster_id,
+                'Changes': '\n'.join(f'{key}: {before} -> {after}' for key, (before, after) in self.changes.items()),
+                'Result': self.result,
+                'Error': self.error or ''}
+
+
+def parse_filters(filters):
+    """Parse `column=pattern` filters, patterns are shell style wildcards matched against the column value."""
+    parsed = []
+    for item in filters:
+        key, sep, pattern = item.partition('=')
+        if not sep or key not in Cluster.__table__.columns:
+            raise ValueError(f'Invalid filter {item}, expected <cluster column>=<pattern>')
+        parsed.append((key, pattern))
+    return parsed
+
+
+def filter_value(value):
+    return value.name if isinstance(value, enum.Enum) else str(value)
+
+
+def select_clusters(session, cluster_ids=(), all_clusters=False, cluster_group=None, filters=()):
+    """Clusters selected by id, by group and/or filters, or all of them with `all_clusters`. Nothing is selected
+    without any criteria so a missing option never targets the whole fleet."""
+    parsed = parse_filters(filters)
+    if not (cluster_ids or all_clusters or cluster_group or parsed):
+        return []
+    query = session.query(Cluster)
+    if cluster_ids:
+        query = query.filter(Cluster.id.in_(cluster_ids))
+    if cluster_group:
+        query = query.filter(Cluster.cluster_group == cluster_group)
+    clusters = query.order_by(Cluster.id).all()
+    return [cluster for cluster in clusters
+            if all(fnmatch(filter_value(getattr(cluster, key)), pattern) for key, pattern in parsed)]
+
+
+def run_concurrently(calls: dict, concurrency=20):
+    """Run {key: callable} in a thread pool of `concurrency` threads, return {key: exception or None}."""
+    errors = {}
+    if not calls:
+        return errors
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(calls)), thread_name_prefix='mse-bulk') as executor:
+        futures = {executor.submit(call): key for key, call in calls.items()}
+        for future in as_completed(futures):
+            errors[futures[future]] = future.exception()
+    return errors
+
+
+def finish(results, errors, dry_run):
+    for result in results:
+        if dry_run:
+            if result.changes and result.result == 'unchanged':
+                result.result = 'dry run'
+        elif result.cluster_id in errors:
+            error = errors[result.cluster_id]
+            result.result = 'failed' if error else 'ok'
+            result.error = str(error) if error else None
+    return results
+
+
+def reset_clusters(session, clusters, dry_run=False, concurrency=20):
+    """Put the initial max units back on every cluster with concurrent EMR calls. The database is only updated
+    for the clusters whose policy was put successfully."""
+    results = []
+    policies = {}
+    for cluster in clusters:
+        result = BulkResult(cluster_id=cluster.id)
+        results.append(result)
+        if not cluster.initial_max_units:
+            result.result = 'skipped'
+            result.error = 'No initial managed scaling policy'
+            continue
+        if cluster.current_max_units != cluster.initial_max_units:
+            result.changes['MaximumCapacityUnits'] = (cluster.current_max_units, cluster.initial_max_units)
+        if cluster.pending_scale_direction:
+            result.changes['pending_scale_direction'] = (cluster.pending_scale_direction, None)
+        policies[cluster.id] = (cluster, cluster.new_scaling_policy(max_units=cluster.initial_max_units))
+    if dry_run:
+        return finish(results, {}, dry_run)
+
+    # The policy is put even when the database already has the initial max units, EMR may have drifted from it
+    errors = run_concurrently({cluster_id: put_policy_call(cluster, policy)
+                               for cluster_id, (cluster, policy) in policies.items()}, concurrency)
+    for cluster_id, (cluster, policy) in policies.items():
+        if errors.get(cluster_id) is None:
+            cluster.current_managed_scaling_policy = policy
+            cluster.pending_scale_direction = None
+            cluster.pending_scale_count = 0
+        else:
+            logger.warning(f'Reset cluster {cluster_id} error: {errors[cluster_id]}')
+    session.commit()
+    return finish(results, errors, dry_run)
+
+
+def put_policy_call(cluster: Cluster, policy):
+    return lambda: client_pool.emr(cluster).put_managed_scaling_policy(ClusterId=cluster.id,
+                                                                        ManagedScalingPolicy=policy)
+
+
+def set_active(session, clusters, active, dry_run=False):
+    results = []
+    for cluster in clusters:
+        result = BulkResult(cluster_id=cluster.id)
+        if cluster.active != active:
+            result.changes['active'] = (cluster.active, active)
+            if not dry_run:
+                cluster.active = active
+                result.result = 'ok'
+        results.append(result)
+    if not dry_run:
+        session.commit()
+    return finish(results, {}, dry_run)
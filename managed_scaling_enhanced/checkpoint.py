@@ -0,0 +1,65 @@
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+
+from managed_scaling_enhanced.sampler import sampler
+from managed_scaling_enhanced.scraper import scraper
+from managed_scaling_enhanced.status import registry
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpointer:
+    """Checkpoint the in-memory controller state to a file after every cycle and restore it at startup:
+    live cluster status and recent decisions, config changes queued by the API, the scrape circuit breakers and
+    the YARN sampler buffers. Persisted metrics, CPU counter baselines, cool down timestamps and pending scale
+    counts live in the database, or in the spool until it is replayed."""
+
+    def __init__(self):
+        self.path = None
+        self.max_age_minutes = 60
+
+    def configure(self, path=None, max_age_minutes=60):
+        self.path = Path(path) if path else None
+        self.max_age_minutes = max_age_minutes
+
+    def save(self):
+        if not self.path:
+            return
+        state = {'saved_at': datetime.utcnow(),
+                 'registry': registry.export_state(),
+                 'scraper': scraper.export_state(),
+                 'sampler': sampler.export_state()}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.exception(f'Save checkpoint {self.path} error: {e}')
+
+    def restore(self):
+        if not self.path or not self.path.exists():
+            return False
+        try:
+            state = orjson.loads(self.path.read_bytes())
+            age_minutes = (datetime.utcnow() - datetime.fromisoformat(state['saved_at'])).total_seconds() / 60
+            if age_minutes > self.max_age_minutes:
+                logger.info(f'Ignoring checkpoint {self.path} saved {age_minutes:.0f} minutes ago.')
+                return False
+            registry.restore_state(state['registry'])
+            scraper.restore_state(state['scraper'], elapsed_seconds=age_minutes * 60)
+            # Checkpoints written before the sampler was checkpointed have no buffers
+            sampler.restore_state(state.get('sampler', {}), elapsed_seconds=age_minutes * 60)
+        except Exception as e:
+            logger.exception(f'Restore checkpoint {self.path} error: {e}')
+            return False
+        logger.info(f'Restored state of {len(state["registry"]["clusters"])} clusters from checkpoint {self.path}, '
+                    f'saved {age_minutes:.1f} minutes ago.')
+        return True
+
+
+checkpointer = Checkpointer()
@@ -1,16 +1,32 @@
 import click
 
-from managed_scaling_enhanced import boto3_config
-from managed_scaling_enhanced.database import Session
-from managed_scaling_enhanced.models import Cluster, ResizePolicy
+from managed_scaling_enhanced import start_log_listener
+from managed_scaling_enhanced.aws import client_pool, account_of
+from managed_scaling_enhanced.database import Session, engine
+from managed_scaling_enhanced.models import Cluster, ClusterGroup, ResizePolicy, CpuSource, Event, upgrade_schema
 from apscheduler.schedulers.background import BackgroundScheduler
-from managed_scaling_enhanced.run import run
+from managed_scaling_enhanced.run import run, listen_events
+from managed_scaling_enhanced.async_run import start_async
+from managed_scaling_enhanced.api import start_api_server, api_request
+from managed_scaling_enhanced.status import coerce_config
+from managed_scaling_enhanced.scraper import scraper
+from managed_scaling_enhanced.profiling import profiler
+from managed_scaling_enhanced.checkpoint import checkpointer
+from managed_scaling_enhanced.sampler import sampler
+from managed_scaling_enhanced.decision_log import decision_log
+from managed_scaling_enhanced.spool import spool
+from managed_scaling_enhanced.shadow import SHADOW_FIELDS, shadow_policy, shadow_summary
+from managed_scaling_enhanced.bulk import select_clusters, reset_clusters, set_active, run_concurrently, BulkResult
+import asyncio
+import os
+import pprint
+import threading
 import time
-import boto3
 import random
+from datetime import datetime, timedelta
 from tabulate import tabulate
 
-emr_client = boto3.client('emr', config=boto3_config)
+emr_client = client_pool.client('emr')
 
 
 @click.group()
@@ -18,6 +34,12 @@ def cli():
     pass
 
 
+def check_prometheus_url(cpu_source, prometheus_url):
+    if cpu_source == CpuSource.PROMETHEUS.name and not (prometheus_url or os.getenv('PROMETHEUS_URL')):
+        raise click.BadParameter('is required with --cpu-source PROMETHEUS unless $PROMETHEUS_URL is set',
+                                 param_hint='--prometheus-url')
+
+
 @click.command()
 @click.option('--cluster-id', required=True, help='EMR cluster ID')
 @click.option('--cluster-name', default=None, help='EMR cluster name')
@@ -30,18 +52,50 @@ def cli():
 @click.option('--scale-out-factor', default=1.0)
 @click.option('--max-capacity-limit', help='Maximum capacity limit')
 @click.option('--resize-policy', default=ResizePolicy.CPU_BASED.name)
+@click.option('--scale-in-dead-band', default=0.0,
+              help='Ignore scale in smaller than this fraction of current max units')
+@click.option('--scale-out-dead-band', default=0.0,
+              help='Ignore scale out smaller than this fraction of current max units')
+@click.option('--min-scale-step', default=1, help='Minimum units to change the max capacity by')
+@click.option('--required-consecutive-evaluations', default=1,
+              help='Number of consecutive evaluations in the same direction required before scaling')
+@click.option('--cpu-source', default=CpuSource.NODE_EXPORTER.name,
+              type=click.Choice([source.name for source in CpuSource]),
+              help='Where CPU utilization comes from')
+@click.option('--prometheus-url', help='Prometheus compatible API, defaults to $PROMETHEUS_URL')
+@click.option('--prometheus-selector', help='Label selector of the cluster nodes, defaults to cluster_id="{cluster_id}"')
+@click.option('--min-scrape-coverage', default=0.0,
+              help='Ignore CPU utilization when a smaller share of the nodes could be scraped')
+@click.option('--region', help='Region of the cluster, defaults to the region of the scheduler')
+@click.option('--role-arn', help='Role to assume to manage the cluster in another account')
+@click.option('--aggressive-scale-out', is_flag=True,
+              help='Also raise the task fleet target or instance group count when scaling out')
+@click.option('--container-aware-scale-in/--no-container-aware-scale-in', default=True,
+              help='Only remove task nodes without YARN containers when scaling in')
+@click.option('--log-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING']),
+              help='Decision log level of the cluster, defaults to --decision-log-level of the scheduler')
 def add(cluster_id, cluster_name, cluster_group, cpu_usage_upper_bound, cpu_usage_lower_bound,
         metrics_lookback_period_minutes, cool_down_period_minutes, max_capacity_limit,
-        scale_in_factor, scale_out_factor, resize_policy):
+        scale_in_factor, scale_out_factor, resize_policy, scale_in_dead_band, scale_out_dead_band,
+        min_scale_step, required_consecutive_evaluations, cpu_source, prometheus_url, prometheus_selector,
+        min_scrape_coverage, region, role_arn, aggressive_scale_out, container_aware_scale_in, log_level):
     """Add an EMR cluster to be managed by this tool."""
+    check_prometheus_url(cpu_source, prometheus_url)
     session = Session()
     cluster = Cluster(id=cluster_id, cluster_name=cluster_name,
                       cluster_group=cluster_group, cpu_usage_upper_bound=cpu_usage_upper_bound,
                       cpu_usage_lower_bound=cpu_usage_lower_bound,
                       metrics_lookback_period_minutes=metrics_lookback_period_minutes,
                       cool_down_period_minutes=cool_down_period_minutes, max_capacity_limit=max_capacity_limit,
-                      scale_in_factor=scale_in_factor, scale_out_factor=scale_out_factor, resize_policy=resize_policy)
-    cluster.initial_managed_scaling_policy = emr_client.get_managed_scaling_policy(ClusterId=cluster.id)[
+                      scale_in_factor=scale_in_factor, scale_out_factor=scale_out_factor, resize_policy=resize_policy,
+                      scale_in_dead_band=scale_in_dead_band, scale_out_dead_band=scale_out_dead_band,
+                      min_scale_step=min_scale_step,
+                      required_consecutive_evaluations=required_consecutive_evaluations,
+                      cpu_source=cpu_source, prometheus_url=prometheus_url,
+                      prometheus_selector=prometheus_selector, min_scrape_coverage=min_scrape_coverage,
+                      region=region, role_arn=role_arn, aggressive_scale_out=aggressive_scale_out,
+                      container_aware_scale_in=container_aware_scale_in, log_level=log_level)
+    cluster.initial_managed_scaling_policy = client_pool.emr(cluster).get_managed_scaling_policy(ClusterId=cluster.id)[
         'ManagedScalingPolicy']
     cluster.current_managed_scaling_policy = cluster.initial_managed_scaling_policy
     if max_capacity_limit is None:
@@ -61,41 +115,70 @@ def add(cluster_id, cluster_name, cluster_group, cpu_usage_upper_bound, cpu_usag
 @click.option('--resize-policy')
 @click.option('--scale-in-factor')
 @click.option('--scale-out-factor')
-def modify(cluster_id, cpu_usage_upper_bound, cpu_usage_lower_bound,
-           metrics_lookback_period_minutes, cool_down_period_minutes,
-           max_capacity_limit, resize_policy, scale_in_factor, scale_out_factor):
+@click.option('--scale-in-dead-band')
+@click.option('--scale-out-dead-band')
+@click.option('--min-scale-step')
+@click.option('--required-consecutive-evaluations')
+@click.option('--cpu-source', type=click.Choice([source.name for source in CpuSource]))
+@click.option('--prometheus-url')
+@click.option('--prometheus-selector')
+@click.option('--min-scrape-coverage')
+@click.option('--aggressive-scale-out', type=click.BOOL)
+@click.option('--container-aware-scale-in', type=click.BOOL)
+@click.option('--log-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING']))
+@click.option('--no-api', is_flag=True, help='Write to the database instead of the running daemon')
+def modify(cluster_id, no_api, **options):
     """Modify a cluster configuration"""
+    changes = {k: v for k, v in options.items() if v is not None}
+    if changes.get('cpu_source') == CpuSource.PROMETHEUS.name and 'prometheus_url' not in changes:
+        session = Session()
+        check_prometheus_url(CpuSource.PROMETHEUS.name,
+                             session.query(Cluster.prometheus_url).filter(Cluster.id == cluster_id).scalar())
+        session.close()
+    if not no_api:
+        result = api_request('POST', f'/clusters/{cluster_id}/config', changes)
+        if result is not None:
+            click.echo(f'Config changes {result["pending_config"]} will be applied on the next evaluation.')
+            return
     session = Session()
     cluster: Cluster = session.get(Cluster, cluster_id)
-    if cpu_usage_upper_bound is not None:
-        cluster.cpu_usage_upper_bound = cpu_usage_upper_bound
-    if cpu_usage_lower_bound is not None:
-        cluster.cpu_usage_lower_bound = cpu_usage_lower_bound
-    if metrics_lookback_period_minutes is not None:
-        cluster.metrics_lookback_period_minutes = metrics_lookback_period_minutes
-    if cool_down_period_minutes is not None:
-        cluster.cool_down_period_minutes = cool_down_period_minutes
-    if max_capacity_limit is not None:
-        cluster.max_capacity_limit = max_capacity_limit
-    if resize_policy is not None:
-        cluster.resize_policy = resize_policy
-    if scale_in_factor is not None:
-        cluster.scale_in_factor = scale_in_factor
-    if scale_out_factor is not None:
-        cluster.scale_out_factor = scale_out_factor
+    for key, value in coerce_config(changes).items():
+        setattr(cluster, key, value)
     session.commit()
     session.close()
 
 
 @click.command()
-def list_cluster():
+@click.option('--no-api', is_flag=True, help='Read from the database instead of the running daemon')
+def list_cluster(no_api):
     """List info of all EMR clusters."""
+    statuses = None if no_api else api_request('GET', '/clusters')
+    if statuses is not None:
+        dicts = []
+        for status in statuses:
+            config = status['config']
+            dicts.append({'Cluster ID': status['cluster_id'],
+                          'Cluster Name': config['cluster_name'],
+                          'Region': config['region'],
+                          'Account': account_of(config['role_arn']),
+                          'Resize Policy': config['resize_policy'],
+                          'CPU Upper Bound': config['cpu_usage_upper_bound'],
+                          'CPU Lower Bound': config['cpu_usage_lower_bound'],
+                          'Max Unit Limit': config['max_capacity_limit'],
+                          'Lookback Period': config['metrics_lookback_period_minutes'],
+                          'Cool Down': config['cool_down_period_minutes'],
+                          'Cool Down Remaining': round(status['cool_down_remaining_seconds']),
+                          'Last Result': status['last_result']})
+        click.echo(tabulate(dicts, headers="keys", tablefmt="grid"))
+        return
     session = Session()
     clusters = session.query(Cluster).all()
     dicts = []
     for cluster in clusters:
         dicts.append({'Cluster ID': cluster.id,
                       'Cluster Name': cluster.cluster_name,
+                      'Region': cluster.region,
+                      'Account': account_of(cluster.role_arn),
                       'Resize Policy': cluster.resize_policy.name,
                       'CPU Upper Bound': cluster.cpu_usage_upper_bound,
                       'CPU Lower Bound': cluster.cpu_usage_lower_bound,
@@ -123,8 +206,14 @@ def delete_cluster(cluster_id):
 
 @click.command()
 @click.option('--cluster-id', required=True, help='EMR cluster ID')
-def describe_cluster(cluster_id):
+@click.option('--decisions', default=10, help='Number of recent decisions to show from the running daemon')
+@click.option('--no-api', is_flag=True, help='Read from the database instead of the running daemon')
+def describe_cluster(cluster_id, decisions, no_api):
     """Describe an EMR cluster by cluster id."""
+    status = None if no_api else api_request('GET', f'/clusters/{cluster_id}?decisions={decisions}')
+    if status is not None:
+        click.echo(pprint.pformat(status))
+        return
     session = Session()
     cluster = session.query(Cluster).get(cluster_id)
     if not cluster:
@@ -139,13 +228,82 @@ def describe_cluster(cluster_id):
 @click.option('--dry-run', is_flag=True, help='Dry run mode')
 @click.option('--run-once', is_flag=True, help='Run only once')
 @click.option('--event-queue', help='EMR event queue name')
-def start(schedule_interval, run_once, dry_run, event_queue):
+@click.option('--async', 'use_async', is_flag=True, help='Evaluate all clusters concurrently on one asyncio event loop')
+@click.option('--concurrency', default=20, help='Maximum clusters evaluated at the same time in async mode')
+@click.option('--max-workers', default=8, help='Threads used for blocking AWS calls in async mode')
+@click.option('--api-host', default='127.0.0.1', help='Listen address of the status API')
+@click.option('--api-port', default=8765, help='Port of the status API, 0 to disable it')
+@click.option('--scrape-concurrency', default=200, help='Maximum node_exporter requests in flight')
+@click.option('--scrape-cluster-concurrency', default=50, help='Maximum node_exporter requests in flight per cluster')
+@click.option('--scrape-connect-timeout', default=1.0, help='node_exporter connect timeout seconds')
+@click.option('--scrape-read-timeout', default=3.0, help='node_exporter read timeout seconds')
+@click.option('--scrape-hedge-after', type=click.FLOAT,
+              help='Send a second request to nodes that have not answered after this many seconds')
+@click.option('--profile', multiple=True, type=click.Choice(['cpu', 'memory']),
+              help='Profile cycles: cpu writes cProfile stats per cluster, memory writes tracemalloc diffs')
+@click.option('--profile-every', default=1, help='Profile every Nth cycle')
+@click.option('--profile-dir', default='log/profiles', help='Directory of the profile files')
+@click.option('--profile-keep', default=20, help='Number of profiled cycles to keep files of')
+@click.option('--partition-workers', default=4, help='Regions and accounts evaluated in parallel')
+@click.option('--checkpoint', default='log/checkpoint.json', help='File the controller state is saved to every cycle '
+                                                                  'and restored from at startup, empty to disable')
+@click.option('--checkpoint-max-age', default=60, help='Ignore checkpoints older than this many minutes')
+@click.option('--yarn-sample-interval', default=0.0,
+              help='Sample YARN metrics every this many seconds in the background, 0 samples once per cycle')
+@click.option('--cycle-budget', type=click.FLOAT,
+              help='Seconds a cycle may take before less urgent clusters are deferred, '
+                   'defaults to 90%% of the schedule interval, 0 disables it')
+@click.option('--decision-log', 'decision_log_path', default='log/decisions.jsonl',
+              help='JSON lines file of scaling decisions, empty to disable')
+@click.option('--decision-log-level', default='INFO', type=click.Choice(['DEBUG', 'INFO', 'WARNING']),
+              help='Decision log level of clusters without their own, DEBUG adds metrics and cluster state')
+@click.option('--decision-log-noop-every', default=10, help='Only log every Nth decision without action per cluster')
+@click.option('--spool-dir', default='log/spool',
+              help='Directory metrics and events are spooled to and replayed to the database from, '
+                   'empty to write them to the database directly')
+def start(schedule_interval, run_once, dry_run, event_queue, use_async, concurrency, max_workers, api_host, api_port,
+          scrape_concurrency, scrape_cluster_concurrency, scrape_connect_timeout, scrape_read_timeout,
+          scrape_hedge_after, profile, profile_every, profile_dir, profile_keep, partition_workers, checkpoint,
+          checkpoint_max_age, yarn_sample_interval, cycle_budget, decision_log_path, decision_log_level,
+          decision_log_noop_every, spool_dir):
     """Start background scheduled job."""
-    if run_once:
-        run(dry_run, event_queue)
+    start_log_listener()
+    upgrade_schema(engine)
+    decision_log.configure(path=decision_log_path, level=decision_log_level, noop_every=decision_log_noop_every)
+    spool.configure(directory=spool_dir)
+    spool.start()
+    profiler.configure(modes=profile, every=profile_every, directory=profile_dir, keep=profile_keep)
+    if not run_once:
+        # Before the restore, the sampler buffers of the checkpoint are only restored when sampling is enabled
+        sampler.configure(interval=yarn_sample_interval)
+    checkpointer.configure(path=checkpoint, max_age_minutes=checkpoint_max_age)
+    checkpointer.restore()
+    scraper.configure(concurrency=scrape_concurrency, cluster_concurrency=scrape_cluster_concurrency,
+                      connect_timeout=scrape_connect_timeout, read_timeout=scrape_read_timeout,
+                      hedge_after=scrape_hedge_after)
+    if api_port and not run_once:
+        start_api_server(api_host, api_port)
+    if not run_once:
+        sampler.start()
+    if cycle_budget is None and schedule_interval and not run_once:
+        cycle_budget = schedule_interval * 0.9
+    if use_async:
+        try:
+            asyncio.run(start_async(schedule_interval, dry_run, event_queue, run_once=run_once,
+                                    concurrency=concurrency, max_workers=max_workers, budget=cycle_budget))
+        except (KeyboardInterrupt, SystemExit):
+            click.echo("Event loop shutdown successfully.")
+    elif run_once:
+        run(dry_run, event_queue, partition_workers=partition_workers, budget=cycle_budget)
     else:
         scheduler = BackgroundScheduler()
-        scheduler.add_job(run, 'interval', args=[dry_run, event_queue], seconds=schedule_interval)
+        stop_event = threading.Event()
+        if event_queue:
+            # EMR events are consumed continuously and trigger an immediate re-evaluation of their cluster
+            threading.Thread(target=listen_events, args=(event_queue, dry_run, stop_event), daemon=True).start()
+        scheduler.add_job(run, 'interval', args=[dry_run, None],
+                          kwargs={'partition_workers': partition_workers, 'budget': cycle_budget},
+                          seconds=schedule_interval)
         scheduler.start()
         try:
             # 主线程继续运行，直到按Ctrl+C或发生异常
@@ -153,7 +311,10 @@ def start(schedule_interval, run_once, dry_run, event_queue):
                 time.sleep(1)
         except (KeyboardInterrupt, SystemExit):
             # 关闭调度器
+            stop_event.set()
             scheduler.shutdown()
+            checkpointer.save()
+            spool.stop()
             click.echo("Scheduler shutdown successfully.")
 
 
@@ -239,55 +400,210 @@ def kill_test_job(cluster_id, job_number):
             click.echo(cluster.kill_app(app_id).text)
 
 
+def cluster_selection(func):
+    """Options selecting the clusters of a bulk operation."""
+    options = [
+        click.option('--cluster-id', 'cluster_ids', multiple=True, help='EMR cluster ID, can be repeated'),
+        click.option('--all-clusters', '-a', is_flag=True, help='Select all clusters.'),
+        click.option('--cluster-group', help='Select the clusters of this group'),
+        click.option('--filter', 'filters', multiple=True,
+                     help='Select clusters whose column matches a wildcard pattern, e.g. region=eu-*, can be repeated'),
+        click.option('--dry-run', is_flag=True, help='Only show the changes'),
+        click.option('--concurrency', default=20, help='Clusters changed at the same time'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def selected_clusters(session, cluster_ids, all_clusters, cluster_group, filters):
+    try:
+        return select_clusters(session, cluster_ids=cluster_ids, all_clusters=all_clusters,
+                               cluster_group=cluster_group, filters=filters)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--filter')
+
+
+def echo_results(results):
+    click.echo(tabulate([result.to_dict() for result in results], headers="keys", tablefmt="grid"))
+    if any(result.result == 'failed' for result in results):
+        raise SystemExit(1)
+
+
 @click.command()
-@click.option('--cluster-id', help='EMR cluster ID')
-@click.option('--all-clusters', '-a', is_flag=True, help='Reset all clusters.')
-def reset(cluster_id, all_clusters):
-    """Reset clusters."""
-    session = Session()
-    clusters = session.query(Cluster).all()
+@cluster_selection
+def reset(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency):
+    """Reset clusters to their initial max units."""
+    with Session() as session:
+        clusters = selected_clusters(session, cluster_ids, all_clusters, cluster_group, filters)
+        results = reset_clusters(session, clusters, dry_run=dry_run, concurrency=concurrency)
+    echo_results(results)
+
+
+def set_active_via_api(session, clusters, active, concurrency):
+    """Queue the change on the running daemon, None when there is no daemon. Clusters the daemon did not answer for
+    (timeout or 404) are changed in the database instead."""
+    if api_request('GET', '/cycles?limit=1') is None:
+        return None
+    responses = {}
+
+    def queue(cluster_id):
+        responses[cluster_id] = api_request('POST', f'/clusters/{cluster_id}/config', {'active': active})
+
+    errors = run_concurrently({cluster.id: lambda cluster_id=cluster.id: queue(cluster_id) for cluster in clusters},
+                              concurrency)
+    unanswered = [cluster for cluster in clusters if not errors[cluster.id] and responses.get(cluster.id) is None]
+    fallback = {result.cluster_id: result for result in set_active(session, unanswered, active)} if unanswered else {}
+    results = []
     for cluster in clusters:
-        if cluster.initial_max_units and (cluster.id == cluster_id or all_clusters):
-            cluster.modify_scaling_policy(max_units=cluster.initial_max_units)
-            click.echo(f'Reset cluster {cluster.id} to initial max capacity {cluster.initial_max_units}')
-            emr_client.put_managed_scaling_policy(ClusterId=cluster.id,
-                                                  ManagedScalingPolicy=cluster.current_managed_scaling_policy)
-    session.commit()
-    session.close()
+        if cluster.id in fallback:
+            results.append(fallback[cluster.id])
+            continue
+        error = errors[cluster.id]
+        results.append(BulkResult(cluster_id=cluster.id, changes={'active': (cluster.active, active)},
+                                  result='failed' if error else 'queued', error=str(error) if error else None))
+    return results
+
+
+def change_active(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency, no_api, active):
+    with Session() as session:
+        clusters = selected_clusters(session, cluster_ids, all_clusters, cluster_group, filters)
+        results = None
+        if not no_api and not dry_run:
+            results = set_active_via_api(session, clusters, active, concurrency)
+        if results is None:
+            results = set_active(session, clusters, active, dry_run=dry_run)
+    echo_results(results)
 
 
 @click.command()
-@click.option('--cluster-id', help='EMR cluster ID')
-@click.option('--all-clusters', '-a', is_flag=True, help='Disable all clusters.')
-def disable_cluster(cluster_id, all_clusters):
-    """Disable an EMR cluster."""
-    clusters = []
-    session = Session()
-    if cluster_id:
-        clusters.append(session.get(Cluster, cluster_id))
-    elif all_clusters:
-        clusters = session.query(Cluster).all()
-    for cluster in clusters:
-        cluster.active = False
-    session.commit()
-    session.close()
+@cluster_selection
+@click.option('--no-api', is_flag=True, help='Write to the database instead of the running daemon')
+def disable_cluster(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency, no_api):
+    """Disable EMR clusters."""
+    change_active(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency, no_api, False)
 
 
 @click.command()
-@click.option('--cluster-id', help='EMR cluster ID')
-@click.option('--all-clusters', '-a', is_flag=True, help='Enable all clusters.')
-def enable_cluster(cluster_id, all_clusters):
-    """Enable an EMR cluster."""
-    clusters = []
-    session = Session()
-    if cluster_id:
-        clusters.append(session.get(Cluster, cluster_id))
-    elif all_clusters:
-        clusters = session.query(Cluster).all()
-    for cluster in clusters:
-        cluster.active = True
-    session.commit()
-    session.close()
+@cluster_selection
+@click.option('--no-api', is_flag=True, help='Write to the database instead of the running daemon')
+def enable_cluster(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency, no_api):
+    """Enable EMR clusters."""
+    change_active(cluster_ids, all_clusters, cluster_group, filters, dry_run, concurrency, no_api, True)
+
+
+@click.command()
+@click.option('--cluster-group', help='Cluster group, all groups are listed when not given')
+@click.option('--capacity-budget', type=click.INT,
+              help='Max units shared by the clusters of the group, 0 removes the budget')
+def group_budget(cluster_group, capacity_budget):
+    """Set or list the capacity budgets of cluster groups."""
+    with Session() as session:
+        if cluster_group and capacity_budget is not None:
+            group = session.get(ClusterGroup, cluster_group) or ClusterGroup(name=cluster_group)
+            group.capacity_budget = capacity_budget or None
+            session.add(group)
+            session.commit()
+        dicts = []
+        for group in session.query(ClusterGroup).order_by(ClusterGroup.name):
+            if cluster_group and group.name != cluster_group:
+                continue
+            members = session.query(Cluster.id, Cluster.current_managed_scaling_policy).filter(
+                Cluster.cluster_group == group.name).all()
+            dicts.append({'Cluster Group': group.name,
+                          'Capacity Budget': group.capacity_budget,
+                          'Clusters': len(members),
+                          'Current Max Units': sum(policy['ComputeLimits']['MaximumCapacityUnits']
+                                                   for _, policy in members if policy)})
+    click.echo(tabulate(dicts, headers="keys", tablefmt="grid"))
+
+
+@click.command()
+@click.option('--cluster-id', required=True, help='EMR cluster ID')
+@click.option('--name', help='Name of the shadow policy to add, replace or remove')
+@click.option('--set', 'settings', multiple=True,
+              help=f'column=value overridden by the shadow policy, repeatable. Columns: {", ".join(SHADOW_FIELDS)}')
+@click.option('--remove', is_flag=True, help='Remove the shadow policy')
+@click.option('--hours', default=24, help='Compare the decisions of the last this many hours')
+def shadow(cluster_id, name, settings, remove, hours):
+    """Add, replace or remove a shadow policy of a cluster and compare the decisions of its shadow policies with
+    the real ones. Shadow policies are evaluated on the same metrics every cycle without acting."""
+    with Session() as session:
+        cluster = session.get(Cluster, cluster_id)
+        if not cluster:
+            raise click.BadParameter(f'Cluster {cluster_id} does not exist', param_hint='--cluster-id')
+        if remove and not name:
+            raise click.BadParameter('--remove requires the name of the shadow policy', param_hint='--name')
+        if name:
+            policies = [policy for policy in cluster.shadow_policies or () if policy['name'] != name]
+            if remove and len(policies) == len(cluster.shadow_policies or ()):
+                raise click.BadParameter(f'Cluster {cluster_id} has no shadow policy {name}', param_hint='--name')
+            if not remove:
+                overrides = {}
+                for setting in settings:
+                    key, sep, value = setting.partition('=')
+                    if not sep:
+                        raise click.BadParameter(f'Invalid setting {setting}, expected column=value', param_hint='--set')
+                    overrides[key] = value
+                try:
+                    policies.append(shadow_policy(name, overrides))
+                except ValueError as e:
+                    raise click.BadParameter(str(e), param_hint='--set')
+            cluster.shadow_policies = policies or None
+            session.commit()
+        events = session.query(Event).filter(Event.cluster_id == cluster_id,
+                                             Event.event_time > datetime.utcnow() - timedelta(hours=hours)).all()
+        rows = shadow_summary(events, cluster.shadow_policies)
+    click.echo(tabulate(rows, headers="keys", tablefmt="grid"))
+
+
+@click.command()
+@click.option('--cycles', default=1000, help='Number of simulated scheduling cycles')
+@click.option('--clusters', default=3, help='Number of simulated clusters, fleets and instance groups alternate')
+@click.option('--nodes', default=4, help='Number of simulated nodes per cluster')
+@click.option('--interval', default=60, help='Simulated seconds between cycles')
+@click.option('--warmup', default=100, help='Cycles to run before the baseline is measured')
+@click.option('--max-rss-growth-mb', default=32, help='Fail when RSS grows more than this after the warm up')
+@click.option('--max-object-growth', default=5000, help='Fail when live objects grow more than this after the warm up')
+@click.option('--db-conn-str', help='Database of the soak, a temporary sqlite file by default')
+@click.option('--no-spool', is_flag=True, help='Write to the database directly instead of spooling')
+def soak(cycles, clusters, nodes, interval, warmup, max_rss_growth_mb, max_object_growth, db_conn_str, no_spool):
+    """Run simulated cycles against local EMR, YARN and node_exporter stubs and check memory stays bounded."""
+    from managed_scaling_enhanced.soak import soak as run_soak
+    report = run_soak(cycles=cycles, clusters=clusters, nodes=nodes, interval=interval, warmup=warmup,
+                      sample_every=max(cycles // 10, 1), max_rss_growth_mb=max_rss_growth_mb,
+                      max_object_growth=max_object_growth, db_conn_str=db_conn_str, use_spool=not no_spool)
+    click.echo(report.format())
+    if not report.passed:
+        raise SystemExit(1)
+
+
+@click.command()
+@click.option('--clusters', default='10,100,1000', help='Comma separated cluster counts to run, in increasing order')
+@click.option('--nodes', default=10, help='Number of simulated nodes per cluster')
+@click.option('--cycles', default=3, help='Measured cycles per cluster count')
+@click.option('--warmup', default=2, help='Cycles to run before measuring')
+@click.option('--interval', default=60, help='Simulated seconds between cycles, a cycle taking longer overruns')
+@click.option('--node-latency', default=0.0, help='Mean seconds a node_exporter takes to answer')
+@click.option('--node-failure-rate', default=0.0, help='Fraction of node_exporter requests failing')
+@click.option('--async', 'use_async', is_flag=True, help='Measure the asyncio engine instead of the thread pool')
+@click.option('--concurrency', default=20, help='Clusters evaluated concurrently by the asyncio engine')
+@click.option('--db-conn-str', help='Database of the load test, a temporary sqlite file per step by default. '
+                                    'The rows of the simulated clusters are deleted before every step')
+@click.option('--no-spool', is_flag=True, help='Write to the database directly instead of spooling')
+def load_test(clusters, nodes, cycles, warmup, interval, node_latency, node_failure_rate, use_async, concurrency,
+              db_conn_str, no_spool):
+    """Measure cycle time, API calls and DB statements against local stubs at increasing cluster counts."""
+    from managed_scaling_enhanced.loadtest import load_test as run_load_test
+    try:
+        cluster_counts = [int(count) for count in clusters.split(',')]
+    except ValueError:
+        raise click.BadParameter(f'Invalid cluster counts {clusters}', param_hint='--clusters')
+    report = run_load_test(cluster_counts=cluster_counts, nodes=nodes, cycles=cycles, warmup=warmup,
+                           interval=interval, node_latency=node_latency, node_failure_rate=node_failure_rate,
+                           db_conn_str=db_conn_str, use_async=use_async, concurrency=concurrency,
+                           use_spool=not no_spool)
+    click.echo(report.format())
 
 
 cli.add_command(add, 'add-cluster')
@@ -301,7 +617,11 @@ cli.add_command(start, 'start')
 cli.add_command(reset, 'reset')
 cli.add_command(disable_cluster, 'disable-cluster')
 cli.add_command(enable_cluster, 'enable-cluster')
+cli.add_command(group_budget, 'group-budget')
+cli.add_command(shadow, 'shadow-policy')
 cli.add_command(test, 'test')
+cli.add_command(soak, 'soak')
+cli.add_command(load_test, 'load-test')
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,52 @@
+import threading
+
+from managed_scaling_enhanced.models import Cluster
+
+
+class StaleCluster(Exception):
+    """The row of a cluster was updated by someone else while the cluster was being evaluated."""
+
+
+def check_version(cluster: Cluster, version):
+    """Raise StaleCluster when `version`, just read from the database, is not the one the cluster was loaded with.
+    Checked before EMR is changed, the commit of the evaluation would only fail after the EMR calls otherwise."""
+    if version != cluster.version:
+        raise StaleCluster(f'Cluster {cluster.id} was changed from version {cluster.version} to {version} '
+                           f'during its evaluation.')
+
+
+class ClusterCache:
+    """Cluster rows kept across cycles as detached objects, so their policy, fleet and group JSON is not loaded and
+    parsed again on every evaluation. Every update of a row increments its version (also the updates made by this
+    process), a cycle probes the versions of all rows and only the clusters changed by someone else are reloaded.
+    A cluster is checked out by the one session evaluating it and checked in again after a successful commit."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clusters = {}
+
+    def refresh(self, versions: dict):
+        """Drop the clusters deleted or modified since they were cached, `versions` maps cluster id to row version."""
+        with self.lock:
+            for cluster_id in list(self.clusters):
+                if versions.get(cluster_id) != self.clusters[cluster_id].version:
+                    del self.clusters[cluster_id]
+
+    def checkout(self, cluster_id, version=None) -> Cluster:
+        """The cached cluster or None. A `version` different from the cached one also returns None."""
+        with self.lock:
+            cluster = self.clusters.pop(cluster_id, None)
+        if cluster is not None and version is not None and cluster.version != version:
+            return None
+        return cluster
+
+    def checkin(self, cluster: Cluster):
+        with self.lock:
+            self.clusters[cluster.id] = cluster
+
+    def invalidate(self, cluster_id):
+        with self.lock:
+            self.clusters.pop(cluster_id, None)
+
+
+cluster_cache = ClusterCache()
@@ -16,3 +16,21 @@ Base = declarative_base()
 
 # Create a sessionmaker
 Session = sessionmaker(bind=engine)
+
+_async_session = None
+
+
+def get_async_session():
+    """Return an asyncio sessionmaker. The engine is created lazily so the async DB driver
+    is only needed by `mse start --async`."""
+    global _async_session
+    if _async_session is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        async_connection_string = os.getenv('ASYNC_DB_CONN_STR', connection_string
+                                            .replace('sqlite://', 'sqlite+aiosqlite://')
+                                            .replace('mysql+pymysql://', 'mysql+aiomysql://'))
+        async_engine = create_async_engine(async_connection_string, echo=False,
+                                           json_serializer=lambda x: orjson.dumps(x).decode('utf8'),
+                                           json_deserializer=lambda x: orjson.loads(x))
+        _async_session = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+    return _async_session
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+
+decision_logger = logging.getLogger('managed_scaling_enhanced.decisions')
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue the record as is, so the JSON is serialized by the listener thread instead of the control loop."""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        line = {'time': datetime.utcfromtimestamp(record.created), 'level': record.levelname, **record.msg}
+        return orjson.dumps(line, option=orjson.OPT_NON_STR_KEYS, default=str).decode('utf8')
+
+
+class DecisionLog:
+    """JSON lines log of scaling decisions written by a background thread.
+    A record is only built when the level of its cluster (or the default level) enables it: INFO writes a summary
+    of every decision, DEBUG adds the cluster snapshot and averaged metrics, WARNING disables the log.
+    Decisions without action are sampled, one in `noop_every` per cluster is written."""
+
+    def __init__(self):
+        self.level = logging.INFO
+        self.noop_every = 10
+        self.noop_counts = {}
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def configure(self, path='log/decisions.jsonl', level='INFO', noop_every=10,
+                  max_bytes=50 * 1024 * 1024, backup_count=5):
+        self.level = logging.getLevelName(level)
+        self.noop_every = max(noop_every, 1)
+        if self.listener or not path:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(JsonLinesFormatter())
+        log_queue = queue.SimpleQueue()
+        decision_logger.addHandler(DeferredQueueHandler(log_queue))
+        decision_logger.setLevel(logging.DEBUG)
+        decision_logger.propagate = False
+        self.listener = logging.handlers.QueueListener(log_queue, handler)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def effective_level(self, cluster_level=None):
+        return logging.getLevelName(cluster_level) if cluster_level else self.level
+
+    def log(self, cluster_id, cluster_level, build, noop=False):
+        """Write the record returned by build(detailed) if enabled for the cluster."""
+        if self.listener is None:
+            return
+        level = self.effective_level(cluster_level)
+        if level > logging.INFO:
+            return
+        with self.lock:
+            if noop:
+                count = self.noop_counts.get(cluster_id, 0)
+                self.noop_counts[cluster_id] = count + 1
+                if count % self.noop_every:
+                    return
+            else:
+                self.noop_counts.pop(cluster_id, None)
+        decision_logger.info(build(level <= logging.DEBUG))
+
+
+decision_log = DecisionLog()
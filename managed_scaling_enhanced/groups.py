@@ -0,0 +1,131 @@
+import logging
+import math
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+from managed_scaling_enhanced.models import AvgMetric
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Proposal:
+    cluster_id: str
+    current_units: int
+    request_units: int
+    weight: float
+    plan: Any
+
+
+def demand_weight(avg_metric: AvgMetric):
+    """1 plus the utilization of the cluster, busy clusters turn extra capacity into throughput first."""
+    utilization = max((avg_metric.yarn_allocated_mem + avg_metric.yarn_reserved_mem) / avg_metric.yarn_total_mem
+                      if avg_metric.yarn_total_mem else 0,
+                      (avg_metric.yarn_allocated_vcore + avg_metric.yarn_reserved_vcore) / avg_metric.yarn_total_vcore
+                      if avg_metric.yarn_total_vcore else 0,
+                      avg_metric.cpu_utilization or 0)
+    return 1 + min(utilization, 1)
+
+
+def water_fill(amount, demands: dict, weights: dict):
+    """Split `amount` units in proportion to the weights, no key getting more than its demand, and hand the
+    units a satisfied key does not need to the others. Grants are integers, the rounding remainder goes to the
+    largest fractions."""
+    grants = {}
+    remaining = amount
+    total_weight = sum(weights[key] for key in demands)
+    for key in sorted(demands, key=lambda key: demands[key] / weights[key]):
+        share = remaining * weights[key] / total_weight if total_weight else 0
+        grants[key] = min(demands[key], share)
+        remaining -= grants[key]
+        total_weight -= weights[key]
+    result = {key: math.floor(grant) for key, grant in grants.items()}
+    leftover = amount - sum(result.values())
+    for key in sorted(grants, key=lambda key: grants[key] - result[key], reverse=True):
+        if leftover <= 0:
+            break
+        if result[key] < demands[key]:
+            result[key] += 1
+            leftover -= 1
+    return result
+
+
+def allocate(budget, proposals: dict, held_units=0):
+    """Max units of every proposal within the group budget. Members that do not ask for more units get their
+    request, they are only lowered by their own stabilized decisions. The budget left after them and the units held
+    by the other members is water filled over the scale out requests weighted by demand, above the current max
+    units of those members."""
+    growing = {cluster_id: p for cluster_id, p in proposals.items() if p.request_units > p.current_units}
+    allocations = {cluster_id: p.request_units for cluster_id, p in proposals.items() if cluster_id not in growing}
+    available = budget - held_units - sum(allocations.values()) - sum(p.current_units for p in growing.values())
+    grants = water_fill(max(available, 0),
+                        {cluster_id: p.request_units - p.current_units for cluster_id, p in growing.items()},
+                        {cluster_id: p.weight for cluster_id, p in growing.items()})
+    allocations.update({cluster_id: p.current_units + grants[cluster_id] for cluster_id, p in growing.items()})
+    return allocations
+
+
+class GroupAllocator:
+    """Share the capacity budget of a cluster group between its members.
+    During a cycle the scale decisions of budgeted members are held back until every member has been evaluated,
+    then the group is allocated at once. Evaluations outside of a cycle, triggered by EMR events, are capped by the
+    allocation of the last cycle."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.collecting = False
+        self.proposals = {}
+        self.allocations = {}
+
+    def start_cycle(self, budgets: dict):
+        with self.lock:
+            self.budgets = {group: budget for group, budget in budgets.items() if budget}
+            self.proposals = {}
+            self.collecting = True
+
+    def budgeted(self, cluster_group):
+        return cluster_group in self.budgets
+
+    def propose(self, cluster_group, proposal: Proposal):
+        """Hold back the decision until the group is allocated, False when not collecting a cycle."""
+        with self.lock:
+            if not self.collecting:
+                return False
+            self.proposals.setdefault(cluster_group, {})[proposal.cluster_id] = proposal
+            return True
+
+    def last_allocation(self, cluster_id):
+        with self.lock:
+            return self.allocations.get(cluster_id)
+
+    def drain(self):
+        with self.lock:
+            proposals = self.proposals
+            self.proposals = {}
+            self.collecting = False
+        return proposals
+
+    def end_cycle(self):
+        """Stop holding back decisions, also when the cycle failed before its groups were allocated."""
+        with self.lock:
+            if self.proposals:
+                logger.warning(f'Dropping the held back decisions of cluster groups {", ".join(self.proposals)}, '
+                               f'the cycle ended before they were allocated.')
+            self.proposals = {}
+            self.collecting = False
+
+    def allocate(self, cluster_group, proposals: dict, held_units=0):
+        budget = self.budgets[cluster_group]
+        allocations = allocate(budget, proposals, held_units)
+        requested = held_units + sum(p.request_units for p in proposals.values())
+        if requested > budget:
+            logger.info(f'Cluster group {cluster_group} requested {requested} of {budget} units, allocated: '
+                        f'{allocations}')
+        with self.lock:
+            self.allocations.update(allocations)
+        return allocations
+
+
+group_allocator = GroupAllocator()
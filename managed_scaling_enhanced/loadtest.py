@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import os
+import resource
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import List
+
+import boto3
+import orjson
+from sqlalchemy import create_engine, delete, event
+from sqlalchemy.engine import Engine
+
+from managed_scaling_enhanced import boto3_config, database
+from managed_scaling_enhanced import run
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.cluster_cache import cluster_cache
+from managed_scaling_enhanced.database import Base, Session
+from managed_scaling_enhanced.models import (Cluster, ClusterTopology, Metric, AvgMetric, CpuUsage, Event, EMREvent,
+                                             upgrade_schema)
+from managed_scaling_enhanced.scraper import scraper
+from managed_scaling_enhanced.soak import CLUSTER_ID_PREFIX, SimulatedClock, StubEnvironment, start_spool
+from managed_scaling_enhanced.spool import spool
+from managed_scaling_enhanced.status import registry
+from managed_scaling_enhanced.windows import metric_windows
+
+logger = logging.getLogger(__name__)
+
+
+class StatementCounter:
+    """Count the statements sent to any database by their first keyword."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.counts[statement.lstrip().split(None, 1)[0].upper()] += 1
+
+    def reset(self):
+        counts = self.counts
+        self.counts = Counter()
+        return counts
+
+
+@contextmanager
+def counting_statements():
+    counter = StatementCounter()
+    event.listen(Engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(Engine, 'before_cursor_execute', counter)
+
+
+@dataclass
+class StepResult:
+    clusters: int
+    nodes: int
+    cycle_seconds: List[float] = field(default_factory=list)
+    requests: Counter = field(default_factory=Counter)
+    statements: Counter = field(default_factory=Counter)
+    results: Counter = field(default_factory=Counter)
+
+    @property
+    def cycles(self):
+        return len(self.cycle_seconds)
+
+    @property
+    def mean_seconds(self):
+        return sum(self.cycle_seconds) / self.cycles if self.cycles else 0
+
+    @property
+    def max_seconds(self):
+        return max(self.cycle_seconds, default=0)
+
+    def per_cycle(self, counts: Counter):
+        return {key: value / self.cycles for key, value in sorted(counts.items())} if self.cycles else {}
+
+
+@dataclass
+class LoadTestReport:
+    interval: float
+    steps: List[StepResult] = field(default_factory=list)
+    overrun: StepResult = None
+
+    def format(self):
+        lines = []
+        for step in self.steps:
+            lines.append(f'{step.clusters} clusters x {step.nodes + 1} hosts: cycle mean {step.mean_seconds:.2f}s, '
+                         f'max {step.max_seconds:.2f}s over {step.cycles} cycles')
+            lines.append('  requests per cycle: ' + ', '.join(f'{key} {value:.1f}' for key, value
+                                                               in step.per_cycle(step.requests).items()))
+            lines.append('  results per cycle: ' + ', '.join(f'{key} {value:.1f}' for key, value
+                                                              in step.per_cycle(step.results).items()))
+            lines.append('  DB statements per cycle: ' + ', '.join(f'{key} {value:.1f}' for key, value
+                                                                    in step.per_cycle(step.statements).items()))
+        if self.overrun:
+            lines.append(f'Cycles of {self.overrun.clusters} clusters overran the {self.interval:.0f}s interval '
+                         f'(max {self.overrun.max_seconds:.2f}s)')
+        return '\n'.join(lines)
+
+
+def raise_open_files_limit():
+    """Every simulated host listens on its own sockets, raise the soft limit of open files to the hard one."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def reset_state():
+    """Forget the clusters and hosts of the previous step, they share ids and addresses with the next one."""
+    with cluster_cache.lock:
+        cluster_cache.clusters.clear()
+    with metric_windows.lock:
+        metric_windows.windows.clear()
+    with registry.lock:
+        registry.clusters.clear()
+    with scraper.lock:
+        scraper.hosts.clear()
+
+
+def cycle_results():
+    """The last result of every cluster, 'error' counts the clusters whose evaluation raised."""
+    with registry.lock:
+        return Counter(status.last_result for status in registry.clusters.values())
+
+
+def use_database(db_conn_str, use_async):
+    engine = create_engine(db_conn_str, echo=False,
+                           json_serializer=lambda x: orjson.dumps(x).decode('utf8'),
+                           json_deserializer=lambda x: orjson.loads(x))
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
+    Session.configure(bind=engine)
+    if use_async:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        async_engine = create_async_engine(db_conn_str.replace('sqlite://', 'sqlite+aiosqlite://')
+                                           .replace('mysql+pymysql://', 'mysql+aiomysql://'), echo=False,
+                                           json_serializer=lambda x: orjson.dumps(x).decode('utf8'),
+                                           json_deserializer=lambda x: orjson.loads(x))
+        database._async_session = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+def run_cycle(loop, concurrency, partition_workers):
+    """Run one cycle, on `loop` with the asyncio engine. The loop is kept for the whole step, the pooled
+    connections of the async engine belong to it."""
+    if loop:
+        from managed_scaling_enhanced.async_run import start_async
+        loop.run_until_complete(start_async(0, False, None, run_once=True, concurrency=concurrency))
+    else:
+        run.run(False, None, partition_workers=partition_workers)
+
+
+def clear_clusters(session):
+    """Delete the rows of the simulated clusters written by a previous step or run to the same database."""
+    for model in (ClusterTopology, Metric, AvgMetric, CpuUsage, Event, EMREvent):
+        session.execute(delete(model).where(model.cluster_id.like(f'{CLUSTER_ID_PREFIX}%')))
+    session.execute(delete(Cluster).where(Cluster.id.like(f'{CLUSTER_ID_PREFIX}%')))
+
+
+def run_step(clusters, nodes, cycles, warmup, interval, node_latency, node_failure_rate, db_conn_str,
+             use_async, concurrency, partition_workers, use_spool) -> StepResult:
+    use_database(db_conn_str, use_async)
+    reset_state()
+    environment = StubEnvironment(clusters=clusters, nodes=nodes, node_latency=node_latency,
+                                  node_failure_rate=node_failure_rate)
+    environment.start()
+    clock = SimulatedClock()
+    clock.install()
+    result = StepResult(clusters=clusters, nodes=nodes)
+    loop = asyncio.new_event_loop() if use_async else None
+    try:
+        emr_client = boto3.client('emr', endpoint_url=environment.emr_endpoint, region_name='us-east-1',
+                                  aws_access_key_id='load-test', aws_secret_access_key='load-test',
+                                  config=boto3_config)
+        client_pool.register(emr_client, 'emr')
+        os.environ['api_host'] = environment.emr_endpoint.split('//')[1]
+        with Session() as session:
+            clear_clusters(session)
+            session.add_all(environment.cluster_rows('load-test'))
+            session.commit()
+        if use_spool:
+            start_spool()
+
+        with counting_statements() as counter:
+            for cycle in range(warmup + cycles):
+                clock.advance(interval)
+                environment.advance(interval, clock.elapsed_seconds)
+                environment.reset_counts()
+                counter.reset()
+                started = time.monotonic()
+                run_cycle(loop, concurrency, partition_workers)
+                seconds = time.monotonic() - started
+                if cycle >= warmup:
+                    result.cycle_seconds.append(seconds)
+                    result.requests.update(environment.reset_counts())
+                    result.statements.update(counter.reset())
+                    result.results.update(cycle_results())
+    finally:
+        spool.stop()
+        if loop:
+            loop.close()
+        clock.uninstall()
+        environment.stop()
+    return result
+
+
+def load_test(cluster_counts=(10, 100, 1000), nodes=10, cycles=3, warmup=2, interval=60, node_latency=0.0,
+              node_failure_rate=0.0, db_conn_str=None, use_async=False, concurrency=20,
+              partition_workers=4, use_spool=True) -> LoadTestReport:
+    """Run cycles of `run.run()` (or the asyncio engine with `use_async`) against local stubs at increasing
+    cluster counts, each with fresh tables. The first `warmup` cycles of a step are not measured, they
+    collect the CPU baselines and the lookback metrics. Stops at the first step whose cycles overrun `interval`.
+    The database is a temporary sqlite file per step unless `db_conn_str` is given, the rows of the simulated
+    clusters are then deleted before every step. Every step spools to a new directory unless `use_spool` is False."""
+    raise_open_files_limit()
+    report = LoadTestReport(interval=interval)
+    root_logger = logging.getLogger()
+    log_level = root_logger.level
+    root_logger.setLevel(logging.WARNING)
+    try:
+        for clusters in cluster_counts:
+            step_conn_str = db_conn_str or f'sqlite:///{tempfile.mkdtemp(prefix="mse-load-test-")}/load-test.db'
+            step = run_step(clusters, nodes, cycles, warmup, interval, node_latency, node_failure_rate,
+                            step_conn_str, use_async, concurrency, partition_workers, use_spool)
+            report.steps.append(step)
+            if step.max_seconds > interval:
+                report.overrun = step
+                break
+    finally:
+        root_logger.setLevel(log_level)
+    return report
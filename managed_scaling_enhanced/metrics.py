@@ -1,22 +1,23 @@
 import asyncio
 
-import aiohttp
-import boto3
-
-from managed_scaling_enhanced import boto3_config
-from managed_scaling_enhanced.models import Cluster, Metric, AvgMetric, CpuUsage
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.database import Session
+from managed_scaling_enhanced.models import Cluster, Metric, AvgMetric, CpuUsage, CpuSource
+from managed_scaling_enhanced.status import registry
+from managed_scaling_enhanced.scraper import scraper, ScrapeStats
+from managed_scaling_enhanced.spool import spool
+from managed_scaling_enhanced.windows import metric_windows
 from dataclasses import dataclass
 import requests
 import os
 import logging
 from datetime import datetime, timedelta
-from sqlalchemy import inspect
+from sqlalchemy import inspect, select, func, and_
 import statistics
+import math
 
 logger = logging.getLogger(__name__)
 
-emr_client = boto3.client('emr', config=boto3_config)
-
 
 @dataclass
 class Instance:
@@ -27,7 +28,7 @@ class Instance:
 
 def get_instances_native(cluster: Cluster):
     instances = []
-    paginator = emr_client.get_paginator('list_instances')
+    paginator = client_pool.emr(cluster).get_paginator('list_instances')
     response_iterator = paginator.paginate(
         ClusterId=cluster.id,
         InstanceStates=['RUNNING'],
@@ -67,78 +68,206 @@ def get_instances(cluster: Cluster):
     return instances
 
 
-async def fetch_cpu_time(session, instance):
-    url = f'http://{instance.host_name}:9100/metrics'
-    try:
-        async with session.get(url) as response:
-            total_seconds = 0
-            idle_seconds = 0
-            resp_text = await response.text()
-            for line in resp_text.splitlines():
-                if line.startswith('node_cpu_seconds_total'):
-                    seconds = float(line.split(' ')[1])
-                    total_seconds += seconds
-                    if 'mode="idle"' in line:
-                        idle_seconds += seconds
-            cpu_usage = CpuUsage()
-            cpu_usage.cluster_id = instance.cluster_id
-            cpu_usage.instance_id = instance.instance_id
-            cpu_usage.total_seconds = total_seconds
-            cpu_usage.idle_seconds = idle_seconds
-            cpu_usage.event_time = datetime.utcnow()
-            return cpu_usage
-    except Exception as e:
-        logger.info(f'Error get cpu usage of instance {instance.host_name}. Error: {e}')
-        return None
+def parse_yarn_metrics(data):
+    return {k: v for k, v in data.get('clusterMetrics', {}).items() if not k.endswith('AcrossPartition')}
 
 
 def get_current_yarn_metrics(dns_name):
     response = requests.get(f"http://{dns_name}:8088/ws/v1/cluster/metrics", timeout=5)
     response.raise_for_status()
-    return {k: v for k, v in response.json().get('clusterMetrics', {}).items() if not k.endswith('AcrossPartition')}
+    return parse_yarn_metrics(response.json())
 
 
-def get_cpu_utilization(cluster: Cluster, db_session):
-    instances = get_instances(cluster)
+async def fetch_yarn_metrics(session, dns_name):
+    async with session.get(f"http://{dns_name}:8088/ws/v1/cluster/metrics") as response:
+        response.raise_for_status()
+        return parse_yarn_metrics(await response.json())
+
+
+def cpu_baselines_statement(cluster: Cluster):
+    """Select the oldest cpu usage of each instance within the lookback period."""
+    since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+    first_times = (select(CpuUsage.instance_id, func.min(CpuUsage.event_time).label('event_time'))
+                   .where(CpuUsage.cluster_id == cluster.id, CpuUsage.event_time > since)
+                   .group_by(CpuUsage.instance_id)
+                   .subquery())
+    return (select(CpuUsage)
+            .join(first_times, and_(CpuUsage.instance_id == first_times.c.instance_id,
+                                    CpuUsage.event_time == first_times.c.event_time))
+            .where(CpuUsage.cluster_id == cluster.id))
 
-    async def fetch_all():
-        timeout = aiohttp.ClientTimeout(total=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            tasks = [fetch_cpu_time(session, instance) for instance in instances]
-            results = await asyncio.gather(*tasks)
-            data_list = []
-            for result in results:
-                if result is not None:
-                    data_list.append(result)
-            return data_list
 
+def cpu_usages_statement(cluster: Cluster):
+    since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+    return (select(CpuUsage).where(CpuUsage.cluster_id == cluster.id, CpuUsage.event_time > since)
+            .order_by(CpuUsage.event_time))
+
+
+def compute_cpu_utilization(cpu_usages, baselines):
+    old_cpu_usages = {baseline.instance_id: baseline for baseline in baselines}
     old_total = 0
     old_busy = 0
     new_total = 0
     new_busy = 0
-    cpu_usages = asyncio.run(fetch_all())
     for cpu_usage in cpu_usages:
-        old_cpu_usage = (db_session.query(CpuUsage).filter(CpuUsage.cluster_id == cluster.id,
-                                                           CpuUsage.instance_id == cpu_usage.instance_id,
-                                                           CpuUsage.event_time > (datetime.utcnow() - timedelta(
-                                                               minutes=cluster.metrics_lookback_period_minutes)))
-                         .order_by(CpuUsage.event_time)
-                         .first())
+        old_cpu_usage = old_cpu_usages.get(cpu_usage.instance_id)
         if old_cpu_usage:
             old_total += old_cpu_usage.total_seconds
             old_busy += old_cpu_usage.busy_seconds
             new_total += cpu_usage.total_seconds
             new_busy += cpu_usage.busy_seconds
-    db_session.add_all(cpu_usages)
-    db_session.commit()
     if new_total != 0:
         return (new_busy - old_busy) / (new_total - old_total)
 
 
+def prometheus_cpu_query(cluster: Cluster):
+    """Busy share of all CPU seconds of the cluster's nodes over the lookback period, like the node_exporter source."""
+    selector = (cluster.prometheus_selector or 'cluster_id="{cluster_id}"').format(cluster_id=cluster.id)
+    window = f'{int(cluster.metrics_lookback_period_minutes * 60)}s'
+    return (f'1 - sum(rate(node_cpu_seconds_total{{mode="idle",{selector}}}[{window}]))'
+            f' / sum(rate(node_cpu_seconds_total{{{selector}}}[{window}]))')
+
+
+def prometheus_query_url(cluster: Cluster):
+    base_url = cluster.prometheus_url or os.getenv('PROMETHEUS_URL')
+    if not base_url:
+        raise ValueError(f'Cluster {cluster.id} reads CPU utilization from Prometheus but has no --prometheus-url '
+                         f'and $PROMETHEUS_URL is not set')
+    return f"{base_url.rstrip('/')}/api/v1/query"
+
+
+def parse_prometheus_cpu_utilization(data):
+    if data.get('status') != 'success':
+        raise ValueError(f"Prometheus query failed: {data.get('error')}")
+    result = data['data']['result']
+    if result:
+        value = float(result[0]['value'][1])
+        if not math.isnan(value):
+            return value
+
+
+def get_prometheus_cpu_utilization(cluster: Cluster, db_session=None):
+    response = requests.get(prometheus_query_url(cluster), params={'query': prometheus_cpu_query(cluster)}, timeout=5)
+    response.raise_for_status()
+    cpu_utilization = parse_prometheus_cpu_utilization(response.json())
+    registry.record_scrape(cluster.id, total=1, succeeded=int(cpu_utilization is not None))
+    return cpu_utilization
+
+
+async def fetch_prometheus_cpu_utilization(session, cluster: Cluster):
+    async with session.get(prometheus_query_url(cluster), params={'query': prometheus_cpu_query(cluster)}) as response:
+        response.raise_for_status()
+        cpu_utilization = parse_prometheus_cpu_utilization(await response.json())
+    registry.record_scrape(cluster.id, total=1, succeeded=int(cpu_utilization is not None))
+    return cpu_utilization
+
+
+def parse_yarn_node_cpu_utilization(data):
+    """Return the cluster CPU utilization and the utilization of every running node.
+    nodeCPUUsage is the number of vcores in use on a node, it is compared with the vcores the node offers to YARN."""
+    used_vcores = 0
+    total_vcores = 0
+    nodes = {}
+    for node in (data.get('nodes') or {}).get('node', []):
+        utilization = node.get('resourceUtilization') or {}
+        node_vcores = node.get('usedVirtualCores', 0) + node.get('availableVirtualCores', 0)
+        node_used_vcores = utilization.get('nodeCPUUsage')
+        if node.get('state') != 'RUNNING' or node_used_vcores is None or node_used_vcores < 0 or not node_vcores:
+            continue
+        used_vcores += node_used_vcores
+        total_vcores += node_vcores
+        nodes[node['id']] = min(node_used_vcores / node_vcores, 1.0)
+    if total_vcores:
+        return min(used_vcores / total_vcores, 1.0), nodes
+    return None, nodes
+
+
+@dataclass
+class YarnNode:
+    host: str
+    state: str
+    containers: int
+
+
+def parse_yarn_nodes(data):
+    """Host name, state and number of running containers (application masters included) of every node."""
+    nodes = []
+    for node in (data.get('nodes') or {}).get('node', []):
+        nodes.append(YarnNode(host=node.get('nodeHostName') or node['id'].rsplit(':', 1)[0],
+                              state=node.get('state'),
+                              containers=node.get('numContainers', 0)))
+    return nodes
+
+
+def get_yarn_nodes(cluster: Cluster):
+    response = requests.get(f"http://{cluster.master_dns_name}:8088/ws/v1/cluster/nodes", timeout=5)
+    response.raise_for_status()
+    return parse_yarn_nodes(response.json())
+
+
+def get_yarn_cpu_utilization(cluster: Cluster, db_session=None):
+    response = requests.get(f"http://{cluster.master_dns_name}:8088/ws/v1/cluster/nodes?states=RUNNING", timeout=5)
+    response.raise_for_status()
+    cpu_utilization, nodes = parse_yarn_node_cpu_utilization(response.json())
+    registry.record_scrape(cluster.id, total=len(nodes), succeeded=len(nodes), nodes=nodes)
+    return cpu_utilization
+
+
+async def fetch_yarn_cpu_utilization(session, cluster: Cluster):
+    async with session.get(f"http://{cluster.master_dns_name}:8088/ws/v1/cluster/nodes?states=RUNNING") as response:
+        response.raise_for_status()
+        cpu_utilization, nodes = parse_yarn_node_cpu_utilization(await response.json())
+    registry.record_scrape(cluster.id, total=len(nodes), succeeded=len(nodes), nodes=nodes)
+    return cpu_utilization
+
+
+def get_cpu_utilization(cluster: Cluster, db_session):
+    return cpu_sources[cluster.cpu_source or CpuSource.NODE_EXPORTER](cluster, db_session)
+
+
+def get_node_exporter_cpu_utilization(cluster: Cluster, db_session):
+    instances = get_instances(cluster)
+    cpu_usages, stats = asyncio.run(scraper.scrape_all(instances))
+    return save_cpu_usages(cluster, db_session, cpu_usages, stats)
+
+
+def record_cpu_scrape(cluster: Cluster, cpu_usages, stats: ScrapeStats):
+    """Log and record the scrape of the cluster. Return the CPU baselines of its window while the spool is running,
+    None when they have to be read from the database."""
+    if stats.failed or stats.skipped:
+        logger.info(f'Scraped {stats.succeeded}/{stats.total} instances of cluster {cluster.id}, '
+                    f'{stats.failed} failed, {stats.skipped} skipped by circuit breaker, {stats.hedged} hedged.')
+    registry.record_scrape(cluster.id, total=stats.total, succeeded=stats.succeeded)
+    if not spool.running:
+        return None
+    baselines = metric_windows.cpu_baselines(cluster)
+    metric_windows.add_cpu_usages(cluster, cpu_usages)
+    return baselines
+
+
+def save_cpu_usages(cluster: Cluster, db_session, cpu_usages, stats: ScrapeStats):
+    baselines = record_cpu_scrape(cluster, cpu_usages, stats)
+    if baselines is None:
+        baselines = db_session.scalars(cpu_baselines_statement(cluster)).all()
+    if not spool.add(db_session, *cpu_usages):
+        db_session.commit()
+    return compute_cpu_utilization(cpu_usages, baselines)
+
+
+cpu_sources = {
+    CpuSource.NODE_EXPORTER: get_node_exporter_cpu_utilization,
+    CpuSource.PROMETHEUS: get_prometheus_cpu_utilization,
+    CpuSource.YARN: get_yarn_cpu_utilization,
+}
+
+
 def collect_metrics(cluster: Cluster):
+    return build_metric(cluster, get_current_yarn_metrics(cluster.master_dns_name))
+
+
+def build_metric(cluster: Cluster, yarn_metrics):
     metric = Metric()
     metric.cluster_id = cluster.id
-    yarn_metrics = get_current_yarn_metrics(cluster.master_dns_name)
     metric.yarn_app_pending = yarn_metrics.get('appsPending')
     metric.yarn_app_running = yarn_metrics.get('appsRunning')
     metric.yarn_reserved_mem = yarn_metrics.get('reservedMB')
@@ -156,13 +285,38 @@ def collect_metrics(cluster: Cluster):
     return metric
 
 
+def lookback_metrics_statement(cluster):
+    return (select(Metric).where(Metric.cluster_id == cluster.id,
+                                 Metric.event_time > (datetime.utcnow() - timedelta(
+                                     minutes=cluster.metrics_lookback_period_minutes)))
+            .order_by(Metric.event_time))
+
+
 def get_lookback_metrics(cluster, session):
-    metrics = (session.query(Metric).filter(Metric.cluster_id == cluster.id,
-                                            Metric.event_time > (datetime.utcnow() - timedelta(
-                                                minutes=cluster.metrics_lookback_period_minutes)))
-               .order_by(Metric.event_time)
-               .all())
-    return metrics
+    if spool.running:
+        return metric_windows.lookback_metrics(cluster)
+    return session.scalars(lookback_metrics_statement(cluster)).all()
+
+
+def save_metric(cluster, metric, session):
+    """Spool the metric and add it to the window of the cluster, or commit it when the spool is not running."""
+    if spool.add(session, metric):
+        metric_windows.add_metric(cluster, metric)
+    else:
+        session.commit()
+
+
+def seed_window(cluster):
+    """Load the lookback period of the cluster into its window once, while the spool is running. On error the window
+    is seeded by the next evaluation and the cluster is evaluated on the samples of this process."""
+    if not spool.running or not metric_windows.needs_seed(cluster):
+        return
+    try:
+        with Session() as session:
+            metric_windows.seed(cluster, session.scalars(lookback_metrics_statement(cluster)).all(),
+                                session.scalars(cpu_usages_statement(cluster)).all())
+    except Exception as e:
+        logger.warning(f'Seed metric window of cluster {cluster.id} error: {e}')
 
 
 def collect_avg_metrics(cluster, lb_metrics):
@@ -175,3 +329,15 @@ def collect_avg_metrics(cluster, lb_metrics):
             data = [getattr(metric, field) for metric in lb_metrics]
             setattr(avg_metric, field, statistics.mean(data))
     return avg_metric
+
+
+def downsample_metrics(cluster, samples):
+    """Average high frequency samples into one metric to persist."""
+    metric = Metric()
+    metric.cluster_id = cluster.id
+    for field in inspect(Metric).columns.keys():
+        if field.startswith('yarn'):
+            data = [getattr(sample, field) for sample in samples if getattr(sample, field) is not None]
+            setattr(metric, field, round(statistics.mean(data)) if data else None)
+    metric.event_time = samples[-1].event_time
+    return metric
@@ -1,18 +1,39 @@
+import copy
+import hashlib
+import logging
+import zlib
 from datetime import datetime
 
 import enum
-from sqlalchemy import Column, String, JSON, DateTime, Integer, Float, Index, Boolean, Text, BigInteger, Enum
+import orjson
+from sqlalchemy import (Column, String, JSON, DateTime, Integer, Float, Index, Boolean, Text, BigInteger, Enum,
+                        ForeignKey, LargeBinary, select, desc, event, func, inspect, text)
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import set_committed_value
 import pprint
 from managed_scaling_enhanced.database import Base, engine
 import requests
 from managed_scaling_enhanced.utils import ec2_types
 
+logger = logging.getLogger(__name__)
+
 
 class ResizePolicy(enum.Enum):
     CPU_BASED = 'CPU_BASED'
     RESOURCE_BASED = 'RESOURCE_BASED'
 
 
+class CpuSource(enum.Enum):
+    NODE_EXPORTER = 'NODE_EXPORTER'
+    PROMETHEUS = 'PROMETHEUS'
+    YARN = 'YARN'
+
+
+def _snapshot_property(name):
+    """Derived value of a cluster, computed by ClusterSnapshot so the derivation lives in one place."""
+    return property(lambda cluster: getattr(cluster.snapshot(), name))
+
+
 class Cluster(Base):
     __tablename__ = 'clusters'
 
@@ -27,70 +48,91 @@ class Cluster(Base):
     last_scale_out_ts = Column(DateTime, default=datetime.min)
     initial_managed_scaling_policy = Column(JSON)
     current_managed_scaling_policy = Column(JSON)
-    instance_fleets = Column(JSON)
-    instance_groups = Column(JSON)
     master_dns_name = Column(String(100))
     max_capacity_limit = Column(Integer)
     scale_in_factor = Column(Float, default=1)
     scale_out_factor = Column(Float, default=1)
     active = Column(Boolean, default=True)
     resize_policy = Column(Enum(ResizePolicy), default=ResizePolicy.CPU_BASED)
-
-    def to_dict(self):
-        d = {
-            'Cluster ID': self.id,
-            'CPU usage lower bound': self.cpu_usage_lower_bound,
-            'CPU usage upper bound': self.cpu_usage_upper_bound,
-            'Spot capacity': self.current_task_spot_capacity,
-            'OD capacity': self.current_task_od_capacity,
-            'Initial max capacity': self.initial_max_units,
-            'Current Max capacity': self.current_max_units,
-            'Current Min capacity': self.current_min_units,
-            'Max capacity limit': self.max_capacity_limit,
-            'Scale in factor': self.scale_in_factor,
-            'Scale out factor': self.scale_out_factor,
-            'Resize policy': str(self.resize_policy)
-        }
-        return d
+    scale_in_dead_band = Column(Float, default=0)
+    scale_out_dead_band = Column(Float, default=0)
+    min_scale_step = Column(Integer, default=1)
+    required_consecutive_evaluations = Column(Integer, default=1)
+    pending_scale_direction = Column(String(20))
+    pending_scale_count = Column(Integer, default=0)
+    cpu_source = Column(Enum(CpuSource), default=CpuSource.NODE_EXPORTER)
+    prometheus_url = Column(String(255))
+    prometheus_selector = Column(Text)
+    min_scrape_coverage = Column(Float, default=0)
+    region = Column(String(20))
+    role_arn = Column(String(255))
+    aggressive_scale_out = Column(Boolean, default=False)
+    container_aware_scale_in = Column(Boolean, default=True)
+    log_level = Column(String(10))
+    # Alternative configurations evaluated on the same metrics without acting, see shadow.py
+    shadow_policies = Column(JSON)
+    # Incremented by every update, the scheduler caches clusters by version and updates fail on a stale version
+    version = Column(Integer, nullable=False)
+
+    topology = relationship('ClusterTopology', uselist=False, lazy='joined', cascade='all, delete-orphan')
+
+    __mapper_args__ = {'version_id_col': version}
 
     @property
-    def initial_min_units(self):
-        return self.initial_managed_scaling_policy['ComputeLimits']['MinimumCapacityUnits']
+    def instance_fleets(self):
+        return self.topology.instance_fleets if self.topology else None
 
-    @property
-    def initial_max_units(self):
-        return self.initial_managed_scaling_policy['ComputeLimits']['MaximumCapacityUnits']
+    @instance_fleets.setter
+    def instance_fleets(self, value):
+        self.update_topology(instance_fleets=value)
 
     @property
-    def initial_max_core_units(self):
-        return self.initial_managed_scaling_policy['ComputeLimits']['MaximumCoreCapacityUnits']
+    def instance_groups(self):
+        return self.topology.instance_groups if self.topology else None
 
-    @property
-    def current_min_units(self):
-        if self.current_managed_scaling_policy:
-            return self.current_managed_scaling_policy['ComputeLimits']['MinimumCapacityUnits']
+    @instance_groups.setter
+    def instance_groups(self, value):
+        self.update_topology(instance_groups=value)
 
-    @property
-    def current_max_units(self):
-        if self.current_managed_scaling_policy:
-            return self.current_managed_scaling_policy['ComputeLimits']['MaximumCapacityUnits']
+    def update_topology(self, **values):
+        if self.topology is None:
+            self.topology = ClusterTopology(cluster_id=self.id)
+        return self.topology.update(**values)
 
-    @property
-    def current_max_core_units(self):
-        if self.current_managed_scaling_policy:
-            return self.current_managed_scaling_policy['ComputeLimits']['MaximumCoreCapacityUnits']
+    def update_scaling_policy(self, policy):
+        """Keep the current policy when EMR returns the same content so the row is not written."""
+        if json_digest(policy) != json_digest(self.current_managed_scaling_policy):
+            self.current_managed_scaling_policy = policy
+
+    def to_dict(self):
+        return self.snapshot().to_dict()
+
+    def snapshot(self):
+        return ClusterSnapshot(self)
+
+    initial_max_units = _snapshot_property('initial_max_units')
+    managed_scaling_unit_type = _snapshot_property('managed_scaling_unit_type')
+    is_fleet = _snapshot_property('is_fleet')
+    current_min_units = _snapshot_property('current_min_units')
+    current_max_units = _snapshot_property('current_max_units')
+    current_max_core_units = _snapshot_property('current_max_core_units')
+    current_max_od_units = _snapshot_property('current_max_od_units')
+    task_instance_fleet = _snapshot_property('task_instance_fleet')
+    task_instance_groups = _snapshot_property('task_instance_groups')
+    task_target_od_capacity = _snapshot_property('task_target_od_capacity')
+    task_target_spot_capacity = _snapshot_property('task_target_spot_capacity')
+    current_task_spot_capacity = _snapshot_property('current_task_spot_capacity')
+    current_task_od_capacity = _snapshot_property('current_task_od_capacity')
+    current_task_total_capacity = _snapshot_property('current_task_total_capacity')
+    is_resizing = _snapshot_property('is_resizing')
 
     @property
-    def current_max_od_units(self):
-        if self.current_managed_scaling_policy:
-            return self.current_managed_scaling_policy['ComputeLimits']['MaximumOnDemandCapacityUnits']
+    def initial_min_units(self):
+        return self.initial_managed_scaling_policy['ComputeLimits']['MinimumCapacityUnits']
 
     @property
-    def task_instance_fleet(self):
-        if self.instance_fleets:
-            for fleet in self.instance_fleets:
-                if fleet['InstanceFleetType'] == 'TASK':
-                    return fleet
+    def initial_max_core_units(self):
+        return self.initial_managed_scaling_policy['ComputeLimits']['MaximumCoreCapacityUnits']
 
     @property
     def core_instance_fleet(self):
@@ -99,34 +141,17 @@ class Cluster(Base):
                 if fleet['InstanceFleetType'] == 'CORE':
                     return fleet
 
-    @property
-    def is_resizing(self):
-        flag = False
-        if self.is_fleet:
-            for fleet in self.instance_fleets:
-                if fleet['Status']['State'] != 'RUNNING':
-                    flag = True
-        else:
-            for group in self.instance_groups:
-                if group['Status']['State'] != 'RUNNING':
-                    flag = True
-        return flag
-
-    @property
-    def task_target_od_capacity(self):
-        if self.task_instance_fleet:
-            return self.task_instance_fleet['TargetOnDemandCapacity']
-
-    @property
-    def task_target_spot_capacity(self):
-        if self.task_instance_fleet:
-            return self.task_instance_fleet['TargetSpotCapacity']
-
     def modify_scaling_policy(self, max_units=None, max_od_units=None):
+        self.current_managed_scaling_policy = self.new_scaling_policy(max_units=max_units, max_od_units=max_od_units)
+
+    def new_scaling_policy(self, max_units=None, max_od_units=None):
+        # Build a new policy instead of mutating in place, in place changes of a JSON column are not tracked
+        policy = copy.deepcopy(self.current_managed_scaling_policy)
         if max_units:
-            self.current_managed_scaling_policy['ComputeLimits']['MaximumCapacityUnits'] = max_units
+            policy['ComputeLimits']['MaximumCapacityUnits'] = max_units
         if max_od_units:
-            self.current_managed_scaling_policy['ComputeLimits']['MaximumOnDemandCapacityUnits'] = max_od_units
+            policy['ComputeLimits']['MaximumOnDemandCapacityUnits'] = max_od_units
+        return policy
 
     def get_info_str(self):
         d = {}
@@ -148,56 +173,159 @@ class Cluster(Base):
                 app_ids.append(app['id'])
         return app_ids
 
-    @property
-    def managed_scaling_unit_type(self):
-        return self.current_managed_scaling_policy['ComputeLimits']['UnitType']
 
-    @property
-    def is_fleet(self):
-        return self.current_managed_scaling_policy['ComputeLimits']['UnitType'] == 'InstanceFleetUnits'
+class ClusterGroup(Base):
+    """Capacity budget in managed scaling units shared by the clusters of a group."""
+    __tablename__ = 'cluster_groups'
 
-    @property
-    def current_task_spot_capacity(self):
-        if self.managed_scaling_unit_type == 'InstanceFleetUnits':
-            return self.task_target_spot_capacity
-        elif self.managed_scaling_unit_type == 'Instances':
-            instances = 0
-            for group in self.task_instance_groups:
-                if group['Market'] == 'SPOT':
-                    instances += group['RunningInstanceCount']
-            return instances
-        else:
-            count = 0
-            for group in self.task_instance_groups:
-                if group['Market'] == 'SPOT':
-                    count += group['RunningInstanceCount'] * ec2_types[group['InstanceType']]
-            return count
+    name = Column(String(20), primary_key=True)
+    capacity_budget = Column(Integer)
 
-    @property
-    def task_instance_groups(self):
-        if self.instance_groups:
-            return [group for group in self.instance_groups if group['InstanceGroupType'] == 'TASK']
 
-    @property
-    def current_task_od_capacity(self):
-        if self.managed_scaling_unit_type == 'InstanceFleetUnits':
-            return self.task_target_od_capacity
-        elif self.managed_scaling_unit_type == 'Instances':
-            instances = 0
-            for group in self.task_instance_groups:
-                if group['Market'] == 'ON_DEMAND':
-                    instances += group['RunningInstanceCount']
-            return instances
+def json_digest(value):
+    """Content hash of a JSON value. Datetimes hash like the ISO strings they are stored as."""
+    return hashlib.md5(orjson.dumps(value, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class ClusterTopology(Base):
+    """Instance fleets or groups of a cluster as last described by EMR. They change with every resize, so they
+    are kept out of the clusters row and only written when their content hash changes."""
+    __tablename__ = 'cluster_topology'
+
+    cluster_id = Column(String(20), ForeignKey('clusters.id'), primary_key=True)
+    instance_fleets = Column(JSON)
+    instance_groups = Column(JSON)
+    content_hash = Column(String(32))
+    updated_at = Column(DateTime)
+
+    def update(self, **values):
+        """Replace the fleets and/or groups, return False and keep the current objects when nothing changed."""
+        content = {'instance_fleets': self.instance_fleets, 'instance_groups': self.instance_groups, **values}
+        digest = json_digest([content['instance_fleets'], content['instance_groups']])
+        if digest == self.content_hash:
+            return False
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.content_hash = digest
+        self.updated_at = datetime.utcnow()
+        return True
+
+
+def _instance_group_capacity(unit_type, instance_groups, market):
+    count = 0
+    for group in instance_groups:
+        if group['Market'] == market:
+            if unit_type == 'Instances':
+                count += group['RunningInstanceCount']
+            else:
+                count += group['RunningInstanceCount'] * ec2_types[group['InstanceType']]
+    return count
+
+
+class ClusterSnapshot:
+    """Read-only view of a cluster taken once per evaluation.
+    The derived capacities are computed once here instead of walking the fleet/group JSON on every access."""
+
+    CONFIG_COLUMNS = ('id', 'cluster_name', 'cluster_group', 'cpu_usage_upper_bound', 'cpu_usage_lower_bound',
+                      'metrics_lookback_period_minutes', 'cool_down_period_minutes', 'last_scale_in_ts',
+                      'last_scale_out_ts', 'max_capacity_limit', 'scale_in_factor', 'scale_out_factor',
+                      'resize_policy', 'scale_in_dead_band', 'scale_out_dead_band', 'min_scale_step',
+                      'required_consecutive_evaluations', 'pending_scale_direction', 'pending_scale_count',
+                      'min_scrape_coverage', 'aggressive_scale_out', 'container_aware_scale_in', 'log_level',
+                      'shadow_policies')
+
+    __slots__ = CONFIG_COLUMNS + (
+        'initial_max_units', 'managed_scaling_unit_type', 'is_fleet', 'current_min_units', 'current_max_units',
+        'current_max_core_units', 'current_max_od_units', 'task_instance_fleet', 'task_instance_groups',
+        'task_target_od_capacity', 'task_target_spot_capacity', 'current_task_spot_capacity',
+        'current_task_od_capacity', 'current_task_total_capacity', 'current_core_capacity',
+        'current_core_od_capacity', 'is_resizing', 'last_action_time')
+
+    def __init__(self, cluster: Cluster):
+        values = {column: getattr(cluster, column) for column in self.CONFIG_COLUMNS}
+        initial_limits = (cluster.initial_managed_scaling_policy or {}).get('ComputeLimits', {})
+        limits = (cluster.current_managed_scaling_policy or {}).get('ComputeLimits', {})
+        unit_type = limits.get('UnitType')
+        fleets = cluster.instance_fleets or []
+        groups = cluster.instance_groups or []
+        task_instance_fleet = next((fleet for fleet in fleets if fleet['InstanceFleetType'] == 'TASK'), None)
+        task_instance_groups = tuple(group for group in groups if group['InstanceGroupType'] == 'TASK')
+        core_instance_fleet = next((fleet for fleet in fleets if fleet['InstanceFleetType'] == 'CORE'), None)
+        core_instance_groups = tuple(group for group in groups if group['InstanceGroupType'] == 'CORE')
+        is_fleet = unit_type == 'InstanceFleetUnits'
+        if is_fleet:
+            current_core_od_capacity = core_instance_fleet['TargetOnDemandCapacity'] if core_instance_fleet else 0
+            current_core_capacity = current_core_od_capacity + (
+                core_instance_fleet['TargetSpotCapacity'] if core_instance_fleet else 0)
+            task_target_od_capacity = task_instance_fleet['TargetOnDemandCapacity'] if task_instance_fleet else None
+            task_target_spot_capacity = task_instance_fleet['TargetSpotCapacity'] if task_instance_fleet else None
+            current_task_od_capacity = task_target_od_capacity
+            current_task_spot_capacity = task_target_spot_capacity
         else:
-            count = 0
-            for group in self.task_instance_groups:
-                if group['Market'] == 'ON_DEMAND':
-                    count += group['RunningInstanceCount'] * ec2_types[group['InstanceType']]
-            return count
+            task_target_od_capacity = None
+            task_target_spot_capacity = None
+            current_task_od_capacity = _instance_group_capacity(unit_type, task_instance_groups, 'ON_DEMAND')
+            current_task_spot_capacity = _instance_group_capacity(unit_type, task_instance_groups, 'SPOT')
+            current_core_od_capacity = _instance_group_capacity(unit_type, core_instance_groups, 'ON_DEMAND')
+            current_core_capacity = current_core_od_capacity + _instance_group_capacity(
+                unit_type, core_instance_groups, 'SPOT')
+        values.update(
+            initial_max_units=initial_limits.get('MaximumCapacityUnits'),
+            managed_scaling_unit_type=unit_type,
+            is_fleet=is_fleet,
+            current_min_units=limits.get('MinimumCapacityUnits'),
+            current_max_units=limits.get('MaximumCapacityUnits'),
+            current_max_core_units=limits.get('MaximumCoreCapacityUnits'),
+            current_max_od_units=limits.get('MaximumOnDemandCapacityUnits'),
+            task_instance_fleet=task_instance_fleet,
+            task_instance_groups=task_instance_groups,
+            task_target_od_capacity=task_target_od_capacity,
+            task_target_spot_capacity=task_target_spot_capacity,
+            current_task_spot_capacity=current_task_spot_capacity,
+            current_task_od_capacity=current_task_od_capacity,
+            current_task_total_capacity=(current_task_spot_capacity or 0) + (current_task_od_capacity or 0),
+            current_core_capacity=current_core_capacity,
+            current_core_od_capacity=current_core_od_capacity,
+            is_resizing=any(item['Status']['State'] != 'RUNNING' for item in (fleets if is_fleet else groups)),
+            last_action_time=max(cluster.last_scale_in_ts or datetime.min, cluster.last_scale_out_ts or datetime.min),
+        )
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def replace(self, **values):
+        """Copy of the snapshot with some values replaced, used to evaluate shadow policies."""
+        snapshot = object.__new__(type(self))
+        for key in self.__slots__:
+            object.__setattr__(snapshot, key, values[key] if key in values else getattr(self, key))
+        return snapshot
 
-    @property
-    def current_task_total_capacity(self):
-        return self.current_task_spot_capacity + self.current_task_od_capacity
+    def to_dict(self):
+        d = {
+            'Cluster ID': self.id,
+            'CPU usage lower bound': self.cpu_usage_lower_bound,
+            'CPU usage upper bound': self.cpu_usage_upper_bound,
+            'Spot capacity': self.current_task_spot_capacity,
+            'OD capacity': self.current_task_od_capacity,
+            'Initial max capacity': self.initial_max_units,
+            'Current Max capacity': self.current_max_units,
+            'Current Min capacity': self.current_min_units,
+            'Max capacity limit': self.max_capacity_limit,
+            'Scale in factor': self.scale_in_factor,
+            'Scale out factor': self.scale_out_factor,
+            'Resize policy': str(self.resize_policy),
+            'Scale in dead band': self.scale_in_dead_band,
+            'Scale out dead band': self.scale_out_dead_band,
+            'Min scale step': self.min_scale_step,
+            'Required consecutive evaluations': self.required_consecutive_evaluations,
+            'Pending scale direction': self.pending_scale_direction,
+            'Pending scale count': self.pending_scale_count,
+            'Aggressive scale out': self.aggressive_scale_out,
+            'Container aware scale in': self.container_aware_scale_in
+        }
+        return d
 
 
 class Event(Base):
@@ -237,16 +365,44 @@ class CpuUsage(Base):
 
 
 class EMREvent(Base):
+    """EMR event received from the event queue. Lookups use the normalized columns, the raw message is only kept
+    zlib compressed. `event_id` is the EventBridge event id, an event delivered twice is stored once."""
     __tablename__ = 'emr_events'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    event_type = Column(String(20))
+    event_id = Column(String(64), unique=True)
+    event_type = Column(String(64))
     cluster_id = Column(String(20))
     source = Column(String(20))
-    state = Column(String(20))
+    state = Column(String(32))
     message = Column(Text)
-    raw_message = Column(JSON)
+    raw_payload = Column(LargeBinary)
     event_time = Column(DateTime, index=True)
-    create_time = Column(DateTime, index=True)
+    create_time = Column(DateTime)
+
+    __table_args__ = (
+        Index('idx_emr_event_cluster_id_time', 'cluster_id', 'event_time'),
+        Index('idx_emr_event_type_state', 'event_type', 'state'),
+    )
+
+    @property
+    def raw_message(self):
+        return orjson.loads(zlib.decompress(self.raw_payload)) if self.raw_payload else None
+
+    @raw_message.setter
+    def raw_message(self, value):
+        self.raw_payload = zlib.compress(orjson.dumps(value))
+
+    @staticmethod
+    def recent_statement(cluster_id, since=None, limit=50):
+        """Latest events of a cluster, served by the (cluster_id, event_time) index."""
+        statement = select(EMREvent).where(EMREvent.cluster_id == cluster_id)
+        if since:
+            statement = statement.where(EMREvent.event_time >= since)
+        return statement.order_by(desc(EMREvent.event_time)).limit(limit)
+
+    def to_dict(self):
+        return {'event_id': self.event_id, 'event_type': self.event_type, 'cluster_id': self.cluster_id,
+                'state': self.state, 'message': self.message, 'event_time': self.event_time}
 
 
 class Metric(Base):
@@ -303,6 +459,7 @@ class AvgMetric(Base):
     yarn_active_nodes = Column(Integer)
 
     cpu_utilization = Column(Float)
+    scrape_coverage = Column(Float)
 
     event_time = Column(DateTime, index=True)
 
@@ -311,4 +468,67 @@ class AvgMetric(Base):
     )
 
 
+def column_default(column):
+    if column.default is not None and column.default.is_scalar:
+        return column.default.arg
+
+
+@event.listens_for(Cluster, 'load')
+@event.listens_for(Cluster, 'refresh')
+def fill_column_defaults(cluster, context, attrs=None):
+    """Read NULL columns of a cluster as their default, rows added before the column existed have NULLs."""
+    for column in Cluster.__table__.columns:
+        default = column_default(column)
+        if default is not None and column.key in cluster.__dict__ and cluster.__dict__[column.key] is None:
+            set_committed_value(cluster, column.key, default)
+
+
+def upgrade_schema(bind):
+    """Bring tables created by an older version up to the models, `create_all` only creates missing tables.
+    Missing columns are added and filled with their default (`version` with 1), missing indexes and unique
+    constraints are created and on MySQL string columns shorter than their model are widened. Called by `mse start`."""
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name']: column for column in inspector.get_columns(table.name)}
+        indexes = inspector.get_indexes(table.name)
+        index_names = {index['name'] for index in indexes}
+        unique_columns = {tuple(index['column_names']) for index in indexes if index['unique']}
+        unique_columns.update(tuple(constraint['column_names'])
+                              for constraint in inspector.get_unique_constraints(table.name))
+        with bind.begin() as connection:
+            for column in table.columns:
+                column_type = column.type.compile(dialect=bind.dialect)
+                if column.name not in existing:
+                    logger.warning(f'Adding column {column.name} {column_type} to table {table.name}.')
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    default = 1 if column is Cluster.__table__.c.version else column_default(column)
+                    if default is not None:
+                        connection.execute(table.update().values({column.name: default}))
+                elif (bind.dialect.name == 'mysql' and isinstance(column.type, String) and column.type.length
+                      and (getattr(existing[column.name]['type'], 'length', None) or 0) < column.type.length):
+                    logger.warning(f'Widening column {column.name} of table {table.name} to {column_type}.')
+                    connection.execute(text(f'ALTER TABLE {table.name} MODIFY COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                if index.name not in index_names:
+                    logger.warning(f'Creating index {index.name} on table {table.name}.')
+                    index.create(connection)
+            for column in table.columns:
+                if column.unique and (column.name,) not in unique_columns:
+                    create_unique_index(connection, table, column)
+
+
+def create_unique_index(connection, table, column):
+    """Delete the rows duplicating the column, the oldest is kept, and create a unique index on it."""
+    primary_key = table.primary_key.columns.values()[0]
+    keep = select(func.min(primary_key).label('id')).where(column.isnot(None)).group_by(column).subquery()
+    deleted = connection.execute(table.delete().where(column.isnot(None),
+                                                      primary_key.notin_(select(keep.c.id)))).rowcount
+    if deleted:
+        logger.warning(f'Deleted {deleted} rows of table {table.name} duplicating column {column.name}.')
+    logger.warning(f'Creating unique index uq_{table.name}_{column.name} on table {table.name}.')
+    Index(f'uq_{table.name}_{column.name}', column, unique=True).create(connection)
+
+
 Base.metadata.create_all(engine)
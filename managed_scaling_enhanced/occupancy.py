@@ -0,0 +1,86 @@
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.metrics import get_yarn_nodes
+from managed_scaling_enhanced.models import Cluster, ClusterSnapshot
+from managed_scaling_enhanced.utils import ec2_types
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TaskNode:
+    instance_id: str
+    instance_set_id: str
+    market: str
+    units: float
+    # None when the ResourceManager does not report the node, it is then not considered idle
+    containers: Optional[int]
+
+    @property
+    def idle(self):
+        return self.containers == 0
+
+
+@dataclass
+class Occupancy:
+    """Running core and task capacity of a cluster in managed scaling units and the containers of its task nodes."""
+    running_units: float = 0
+    task_nodes: List[TaskNode] = field(default_factory=list)
+
+    def idle_nodes(self, instance_set_id=None, market=None):
+        return [node for node in self.task_nodes
+                if node.idle and instance_set_id in (None, node.instance_set_id) and market in (None, node.market)]
+
+    def idle_units(self, instance_set_id=None, market=None):
+        return sum(node.units for node in self.idle_nodes(instance_set_id, market))
+
+    def headroom_units(self, current_max_units):
+        """Units the max can be lowered by without terminating any node."""
+        return max(current_max_units - self.running_units, 0)
+
+    def removable_units(self, current_max_units):
+        return self.headroom_units(current_max_units) + self.idle_units()
+
+
+def instance_units(snapshot: ClusterSnapshot, instance, fleet_weights):
+    if snapshot.managed_scaling_unit_type == 'Instances':
+        return 1
+    if snapshot.is_fleet:
+        return fleet_weights.get((instance.get('InstanceFleetId'), instance.get('InstanceType')), 1)
+    return ec2_types[instance['InstanceType']]
+
+
+def get_occupancy(cluster: Cluster, snapshot: ClusterSnapshot) -> Optional[Occupancy]:
+    """Read the running instances from EMR and their containers from the ResourceManager, None when either fails."""
+    instance_sets = (cluster.instance_fleets if snapshot.is_fleet else cluster.instance_groups) or []
+    set_types = {item['Id']: item.get('InstanceFleetType') or item.get('InstanceGroupType') for item in instance_sets}
+    fleet_weights = {(fleet['Id'], spec['InstanceType']): spec.get('WeightedCapacity', 1)
+                     for fleet in (instance_sets if snapshot.is_fleet else ())
+                     for spec in fleet.get('InstanceTypeSpecifications', ())}
+    try:
+        yarn_nodes = get_yarn_nodes(cluster)
+        paginator = client_pool.emr(cluster).get_paginator('list_instances')
+        instances = [instance for page in paginator.paginate(ClusterId=cluster.id, InstanceStates=['RUNNING'])
+                     for instance in page['Instances']]
+    except Exception as e:
+        logger.warning(f'Could not read the YARN nodes of cluster {cluster.id}, scaling in without them. Error: {e}')
+        return None
+    containers = {node.host: node.containers for node in yarn_nodes}
+    occupancy = Occupancy()
+    for instance in instances:
+        instance_set_id = instance.get('InstanceFleetId') or instance.get('InstanceGroupId')
+        set_type = set_types.get(instance_set_id)
+        if set_type not in ('CORE', 'TASK'):
+            continue
+        units = instance_units(snapshot, instance, fleet_weights)
+        occupancy.running_units += units
+        if set_type == 'TASK':
+            occupancy.task_nodes.append(TaskNode(
+                instance_id=instance['Ec2InstanceId'], instance_set_id=instance_set_id,
+                market=instance.get('Market'), units=units,
+                containers=containers.get(instance.get('PrivateDnsName'),
+                                          containers.get(instance.get('PrivateIpAddress')))))
+    return occupancy
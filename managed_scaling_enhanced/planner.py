@@ -0,0 +1,112 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Optional
+
+from managed_scaling_enhanced.status import registry
+
+logger = logging.getLogger(__name__)
+
+PENDING_WEIGHT = 10
+COOL_DOWN_WEIGHT = 5
+
+
+@dataclass
+class CycleReport:
+    started: datetime
+    budget: Optional[float]
+    duration: float = 0
+    evaluated: int = 0
+    deferred: list = field(default_factory=list)
+    missed: bool = False
+    deadline: Optional[float] = field(default=None, repr=False)
+
+
+class CyclePlanner:
+    """Evaluate the clusters of a cycle in order of urgency within a time budget.
+    Urgency is the minutes since the last evaluation, raised when YARN had pending resources and lowered while the
+    cluster is cooling down. When the estimated evaluation time of a cluster no longer fits in the budget it is
+    deferred to the next cycle, unless it has pending resources, was never evaluated or was deferred
+    `max_deferrals` times in a row."""
+
+    def __init__(self, max_deferrals=3, history=100):
+        self.max_deferrals = max_deferrals
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.deferrals = {}
+        self.reports = deque(maxlen=history)
+
+    def urgency(self, cluster_id):
+        status = registry.get(cluster_id)
+        if status is None or status['last_evaluation_time'] is None:
+            return math.inf
+        score = (datetime.utcnow() - status['last_evaluation_time']).total_seconds() / 60
+        if self.has_pending(status):
+            score += PENDING_WEIGHT
+        if status['cool_down_remaining_seconds'] > 0:
+            score -= COOL_DOWN_WEIGHT
+        return score
+
+    @staticmethod
+    def has_pending(status):
+        metrics = status['last_metrics'] or {}
+        return (metrics.get('yarn_pending_vcore') or 0) > 0 or (metrics.get('yarn_pending_mem') or 0) > 0
+
+    def must_run(self, cluster_id):
+        status = registry.get(cluster_id)
+        return (status is None or status['last_evaluation_time'] is None or self.has_pending(status)
+                or self.deferrals.get(cluster_id, 0) >= self.max_deferrals)
+
+    def plan(self, cluster_ids):
+        urgencies = {cluster_id: self.urgency(cluster_id) for cluster_id in cluster_ids}
+        return sorted(cluster_ids, key=lambda cluster_id: urgencies[cluster_id], reverse=True)
+
+    def start_cycle(self, budget=None):
+        report = CycleReport(started=datetime.utcnow(), budget=budget)
+        if budget:
+            report.deadline = time.monotonic() + budget
+        return report
+
+    def should_run(self, report: CycleReport, cluster_id):
+        if report.deadline is None:
+            return True
+        with self.lock:
+            estimate = self.durations.get(cluster_id, 0)
+            if time.monotonic() + estimate <= report.deadline or self.must_run(cluster_id):
+                return True
+            self.deferrals[cluster_id] = self.deferrals.get(cluster_id, 0) + 1
+            report.deferred.append(cluster_id)
+        logger.info(f'Deferring cluster {cluster_id} to the next cycle, its estimated {estimate:.1f} seconds '
+                    f'do not fit in the cycle budget.')
+        return False
+
+    def record(self, report: CycleReport, cluster_id, seconds):
+        with self.lock:
+            previous = self.durations.get(cluster_id)
+            self.durations[cluster_id] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+            self.deferrals.pop(cluster_id, None)
+            report.evaluated += 1
+
+    def end_cycle(self, report: CycleReport):
+        report.duration = (datetime.utcnow() - report.started).total_seconds()
+        report.missed = bool(report.budget) and report.duration > report.budget
+        if report.missed:
+            logger.warning(f'Cycle missed its deadline: {report.duration:.1f} of {report.budget:.1f} seconds, '
+                           f'{report.evaluated} clusters evaluated, {len(report.deferred)} deferred.')
+        elif report.deferred:
+            logger.info(f'Cycle finished in {report.duration:.1f} seconds, {report.evaluated} clusters evaluated, '
+                        f'{len(report.deferred)} deferred: {report.deferred}')
+        with self.lock:
+            self.reports.append(report)
+
+    def list(self, limit=20):
+        with self.lock:
+            reports = list(self.reports)[-limit:]
+        return [{k: v for k, v in asdict(report).items() if k != 'deadline'} for report in reports]
+
+
+planner = CyclePlanner()
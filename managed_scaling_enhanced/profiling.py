@@ -0,0 +1,159 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class NoopTimer:
+    def lap(self, phase):
+        pass
+
+
+class PhaseTimer:
+    """Record the wall time and traced memory growth between consecutive laps of one cluster evaluation."""
+
+    def __init__(self, profiler, cluster_id):
+        self.profiler = profiler
+        self.cluster_id = cluster_id
+        self.last_time = time.perf_counter()
+        self.last_memory = self.traced_memory()
+
+    def traced_memory(self):
+        return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        memory = self.traced_memory()
+        self.profiler.record_phase({'cluster_id': self.cluster_id, 'phase': phase,
+                                    'seconds': round(now - self.last_time, 6),
+                                    'memory_delta': memory - self.last_memory if memory is not None else None})
+        self.last_time = time.perf_counter()
+        self.last_memory = self.traced_memory()
+
+
+class Profiler:
+    """Profile every Nth scheduler cycle in place.
+    cpu: a cProfile per cluster evaluation (per cycle for the async engine) written as .prof files.
+    memory: tracemalloc snapshots with the top allocation growth between profiled cycles.
+    Phase timings of do_run are written for every profiled cycle. Files of the last `keep` cycles are kept."""
+
+    def __init__(self):
+        self.cpu = False
+        self.memory = False
+        self.every = 1
+        self.keep = 20
+        self.top = 25
+        self.directory = Path('log/profiles')
+        self.cycle = 0
+        self.active = False
+        self.phases = []
+        self.lock = threading.Lock()
+        self.cpu_lock = threading.Lock()
+        self.last_snapshot = None
+
+    @property
+    def enabled(self):
+        return self.cpu or self.memory
+
+    def configure(self, modes=(), every=1, directory=None, keep=20):
+        self.cpu = 'cpu' in modes
+        self.memory = 'memory' in modes
+        self.every = max(every, 1)
+        self.keep = keep
+        if directory:
+            self.directory = Path(directory)
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+    def path(self, name):
+        return self.directory / f'cycle-{self.cycle:06d}-{name}'
+
+    def start_cycle(self):
+        with self.lock:
+            self.cycle += 1
+            self.active = self.enabled and self.cycle % self.every == 0
+            self.phases = []
+
+    def end_cycle(self):
+        if not self.active:
+            return
+        with self.lock:
+            phases = self.phases
+            self.phases = []
+            self.active = False
+        self.path('phases.json').write_bytes(orjson.dumps(phases, option=orjson.OPT_INDENT_2))
+        if self.memory:
+            self.write_memory_diff()
+        self.rotate()
+
+    def record_phase(self, record):
+        with self.lock:
+            if self.active:
+                self.phases.append(record)
+
+    def timer(self, cluster_id):
+        if self.active:
+            return PhaseTimer(self, cluster_id)
+        return NoopTimer()
+
+    @contextmanager
+    def profile(self, name):
+        # Only one cProfile can be enabled at a time, evaluations running meanwhile are not profiled
+        if not (self.active and self.cpu and self.cpu_lock.acquire(blocking=False)):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+            profile.dump_stats(self.path(f'{name}.prof'))
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(self.top)
+            self.path(f'{name}.txt').write_text(stream.getvalue())
+        finally:
+            self.cpu_lock.release()
+
+    def write_memory_diff(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'Traced memory: current {current} bytes, peak {peak} bytes']
+        if self.last_snapshot is not None:
+            stats = snapshot.compare_to(self.last_snapshot, 'lineno')[:self.top]
+            lines.append(f'Top {self.top} allocation differences since the last profiled cycle:')
+            lines.extend(str(stat) for stat in stats)
+            for stat in stats[:5]:
+                logger.info(f'Memory growth: {stat}')
+        else:
+            lines.append(f'Top {self.top} allocations:')
+            lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:self.top])
+        self.last_snapshot = snapshot
+        self.path('memory.txt').write_text('\n'.join(lines))
+
+    def rotate(self):
+        oldest = self.cycle - self.keep * self.every
+        for path in self.directory.glob('cycle-*'):
+            try:
+                if int(path.name.split('-')[1]) <= oldest:
+                    path.unlink()
+            except (ValueError, IndexError, FileNotFoundError):
+                continue
+
+
+profiler = Profiler()
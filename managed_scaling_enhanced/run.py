@@ -1,19 +1,44 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import boto3
 from orjson import orjson
 from dateutil import parser
+from sqlalchemy import select
 
+from managed_scaling_enhanced import boto3_config
+from managed_scaling_enhanced.aws import client_pool, account_of
 from managed_scaling_enhanced.database import Session
-from managed_scaling_enhanced.models import EMREvent, Event
+from managed_scaling_enhanced.models import EMREvent, Event, ClusterGroup
 import logging
-from managed_scaling_enhanced.scale import resize_cluster
+from managed_scaling_enhanced.scale import resize_cluster, apply_scale
+from managed_scaling_enhanced.groups import group_allocator
+from managed_scaling_enhanced.status import registry
+from managed_scaling_enhanced.profiling import profiler
+from managed_scaling_enhanced.checkpoint import checkpointer
+from managed_scaling_enhanced.sampler import sampler
+from managed_scaling_enhanced.planner import planner, CycleReport
+from managed_scaling_enhanced.cluster_cache import cluster_cache, check_version, StaleCluster
+from managed_scaling_enhanced.spool import spool
+from managed_scaling_enhanced.windows import metric_windows
 from managed_scaling_enhanced.metrics import *
 
 logger = logging.getLogger(__name__)
-emr_client = boto3.client('emr', config=boto3_config)
 ec2_client = boto3.client('ec2', config=boto3_config)
 sqs = boto3.client('sqs')
 
+REEVALUATION_EVENT_TYPES = (
+    'EMR Cluster State Change',
+    'EMR Instance Fleet State Change',
+    'EMR Instance Fleet Resize',
+    'EMR Instance Group State Change',
+)
+evaluating = set()
+# Clusters to evaluate again once their evaluation finishes, after an EMR event or a concurrent change of their row
+rerun_requested = set()
+evaluating_lock = threading.Lock()
+
 
 def get_latest_ready_time(instances):
     latest_ready_time = datetime.min
@@ -24,37 +49,86 @@ def get_latest_ready_time(instances):
     return latest_ready_time
 
 
-def do_run(cluster: Cluster, dry_run, session):
-    response = emr_client.describe_cluster(ClusterId=cluster.id)
+def update_description(cluster: Cluster, response):
+    """Copy the name and master of a described cluster. Return False after recording the skip if it is not running."""
     if response['Cluster']['Status']['State'] not in ('RUNNING', 'WAITING'):
         logger.info(f'Skipping cluster {cluster.id} because it is not running.')
-        return
+        registry.record_result(cluster.id, 'not running')
+        return False
     cluster.cluster_name = response['Cluster']['Name']
-    master_public_dns = response['Cluster']['MasterPublicDnsName']
-    cluster.master_dns_name = master_public_dns
-    cluster.current_managed_scaling_policy = emr_client.get_managed_scaling_policy(ClusterId=cluster.id)['ManagedScalingPolicy']
+    cluster.master_dns_name = response['Cluster']['MasterPublicDnsName']
+    return True
+
+
+def cached_lookback_metrics(cluster: Cluster):
+    """Lookback metrics kept in memory by the sampler, or by the window while the spool is running.
+    None when they have to be read from the database."""
+    lb_metrics = sampler.window(cluster)
+    if len(lb_metrics) < 2 and spool.running:
+        lb_metrics = metric_windows.lookback_metrics(cluster)
+    return lb_metrics if len(lb_metrics) >= 2 or spool.running else None
+
+
+def average_metrics(cluster: Cluster, cpu_utilization, lb_metrics):
+    """Average the lookback metrics the cluster is scaled on. Return None after recording why it is skipped."""
+    if cpu_utilization is None:
+        logger.info(f'Skipping cluster {cluster.id} no cpu utilization is found.')
+        registry.record_result(cluster.id, 'no cpu utilization')
+        return None
+    if len(lb_metrics) < 2:
+        logger.info(f'Skipping cluster {cluster.id} because there are not enough metrics.')
+        registry.record_result(cluster.id, 'not enough metrics')
+        return None
+    avg_metric = collect_avg_metrics(cluster, lb_metrics)
+    avg_metric.cpu_utilization = cpu_utilization
+    avg_metric.scrape_coverage = registry.scrape_coverage(cluster.id)
+    return avg_metric
+
+
+def record_evaluation(cluster: Cluster, event):
+    if event is None:
+        registry.record_result(cluster.id, 'waiting for group allocation')
+        return
+    registry.record_decision(cluster, event)
+    registry.record_result(cluster.id, event.action)
+
+
+def do_run(cluster: Cluster, dry_run, session):
+    timer = profiler.timer(cluster.id)
+    emr_client = client_pool.emr(cluster)
+    response = emr_client.describe_cluster(ClusterId=cluster.id)
+    timer.lap('describe_cluster')
+    if not update_description(cluster, response):
+        return
+    cluster.update_scaling_policy(emr_client.get_managed_scaling_policy(ClusterId=cluster.id)['ManagedScalingPolicy'])
     if cluster.is_fleet:
         cluster.instance_fleets = emr_client.list_instance_fleets(ClusterId=cluster.id)['InstanceFleets']
     else:
         cluster.instance_groups = emr_client.list_instance_groups(ClusterId=cluster.id)['InstanceGroups']
-    metric = collect_metrics(cluster)
-    logger.info(f'Collected metrics: {metric.__dict__}')
-    session.add(metric)
-    session.commit()
+    timer.lap('describe_topology')
+    seed_window(cluster)
+    sampler.track(cluster)
+    metric = sampler.downsample(cluster) or collect_metrics(cluster)
+    save_metric(cluster, metric, session)
+    registry.record_metrics(cluster.id, metric=metric)
+    timer.lap('yarn_metrics')
     # Update instances cpu time
     cpu_utilization = get_cpu_utilization(cluster, session)
-    if cpu_utilization is None:
-        logger.info(f'Skipping cluster {cluster.id} no cpu utilization is found.')
-        return
-    lb_metrics = get_lookback_metrics(cluster, session)
-    if len(lb_metrics) < 2:
-        logger.info(f'Skipping cluster {cluster.id} because there are not enough metrics.')
+    timer.lap('cpu_utilization')
+    lb_metrics = None if cpu_utilization is None else cached_lookback_metrics(cluster)
+    if cpu_utilization is not None and lb_metrics is None:
+        lb_metrics = get_lookback_metrics(cluster, session)
+    avg_metric = average_metrics(cluster, cpu_utilization, lb_metrics)
+    if avg_metric is None:
         return
-    avg_metric = collect_avg_metrics(cluster, lb_metrics)
-    avg_metric.cpu_utilization = cpu_utilization
-    session.add(avg_metric)
-    session.commit()
-    resize_cluster(cluster, session, dry_run)
+    if not spool.add(session, avg_metric):
+        session.commit()
+    registry.record_metrics(cluster.id, avg_metric=avg_metric)
+    timer.lap('avg_metrics')
+    check_cluster_version(session, cluster)
+    event = resize_cluster(cluster, avg_metric, session, dry_run)
+    timer.lap('resize')
+    record_evaluation(cluster, event)
 
 
 def clean(session):
@@ -69,56 +143,288 @@ def clean(session):
         synchronize_session=False)
 
 
-def read_sqs(name):
+def parse_emr_event(message) -> EMREvent:
+    body = orjson.loads(message['Body'])
+    detail = body.get('detail') or {}
+    return EMREvent(event_id=body.get('id') or message['MessageId'],
+                    event_type=body.get('detail-type'),
+                    cluster_id=detail.get('clusterId'),
+                    state=detail.get('state'),
+                    source=body.get('source'),
+                    message=detail.get('message'),
+                    raw_message=body,
+                    event_time=parser.parse(body['time']).replace(tzinfo=None),
+                    create_time=datetime.utcnow())
+
+
+def read_sqs(name, wait_time_seconds=2):
+    """Store EMR events from the queue and return the ids of active clusters that should be re-evaluated.
+    Events already stored, delivered twice by SQS or EventBridge, are skipped."""
     queue_url = sqs.get_queue_url(QueueName=name)['QueueUrl']
     response = sqs.receive_message(
         QueueUrl=queue_url,
         MaxNumberOfMessages=10,
         VisibilityTimeout=30,
-        WaitTimeSeconds=2
+        WaitTimeSeconds=wait_time_seconds
     )
     messages = response.get('Messages', [])
-    with Session() as session:
-        for message in messages:
-            logger.debug(f'Received EMR event message: {message}')
-            body = orjson.loads(message['Body'])
-            event_type = body.get('detail-type')
-            event_time = parser.parse(body['time']).replace(tzinfo=None)
-            session.add(EMREvent(message=body.get('detail').get('message'), event_type=event_type,
-                                 cluster_id=body.get('detail').get('clusterId'),
-                                 state=body.get('detail').get('state'),
-                                 source=body.get('source'),
-                                 raw_message=body,
-                                 event_time=event_time, create_time=datetime.utcnow()))
-            session.commit()
-            # Assuming processing of the message is successful, delete the message
-            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
-
-
-def run(dry_run, event_queue):
-    session = Session()
-    clusters = session.query(Cluster).all()
-    cluster_ids = [cluster.id for cluster in clusters]
-    session.close()
-    for cluster_id in cluster_ids:
+    if not messages:
+        return set()
+    events = {}
+    parsed = 0
+    for message in messages:
+        logger.debug(f'Received EMR event message: {message}')
         try:
-            with Session() as session:
-                logger.info(f'####################################### Start {cluster_id} ##########################################')
-                cluster = session.get(Cluster, cluster_id)
-                if not cluster.active:
-                    logger.info(f'Skipping cluster {cluster_id} because it is not active.')
-                    continue
-                do_run(cluster, dry_run, session)
-                session.commit()
-                logger.info(f'####################################### End {cluster_id} ##########################################\n\n\n')
+            event = parse_emr_event(message)
         except Exception as e:
-            logger.exception(f'Cluster {cluster_id} error: {e}')
-    if event_queue:
-        read_sqs(event_queue)
+            # A message that cannot be parsed would be redelivered forever, it is deleted with the others
+            logger.warning(f'Skipping malformed EMR event message {message.get("MessageId")}: {e!r}')
+            continue
+        parsed += 1
+        events.setdefault(event.event_id, event)
+    cluster_ids = set()
     with Session() as session:
-        # clean table
-        clean(session)
+        stored = set(session.scalars(select(EMREvent.event_id).where(EMREvent.event_id.in_(list(events)))))
+        new_events = [event for event_id, event in events.items() if event_id not in stored]
+        session.add_all(new_events)
         session.commit()
+        candidates = {event.cluster_id for event in new_events
+                      if event.event_type in REEVALUATION_EVENT_TYPES and event.cluster_id}
+        if candidates:
+            cluster_ids = set(session.scalars(select(Cluster.id).where(Cluster.id.in_(candidates),
+                                                                       Cluster.active == True)))
+    if len(new_events) < parsed:
+        logger.debug(f'Skipped {parsed - len(new_events)} duplicate EMR events.')
+    # The events are stored, so delete the messages
+    response = sqs.delete_message_batch(QueueUrl=queue_url,
+                                        Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                                                 for i, message in enumerate(messages)])
+    for failed in response.get('Failed', []):
+        # The message is delivered again after its visibility timeout, its event is then skipped as a duplicate
+        logger.warning(f'Delete EMR event message {messages[int(failed["Id"])].get("MessageId")} error '
+                       f'{failed.get("Code")}: {failed.get("Message")}')
+    return cluster_ids
+
+
+def check_cluster_version(session, cluster):
+    # Without autoflush the changes of the evaluation are not written, and the row not locked, during the EMR calls
+    with session.no_autoflush:
+        check_version(cluster, session.query(Cluster.version).filter(Cluster.id == cluster.id).scalar())
+
+
+def checkout_cluster(session, cluster_id, probed=False):
+    """The cached cluster attached to the session, or the cluster loaded from the database when it changed.
+    Without a probe of this cycle the version of the row is checked first."""
+    version = None if probed else session.query(Cluster.version).filter(Cluster.id == cluster_id).scalar()
+    cluster = cluster_cache.checkout(cluster_id, version)
+    if cluster is None:
+        return session.get(Cluster, cluster_id)
+    session.add(cluster)
+    return cluster
+
+
+def run_cluster(cluster_id, dry_run, probed=False, rerun=False):
+    """Evaluate a cluster unless it is already being evaluated. With `rerun`, a cluster already being evaluated is
+    evaluated again once that evaluation finishes, it may have described the cluster before an EMR event.
+    True when the cluster was evaluated, False when it was skipped."""
+    with evaluating_lock:
+        if cluster_id in evaluating:
+            if rerun:
+                rerun_requested.add(cluster_id)
+            logger.info(f'Skipping cluster {cluster_id} because it is already being evaluated.')
+            return False
+        evaluating.add(cluster_id)
+    try:
+        return evaluate_cluster(cluster_id, dry_run, probed)
+    finally:
+        release_cluster(cluster_id, dry_run)
+
+
+def release_cluster(cluster_id, dry_run):
+    """Evaluate the cluster again as long as EMR events asked for it during its evaluation, then release it."""
+    while True:
+        with evaluating_lock:
+            if cluster_id not in rerun_requested:
+                evaluating.discard(cluster_id)
+                return
+            rerun_requested.discard(cluster_id)
+        logger.info(f'Re-evaluating cluster {cluster_id}, a re-run was requested during its evaluation.')
+        evaluate_cluster(cluster_id, dry_run)
+
+
+def evaluate_cluster(cluster_id, dry_run, probed=False):
+    evaluated = False
+    try:
+        # Objects are not expired on commit so the cluster can be cached once the session is closed
+        with Session(expire_on_commit=False) as session:
+            logger.info(f'####################################### Start {cluster_id} ##########################################')
+            cluster = checkout_cluster(session, cluster_id, probed)
+            if cluster is None:
+                return False
+            config = registry.apply_pending_config(cluster)
+            if config:
+                logger.info(f'Applied config changes to cluster {cluster_id}: {config}')
+                session.commit()
+            registry.record_cluster(cluster)
+            if not cluster.active:
+                logger.info(f'Skipping cluster {cluster_id} because it is not active.')
+                registry.record_result(cluster_id, 'not active')
+                cluster_cache.checkin(cluster)
+                return False
+            evaluated = True
+            with profiler.profile(cluster_id):
+                do_run(cluster, dry_run, session)
+            session.commit()
+            cluster_cache.checkin(cluster)
+            logger.info(f'####################################### End {cluster_id} ##########################################\n\n\n')
+    except StaleCluster as e:
+        logger.info(f'{e} Evaluating it again.')
+        registry.record_result(cluster_id, 'changed during evaluation')
+        with evaluating_lock:
+            rerun_requested.add(cluster_id)
+    except Exception as e:
+        logger.exception(f'Cluster {cluster_id} error: {e}')
+        registry.record_result(cluster_id, 'error', error=str(e))
+    return evaluated
+
+
+def held_units(session, cluster_group, exclude):
+    """Max units of the group members without a proposal this cycle, they keep what they hold."""
+    units = 0
+    for cluster_id, policy in session.query(Cluster.id, Cluster.current_managed_scaling_policy).filter(
+            Cluster.cluster_group == cluster_group):
+        if cluster_id not in exclude and policy:
+            units += policy['ComputeLimits']['MaximumCapacityUnits']
+    return units
+
+
+def apply_group_plan(cluster_id, plan, max_units, dry_run):
+    with evaluating_lock:
+        if cluster_id in evaluating:
+            logger.info(f'Skipping group allocation of cluster {cluster_id} because it is being evaluated.')
+            return
+        evaluating.add(cluster_id)
+    try:
+        with Session(expire_on_commit=False) as session:
+            cluster = checkout_cluster(session, cluster_id, probed=True)
+            if cluster is None:
+                logger.info(f'Skipping group allocation of cluster {cluster_id} because it was deleted.')
+                return
+            check_cluster_version(session, cluster)
+            event = apply_scale(cluster, plan, dry_run, max_units=max_units)
+            spool.add(session, event)
+            session.commit()
+            cluster_cache.checkin(cluster)
+        registry.record_decision(cluster, event)
+        registry.record_result(cluster_id, event.action)
+    except StaleCluster as e:
+        logger.info(f'{e} Skipping its group allocation.')
+        registry.record_result(cluster_id, 'changed during evaluation')
+    except Exception as e:
+        logger.exception(f'Cluster {cluster_id} error: {e}')
+        registry.record_result(cluster_id, 'error', error=str(e))
+    finally:
+        release_cluster(cluster_id, dry_run)
+
+
+def allocate_groups(dry_run):
+    """Allocate the budget of every cluster group with held back decisions and scale its members."""
+    for cluster_group, proposals in group_allocator.drain().items():
+        with Session() as session:
+            held = held_units(session, cluster_group, exclude=proposals)
+        allocations = group_allocator.allocate(cluster_group, proposals, held_units=held)
+        for cluster_id, proposal in proposals.items():
+            apply_group_plan(cluster_id, proposal.plan, allocations[cluster_id], dry_run)
+
+
+def group_budgets(session):
+    return dict(session.query(ClusterGroup.name, ClusterGroup.capacity_budget).all())
+
+
+def listen_events(event_queue, dry_run, stop_event: threading.Event, max_workers=4):
+    """Long poll the EMR event queue and re-evaluate clusters as soon as their fleets, groups or state change.
+    A cluster that is already queued is not queued again, one that is being evaluated is evaluated again after it."""
+    queued = set()
+    queued_lock = threading.Lock()
+
+    def evaluate(cluster_id):
+        with queued_lock:
+            queued.discard(cluster_id)
+        run_cluster(cluster_id, dry_run, rerun=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mse-event') as executor:
+        while not stop_event.is_set():
+            try:
+                cluster_ids = read_sqs(event_queue, wait_time_seconds=20)
+            except Exception as e:
+                logger.exception(f'Read event queue {event_queue} error: {e}')
+                stop_event.wait(5)
+                continue
+            for cluster_id in cluster_ids:
+                with queued_lock:
+                    if cluster_id in queued:
+                        continue
+                    queued.add(cluster_id)
+                logger.info(f'Re-evaluating cluster {cluster_id} triggered by EMR event.')
+                executor.submit(evaluate, cluster_id)
+
+
+def partition_clusters(session):
+    """Group cluster ids by region and account, each partition is evaluated by its own worker.
+    The versions of the rows are probed at the same time to drop the changed clusters from the cache."""
+    partitions = {}
+    versions = {}
+    for cluster_id, region, role_arn, version in session.query(Cluster.id, Cluster.region, Cluster.role_arn,
+                                                               Cluster.version).all():
+        partitions.setdefault((region, account_of(role_arn)), []).append(cluster_id)
+        versions[cluster_id] = version
+    cluster_cache.refresh(versions)
+    metric_windows.prune(versions)
+    return partitions
+
+
+def run_partition(cluster_ids, dry_run, report: CycleReport):
+    for cluster_id in planner.plan(cluster_ids):
+        if not planner.should_run(report, cluster_id):
+            continue
+        started = time.monotonic()
+        # Skipped clusters do not tell how long an evaluation takes
+        if run_cluster(cluster_id, dry_run, probed=True):
+            planner.record(report, cluster_id, time.monotonic() - started)
+
+
+def run(dry_run, event_queue, partition_workers=4, budget=None):
+    profiler.start_cycle()
+    report = planner.start_cycle(budget)
+    try:
+        with Session() as session:
+            partitions = partition_clusters(session)
+            group_allocator.start_cycle(group_budgets(session))
+        if len(partitions) > 1 and partition_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(len(partitions), partition_workers),
+                                    thread_name_prefix='mse-partition') as executor:
+                futures = []
+                for (region, account), cluster_ids in partitions.items():
+                    logger.info(f'Evaluating {len(cluster_ids)} clusters of region {region or "default"}, '
+                                f'account {account or "default"}.')
+                    futures.append(executor.submit(run_partition, cluster_ids, dry_run, report))
+                for future in futures:
+                    future.result()
+        else:
+            for cluster_ids in partitions.values():
+                run_partition(cluster_ids, dry_run, report)
+        allocate_groups(dry_run)
+        if event_queue:
+            read_sqs(event_queue)
+        with Session() as session:
+            # clean table
+            clean(session)
+            session.commit()
+    finally:
+        group_allocator.end_cycle()
+        planner.end_cycle(report)
+        checkpointer.save()
+        profiler.end_cycle()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from managed_scaling_enhanced.metrics import fetch_yarn_metrics, build_metric, downsample_metrics
+from managed_scaling_enhanced.models import Cluster, Metric
+from managed_scaling_enhanced.status import row_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Target:
+    id: str
+    master_dns_name: str
+    lookback_seconds: float
+    last_seen: float
+
+
+class YarnSampler:
+    """Poll the ResourceManager metrics of every evaluated cluster every `interval` seconds into in-memory buffers,
+    independent of the scheduling interval. Decisions average the buffered samples of the lookback period and only
+    one downsampled metric per cycle is persisted. Clusters not evaluated for `expire_seconds` are no longer polled."""
+
+    def __init__(self, interval=0, expire_seconds=600):
+        self.interval = interval
+        self.expire_seconds = expire_seconds
+        self.lock = threading.Lock()
+        self.targets = {}
+        self.samples = {}
+        self.downsampled_until = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def configure(self, interval=0):
+        self.interval = interval
+
+    def start(self):
+        if self.enabled and self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=lambda: asyncio.run(self.poll()), daemon=True,
+                                           name='mse-yarn-sampler')
+            self.thread.start()
+            logger.info(f'Sampling YARN metrics every {self.interval} seconds.')
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread = None
+
+    def track(self, cluster: Cluster):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.targets[cluster.id] = Target(id=cluster.id, master_dns_name=cluster.master_dns_name,
+                                              lookback_seconds=cluster.metrics_lookback_period_minutes * 60,
+                                              last_seen=time.monotonic())
+            self.samples.setdefault(cluster.id, deque())
+
+    def expire(self):
+        expired = time.monotonic() - self.expire_seconds
+        with self.lock:
+            for cluster_id in [cluster_id for cluster_id, target in self.targets.items() if target.last_seen < expired]:
+                del self.targets[cluster_id]
+                self.samples.pop(cluster_id, None)
+                self.downsampled_until.pop(cluster_id, None)
+
+    def export_state(self):
+        with self.lock:
+            return {cluster_id: {'master_dns_name': target.master_dns_name,
+                                 'lookback_seconds': target.lookback_seconds,
+                                 'downsampled_until': self.downsampled_until.get(cluster_id),
+                                 'samples': [row_to_dict(metric) for metric in self.samples.get(cluster_id, ())]}
+                    for cluster_id, target in self.targets.items()}
+
+    def restore_state(self, clusters, elapsed_seconds=0):
+        """Restore the buffers of a checkpoint, a cluster is tracked again as if evaluated when it was saved."""
+        if not self.enabled:
+            return
+        last_seen = time.monotonic() - elapsed_seconds
+        with self.lock:
+            for cluster_id, state in clusters.items():
+                if cluster_id in self.targets:
+                    continue
+                self.targets[cluster_id] = Target(id=cluster_id, master_dns_name=state['master_dns_name'],
+                                                  lookback_seconds=state['lookback_seconds'], last_seen=last_seen)
+                self.samples[cluster_id] = deque(
+                    Metric(**{**sample, 'event_time': datetime.fromisoformat(sample['event_time'])})
+                    for sample in state['samples'])
+                if state['downsampled_until']:
+                    self.downsampled_until[cluster_id] = datetime.fromisoformat(state['downsampled_until'])
+
+    async def sample(self, session, target: Target):
+        try:
+            metric = build_metric(target, await fetch_yarn_metrics(session, target.master_dns_name))
+        except Exception as e:
+            logger.debug(f'Sample YARN metrics of cluster {target.id} error: {e}')
+            return
+        oldest = metric.event_time - timedelta(seconds=target.lookback_seconds)
+        with self.lock:
+            samples = self.samples.get(target.id)
+            if samples is None:
+                return
+            samples.append(metric)
+            while samples and samples[0].event_time <= oldest:
+                samples.popleft()
+
+    async def poll(self):
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=max(self.interval, 1))) as session:
+            while not self.stop_event.is_set():
+                started = time.monotonic()
+                self.expire()
+                with self.lock:
+                    targets = list(self.targets.values())
+                await asyncio.gather(*[self.sample(session, target) for target in targets])
+                await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def window(self, cluster: Cluster):
+        """Buffered samples of the lookback period, empty when sampling is disabled or the buffer does not span the
+        period yet, after a start or a longer lookback, the persisted metrics are averaged instead."""
+        if not self.enabled:
+            return []
+        since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        with self.lock:
+            samples = self.samples.get(cluster.id)
+            # Older samples are dropped, a spanning buffer starts within a sampling interval of the period start
+            if not samples or samples[0].event_time > since + timedelta(seconds=2 * self.interval):
+                return []
+            return [metric for metric in samples if metric.event_time > since]
+
+    def downsample(self, cluster: Cluster):
+        """Average of the samples taken since the previous call, None when there are none."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            since = self.downsampled_until.get(cluster.id, datetime.min)
+            samples = [metric for metric in self.samples.get(cluster.id, ()) if metric.event_time > since]
+            if not samples:
+                return None
+            self.downsampled_until[cluster.id] = samples[-1].event_time
+        return downsample_metrics(cluster, samples)
+
+
+sampler = YarnSampler()
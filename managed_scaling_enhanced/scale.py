@@ -1,18 +1,19 @@
-from typing import List
+from typing import List, Optional
 
-from managed_scaling_enhanced import boto3_config
-from managed_scaling_enhanced.models import Cluster, AvgMetric, ResizePolicy, Event
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.decision_log import decision_log
+from managed_scaling_enhanced.groups import group_allocator, Proposal, demand_weight
+from managed_scaling_enhanced.models import Cluster, ClusterSnapshot, AvgMetric, ResizePolicy, Event
+from managed_scaling_enhanced.occupancy import Occupancy, get_occupancy
+from managed_scaling_enhanced.shadow import shadow_overrides, shadow_state
+from managed_scaling_enhanced.spool import spool
 import logging
 from datetime import datetime
-import boto3
 import math
 from dataclasses import dataclass, asdict
-from tabulate import tabulate
 from managed_scaling_enhanced.utils import ec2_types
-from sqlalchemy import desc
 
 logger = logging.getLogger(__name__)
-emr_client = boto3.client('emr', config=boto3_config)
 
 
 @dataclass
@@ -66,171 +67,424 @@ def check_requirements(cluster: Cluster, metric: AvgMetric):
     return results
 
 
-def resize_cluster(cluster, session, dry_run):
-    avg_metric = session.query(AvgMetric).filter(AvgMetric.cluster_id == cluster.id).order_by(desc(AvgMetric.event_time)).first()
+def resize_cluster(cluster, avg_metric, session, dry_run):
+    event = evaluate_and_scale(cluster, avg_metric, dry_run)
+    if event is not None:
+        spool.add(session, event)
+    session.commit()
+    return event
+
+
+@dataclass
+class ScalePlan:
+    snapshot: ClusterSnapshot
+    avg_metric: AvgMetric
+    target_units: int
+    stable_target_units: int
+    is_cooling_down: bool
+    can_act: bool
+    shadows: list = None
+
+
+def plan_scale(cluster: Cluster, avg_metric: AvgMetric, dry_run) -> ScalePlan:
+    """Compute and stabilize the target of a cluster."""
+    snapshot = cluster.snapshot()
     # results = check_requirements(cluster, avg_metric)
     # results_dicts = [asdict(result) for result in results]
     # yarn_metrics_dicts = [{'metric': k, 'value': v} for k, v in cluster.yarn_metrics.items()]
     # table = tabulate(yarn_metrics_dicts, headers="keys", tablefmt="grid")
-    logger.info(f'------------------------ Average Yarn Metrics ---------------------\n{avg_metric.__dict__}')
-    cluster_status_dicts = [{'key': k, 'value': v} for k, v in cluster.to_dict().items()]
-    table = tabulate(cluster_status_dicts, headers="keys", tablefmt="grid")
-    logger.info(f'------------------------ Cluster Status ---------------------\n{cluster.to_dict()}')
     # table = tabulate(results_dicts, headers="keys", tablefmt="grid")
     # logger.info(f'------------------------------- Check Results ---------------------------\n{table}')
-    target_units = compute_target_max_units(cluster, avg_metric)
-    logger.info(f'Computed target units: {target_units}')
-    # if target_units == cluster.current_max_units:
-    #     logger.info(f'Skip cluster {cluster.id}. Target unit: {target_units}. Current max units: {cluster.current_max_units}')
+    target_units = compute_target_max_units(snapshot, avg_metric)
+    logger.debug(f'Computed target units: {target_units}')
+    stable_target_units = stabilize_target_units(cluster, snapshot, target_units)
+    # if target_units == snapshot.current_max_units:
+    #     logger.info(f'Skip cluster {cluster.id}. Target unit: {target_units}. Current max units: {snapshot.current_max_units}')
     #     return
 
-    event = Event()
-    event.cluster_id = cluster.id
-    event.event_time = datetime.utcnow()
-    event.current_max_units = cluster.current_max_units
-    event.target_max_units = target_units
-    event.is_resizing = cluster.is_resizing
-    last_action_time = max(cluster.last_scale_in_ts, cluster.last_scale_out_ts)
-    last_action_seconds = (datetime.utcnow() - last_action_time).total_seconds()
-    event.is_cooling_down = last_action_seconds < cluster.cool_down_period_minutes * 60
-    action_flag = True
-    if cluster.is_resizing:
+    last_action_seconds = (datetime.utcnow() - snapshot.last_action_time).total_seconds()
+    is_cooling_down = last_action_seconds < snapshot.cool_down_period_minutes * 60
+    can_act = True
+    if snapshot.is_resizing:
         logger.info(f'Skip resizing cluster {cluster.id}.')
-        action_flag = False
-    if event.is_cooling_down:
+        can_act = False
+    if is_cooling_down:
         logger.info(f'Skip cooling down cluster {cluster.id}.')
-        action_flag = False
+        can_act = False
     if dry_run:
-        action_flag = True
+        can_act = True
+    return ScalePlan(snapshot=snapshot, avg_metric=avg_metric, target_units=target_units,
+                     stable_target_units=stable_target_units, is_cooling_down=is_cooling_down, can_act=can_act,
+                     shadows=evaluate_shadows(snapshot, avg_metric, can_act))
+
+
+def evaluate_shadows(snapshot: ClusterSnapshot, avg_metric: AvgMetric, can_act):
+    """Decisions the shadow policies of the cluster would make on the same metrics and state, nothing is changed.
+    A shadow keeps its own consecutive evaluation count but always starts from the real current max units."""
+    shadows = []
+    for policy in snapshot.shadow_policies or ():
+        name = policy['name']
+        try:
+            overrides = shadow_overrides(policy)
+        except ValueError as e:
+            logger.warning(f'Skipping shadow policy {name} of cluster {snapshot.id}: {e}')
+            continue
+        direction, count = shadow_state.get(snapshot.id, name)
+        shadow = snapshot.replace(**overrides, pending_scale_direction=direction, pending_scale_count=count)
+        target_units = compute_target_max_units(shadow, avg_metric)
+        stable_target_units, direction, count = stabilize(shadow, target_units, log=logger.debug)
+        action = 'nothing'
+        if can_act and stable_target_units != snapshot.current_max_units:
+            action = 'scale in' if stable_target_units < snapshot.current_max_units else 'scale out'
+            direction, count = None, 0
+        shadow_state.set(snapshot.id, name, direction, count)
+        shadows.append({'name': name, 'action': action, 'target_max_units': target_units,
+                        'stable_target_units': stable_target_units})
+    shadow_state.prune(snapshot.id, {policy['name'] for policy in snapshot.shadow_policies or ()})
+    return shadows
+
+
+def evaluate_and_scale(cluster: Cluster, avg_metric: AvgMetric, dry_run) -> Optional[Event]:
+    """Compute the target of a cluster, scale it if allowed and return the event to record.
+    Members of a cluster group with a capacity budget return None during a cycle, they are scaled once the
+    group is allocated. This does not touch the database so it can be called from an executor thread."""
+    plan = plan_scale(cluster, avg_metric, dry_run)
+    max_units = None
+    if group_allocator.budgeted(cluster.cluster_group):
+        snapshot = plan.snapshot
+        proposal = Proposal(cluster_id=cluster.id, current_units=snapshot.current_max_units,
+                            request_units=plan.stable_target_units if plan.can_act else snapshot.current_max_units,
+                            weight=demand_weight(avg_metric), plan=plan)
+        if group_allocator.propose(cluster.cluster_group, proposal):
+            return None
+        max_units = group_allocator.last_allocation(cluster.id)
+    return apply_scale(cluster, plan, dry_run, max_units=max_units)
+
+
+def apply_scale(cluster: Cluster, plan: ScalePlan, dry_run, max_units=None) -> Event:
+    """Scale the cluster to the planned target, at most `max_units` when it is given. The budget of a group only
+    holds back scale out, it never lowers the current max units."""
+    snapshot = plan.snapshot
+    stable_target_units = plan.stable_target_units
+    if max_units is not None and stable_target_units > max(max_units, snapshot.current_max_units):
+        logger.info(f'Cluster {cluster.id} target {stable_target_units} is capped to {max_units} max units by the '
+                    f'budget of group {cluster.cluster_group}.')
+        stable_target_units = max(max_units, snapshot.current_max_units)
+
+    event = Event()
+    event.cluster_id = snapshot.id
+    event.event_time = datetime.utcnow()
+    event.current_max_units = snapshot.current_max_units
+    event.target_max_units = plan.target_units
+    event.is_resizing = snapshot.is_resizing
+    event.is_cooling_down = plan.is_cooling_down
+    data = {}
+    if stable_target_units != plan.stable_target_units:
+        data['group_max_units'] = max_units
+    if plan.shadows:
+        data['shadows'] = plan.shadows
     action = 'nothing'
-    if action_flag:
-        if target_units < cluster.current_max_units:
-            logger.info(f'------------------- Start to scale in ----------------------')
-            scale_in(cluster, target_units, dry_run)
+    changes = []
+    if plan.can_act:
+        occupancy = None
+        if stable_target_units < snapshot.current_max_units and snapshot.container_aware_scale_in:
+            occupancy = get_occupancy(cluster, snapshot)
+        if occupancy is not None:
+            removable_units = occupancy.removable_units(snapshot.current_max_units)
+            data['removable_units'] = removable_units
+            if snapshot.current_max_units - stable_target_units > removable_units:
+                capped_target_units = math.ceil(snapshot.current_max_units - removable_units)
+                logger.info(f'Cluster {cluster.id} scale in to {stable_target_units} is capped to '
+                            f'{capped_target_units} max units, only {removable_units} units are unused or idle.')
+                stable_target_units = capped_target_units
+        if stable_target_units < snapshot.current_max_units:
+            changes = scale_in(cluster, snapshot, stable_target_units, dry_run, occupancy=occupancy)
             action = 'scale in'
-            logger.info(f'------------------- Finished scaling in ----------------------')
-        elif target_units > cluster.current_max_units:
-            logger.info(f'------------------- Start to scale out ----------------------')
-            scale_out(cluster, target_units, dry_run)
-            logger.info(f'------------------- Finished scaling out ----------------------')
+        elif stable_target_units > snapshot.current_max_units:
+            changes = scale_out(cluster, snapshot, stable_target_units, dry_run)
             action = 'scale out'
+        if action != 'nothing':
+            logger.info(f'Cluster {cluster.id} {action} from {snapshot.current_max_units} to {stable_target_units} '
+                        f'max units{" (dry run)" if dry_run else ""}.')
+            cluster.pending_scale_direction = None
+            cluster.pending_scale_count = 0
 
     event.action = action
-    session.add(event)
-    session.commit()
+    event.data = data or None
+    decision_log.log(snapshot.id, snapshot.log_level,
+                     lambda detailed: decision_record(cluster, snapshot, plan.avg_metric, event,
+                                                      stable_target_units, changes, dry_run, detailed),
+                     noop=action == 'nothing')
+    return event
 
 
-def log_table_str(data: List[dataclass]):
-    dicts = [asdict(item) for item in data]
-    return tabulate(dicts, headers="keys", tablefmt="grid")
+def decision_record(cluster: Cluster, snapshot: ClusterSnapshot, avg_metric: AvgMetric, event: Event,
+                    stable_target_units, changes, dry_run, detailed):
+    record = {'cluster_id': snapshot.id,
+              'action': event.action,
+              'current_max_units': snapshot.current_max_units,
+              'target_max_units': event.target_max_units,
+              'stable_target_units': stable_target_units,
+              'pending_scale_direction': cluster.pending_scale_direction,
+              'pending_scale_count': cluster.pending_scale_count,
+              'is_resizing': event.is_resizing,
+              'is_cooling_down': event.is_cooling_down,
+              'dry_run': dry_run,
+              'changes': [asdict(change) for change in changes]}
+    if event.data:
+        record.update(event.data)
+    if detailed:
+        record['metrics'] = {column: getattr(avg_metric, column) for column in DECISION_METRIC_COLUMNS}
+        record['cluster'] = snapshot.to_dict()
+    return record
 
 
-def log_parameters(parameters):
-    logger.info(f'Parameters:\n{log_table_str(parameters)}')
+DECISION_METRIC_COLUMNS = ('event_time', 'yarn_total_vcore', 'yarn_allocated_vcore', 'yarn_reserved_vcore',
+                           'yarn_pending_vcore', 'yarn_total_mem', 'yarn_allocated_mem', 'yarn_reserved_mem',
+                           'yarn_pending_mem', 'cpu_utilization', 'scrape_coverage')
 
 
-def compute_target_max_units(cluster: Cluster, avg_metric: AvgMetric):
+def compute_target_max_units(snapshot: ClusterSnapshot, avg_metric: AvgMetric):
     # use resource based policy first
-    logger.info('Use resource based policy first.')
     if avg_metric.yarn_pending_vcore > 0 or avg_metric.yarn_pending_mem > 0:
-        step1 = (avg_metric.yarn_pending_vcore / avg_metric.yarn_total_vcore) * cluster.current_max_units
-        step2 = (avg_metric.yarn_pending_mem / avg_metric.yarn_total_mem) * cluster.current_max_units
+        step1 = (avg_metric.yarn_pending_vcore / avg_metric.yarn_total_vcore) * snapshot.current_max_units
+        step2 = (avg_metric.yarn_pending_mem / avg_metric.yarn_total_mem) * snapshot.current_max_units
         step = max(step1, step2)
     else:
         step1 = - (1 - (
-                    avg_metric.yarn_allocated_mem + avg_metric.yarn_reserved_mem) / avg_metric.yarn_total_mem) * cluster.current_max_units
+                    avg_metric.yarn_allocated_mem + avg_metric.yarn_reserved_mem) / avg_metric.yarn_total_mem) * snapshot.current_max_units
         step2 = - (1 - (
-                    avg_metric.yarn_allocated_vcore + avg_metric.yarn_reserved_vcore) / avg_metric.yarn_total_vcore) * cluster.current_max_units
+                    avg_metric.yarn_allocated_vcore + avg_metric.yarn_reserved_vcore) / avg_metric.yarn_total_vcore) * snapshot.current_max_units
         step = max(step1, step2)
         step = min(step, 0)
 
-    if step < 0 and cluster.resize_policy == ResizePolicy.CPU_BASED:
-        if avg_metric.cpu_utilization < cluster.cpu_usage_lower_bound:
-            logger.info('Use CPU based policy to scale in')
-            step = - (1 - avg_metric.cpu_utilization / cluster.cpu_usage_upper_bound) * cluster.current_max_units
-        # elif avg_metric.cpu_utilization > cluster.cpu_usage_upper_bound:
-        #     step = (avg_metric.cpu_utilization / cluster.cpu_usage_upper_bound - 1) * cluster.current_max_units
+    low_coverage = (avg_metric.scrape_coverage is not None
+                    and avg_metric.scrape_coverage < snapshot.min_scrape_coverage)
+    if low_coverage:
+        logger.info(f'Scrape coverage {avg_metric.scrape_coverage} is below {snapshot.min_scrape_coverage}, '
+                    f'CPU utilization is not used.')
+    if step < 0 and snapshot.resize_policy == ResizePolicy.CPU_BASED and not low_coverage:
+        if avg_metric.cpu_utilization < snapshot.cpu_usage_lower_bound:
+            logger.debug('Use CPU based policy to scale in')
+            step = - (1 - avg_metric.cpu_utilization / snapshot.cpu_usage_upper_bound) * snapshot.current_max_units
+        # elif avg_metric.cpu_utilization > snapshot.cpu_usage_upper_bound:
+        #     step = (avg_metric.cpu_utilization / snapshot.cpu_usage_upper_bound - 1) * snapshot.current_max_units
     if step > 0:
-        step = math.ceil(step * cluster.scale_out_factor)
+        step = math.ceil(step * snapshot.scale_out_factor)
     elif step < 0:
-        step = math.floor(step * cluster.scale_in_factor)
-    logger.info(f'Computed step: {step}')
-    target_units = cluster.current_max_units + step
-    target_units = min(target_units, cluster.max_capacity_limit)
-    target_units = max(target_units, cluster.current_min_units + 1)
-    target_units = max(target_units, cluster.current_max_core_units)
-    target_units = max(target_units, cluster.current_max_od_units)
+        step = math.floor(step * snapshot.scale_in_factor)
+    logger.debug(f'Computed step: {step}')
+    target_units = snapshot.current_max_units + step
+    target_units = min(target_units, snapshot.max_capacity_limit)
+    target_units = max(target_units, min_max_units(snapshot))
     return target_units
 
 
-def scale_in(cluster: Cluster, target_units, dry_run: bool = False) -> bool:
-    delta = cluster.current_max_units - target_units
-    logger.info(f'Starting cluster {cluster.id} scaling in...')
-    changes = [ParameterChange(parameter='MaximumCapacityUnits',
-                               before=cluster.current_max_units, after=str(target_units))]
+def min_max_units(snapshot: ClusterSnapshot):
+    """Lowest max units the managed scaling policy of the cluster allows."""
+    return max(snapshot.current_min_units + 1, snapshot.current_max_core_units, snapshot.current_max_od_units)
 
-    cluster.modify_scaling_policy(max_units=target_units)
 
+def stabilize_target_units(cluster: Cluster, snapshot: ClusterSnapshot, target_units):
+    stable_target_units, cluster.pending_scale_direction, cluster.pending_scale_count = stabilize(snapshot,
+                                                                                                 target_units)
+    return stable_target_units
+
+
+def stabilize(snapshot: ClusterSnapshot, target_units, log=logger.info):
+    """Return the target to act on, or the current max units while the change is inside the dead band,
+    smaller than the minimum step or has not persisted for enough consecutive evaluations, with the new pending
+    scale direction and count."""
+    delta = target_units - snapshot.current_max_units
+    if delta > 0:
+        direction = 'scale out'
+        dead_band = snapshot.scale_out_dead_band
+    elif delta < 0:
+        direction = 'scale in'
+        dead_band = snapshot.scale_in_dead_band
+    else:
+        direction = None
+        dead_band = 0
+    if direction and abs(delta) < max(snapshot.min_scale_step, dead_band * snapshot.current_max_units):
+        log(f'Change {delta} is within dead band {dead_band} or below minimum step {snapshot.min_scale_step}.')
+        direction = None
+
+    if direction is None:
+        count = 0
+    elif direction == snapshot.pending_scale_direction:
+        count = snapshot.pending_scale_count + 1
+    else:
+        count = 1
+
+    if direction is None:
+        return snapshot.current_max_units, direction, count
+    if count < snapshot.required_consecutive_evaluations:
+        log(f'Deferring {direction} of cluster {snapshot.id}: '
+            f'{count}/{snapshot.required_consecutive_evaluations} consecutive evaluations.')
+        return snapshot.current_max_units, direction, count
+    return target_units, direction, count
+
+
+def put_managed_scaling_policy(cluster: Cluster, dry_run):
     if not dry_run:
-        emr_client.put_managed_scaling_policy(ClusterId=cluster.id,
+        client_pool.emr(cluster).put_managed_scaling_policy(ClusterId=cluster.id,
                                               ManagedScalingPolicy=cluster.current_managed_scaling_policy)
 
-    if cluster.managed_scaling_unit_type == 'InstanceFleetUnits':
-        new_od_capacity = cluster.current_task_od_capacity
-        new_spot_capacity = cluster.current_task_spot_capacity
-        if new_spot_capacity >= delta:
-            new_spot_capacity -= delta
+
+def scale_in(cluster: Cluster, snapshot: ClusterSnapshot, target_units, dry_run: bool = False,
+             occupancy: Occupancy = None) -> List[ParameterChange]:
+    """Lower the max units and the task capacity. With the occupancy of the task nodes the max units above the
+    running capacity go first and only idle task nodes are removed, otherwise spot capacity is removed first."""
+    delta = snapshot.current_max_units - target_units
+    changes = [ParameterChange(parameter='MaximumCapacityUnits',
+                               before=snapshot.current_max_units, after=str(target_units))]
+
+    cluster.modify_scaling_policy(max_units=target_units)
+    put_managed_scaling_policy(cluster, dry_run)
+    if occupancy is not None:
+        delta = max(delta - occupancy.headroom_units(snapshot.current_max_units), 0)
+
+    if snapshot.managed_scaling_unit_type == 'InstanceFleetUnits':
+        changes.extend(scale_in_instance_fleet(cluster, snapshot, delta, dry_run, occupancy))
+    else:
+        changes.extend(scale_in_instance_groups(cluster, snapshot, delta, dry_run, occupancy))
+
+    cluster.last_scale_in_ts = datetime.utcnow()
+    return changes
+
+
+def scale_in_instance_fleet(cluster: Cluster, snapshot: ClusterSnapshot, delta, dry_run,
+                            occupancy: Occupancy = None) -> List[ParameterChange]:
+    new_od_capacity = snapshot.current_task_od_capacity
+    new_spot_capacity = snapshot.current_task_spot_capacity
+    if occupancy is not None:
+        spot_step = min(delta, occupancy.idle_units(market='SPOT'), new_spot_capacity)
+        new_spot_capacity -= spot_step
+        new_od_capacity -= min(delta - spot_step, occupancy.idle_units(market='ON_DEMAND'))
+    elif new_spot_capacity >= delta:
+        new_spot_capacity -= delta
+    else:
+        delta -= new_spot_capacity
+        new_spot_capacity = 0
+        new_od_capacity -= delta
+    new_od_capacity = max(new_od_capacity, 0)
+    changes = [ParameterChange(parameter='TargetOnDemandCapacity', before=snapshot.task_target_od_capacity,
+                               after=str(new_od_capacity)),
+               ParameterChange(parameter='TargetSpotCapacity', before=snapshot.task_target_spot_capacity,
+                               after=str(new_spot_capacity))]
+    unchanged = (new_od_capacity == snapshot.task_target_od_capacity
+                 and new_spot_capacity == snapshot.task_target_spot_capacity)
+    if not dry_run and not unchanged:
+        client_pool.emr(cluster).modify_instance_fleet(ClusterId=cluster.id,
+                                                       InstanceFleet={
+                                                           'InstanceFleetId': snapshot.task_instance_fleet['Id'],
+                                                           'TargetOnDemandCapacity': new_od_capacity,
+                                                           'TargetSpotCapacity': new_spot_capacity
+                                                       })
+    return changes
+
+
+def scale_in_instance_groups(cluster: Cluster, snapshot: ClusterSnapshot, delta, dry_run,
+                             occupancy: Occupancy = None) -> List[ParameterChange]:
+    """Remove whole instances worth at most `delta` units. With the occupancy the groups with the largest share
+    of idle nodes go first and EMR is told to terminate their idle instances, otherwise spot groups go first."""
+    def idle_share(group):
+        return len(occupancy.idle_nodes(instance_set_id=group['Id'])) / max(group['RunningInstanceCount'], 1)
+
+    if occupancy is None:
+        sorted_groups = sorted(snapshot.task_instance_groups, key=lambda x: 0 if x['Market'] == 'SPOT' else 1)
+    else:
+        sorted_groups = sorted(snapshot.task_instance_groups,
+                               key=lambda x: (-idle_share(x), 0 if x['Market'] == 'SPOT' else 1))
+    instance_groups = []
+    changes = []
+    for group in sorted_groups:
+        if delta <= 0:
+            break
+        if snapshot.managed_scaling_unit_type == 'Instances':
+            units_per_instance = 1
         else:
-            delta -= new_spot_capacity
-            new_spot_capacity = 0
-            new_od_capacity -= delta
-        new_od_capacity = max(new_od_capacity, 0)
-        changes.append(ParameterChange(parameter='TargetOnDemandCapacity', before=cluster.task_target_od_capacity,
-                       after=str(new_od_capacity)))
-        changes.append(ParameterChange(parameter='TargetSpotCapacity', before=cluster.task_target_spot_capacity,
-                       after=str(new_spot_capacity)))
+            units_per_instance = ec2_types[group['InstanceType']]
+        count = min(group['RunningInstanceCount'], int(delta // units_per_instance))
+        modification = {'InstanceGroupId': group['Id']}
+        if occupancy is not None:
+            idle_instance_ids = [node.instance_id for node in occupancy.idle_nodes(instance_set_id=group['Id'])]
+            count = min(count, len(idle_instance_ids))
+            modification['ShrinkPolicy'] = {'InstanceResizePolicy': {'InstancesToTerminate': idle_instance_ids[:count]}}
+        if count <= 0:
+            continue
+        modification['InstanceCount'] = group['RunningInstanceCount'] - count
+        instance_groups.append(modification)
+        changes.append(ParameterChange(parameter=f'InstanceCount {group["Id"]}',
+                                       before=group['RunningInstanceCount'],
+                                       after=str(modification['InstanceCount'])))
+        delta -= count * units_per_instance
+    if not dry_run and instance_groups:
+        client_pool.emr(cluster).modify_instance_groups(ClusterId=cluster.id, InstanceGroups=instance_groups)
+    return changes
+
+
+def bump_task_capacity(cluster: Cluster, snapshot: ClusterSnapshot, target_units, dry_run):
+    """Raise the task fleet target or a task instance group by the scale out step instead of waiting for managed
+    scaling to add nodes. Core and task capacity stay within the new max units and on demand within its limit."""
+    step = min(target_units - snapshot.current_max_units,
+               target_units - snapshot.current_core_capacity - snapshot.current_task_total_capacity)
+    od_room = max((snapshot.current_max_od_units or 0) - snapshot.current_core_od_capacity
+                  - (snapshot.current_task_od_capacity or 0), 0)
+    if step <= 0:
+        logger.info(f'Task capacity of cluster {cluster.id} is already at the new max units, skip bumping it.')
+        return []
+    emr_client = client_pool.emr(cluster)
+    if snapshot.is_fleet:
+        fleet = snapshot.task_instance_fleet
+        if fleet is None:
+            return []
+        new_od_capacity = fleet['TargetOnDemandCapacity']
+        new_spot_capacity = fleet['TargetSpotCapacity']
+        if new_spot_capacity > 0 or new_od_capacity == 0:
+            new_spot_capacity += step
+        else:
+            new_od_capacity += min(step, od_room)
+        if new_od_capacity == fleet['TargetOnDemandCapacity'] and new_spot_capacity == fleet['TargetSpotCapacity']:
+            return []
         if not dry_run:
             emr_client.modify_instance_fleet(ClusterId=cluster.id,
                                              InstanceFleet={
-                                                 'InstanceFleetId': cluster.task_instance_fleet['Id'],
+                                                 'InstanceFleetId': fleet['Id'],
                                                  'TargetOnDemandCapacity': new_od_capacity,
                                                  'TargetSpotCapacity': new_spot_capacity
                                              })
-    else:
-        instance_groups = []
-        sorted_groups = sorted(cluster.task_instance_groups, key=lambda x: 0 if x['Market'] == 'SPOT' else 1)
-        for group in sorted_groups:
-            if cluster.managed_scaling_unit_type == 'Instances':
-                units = group['RunningInstanceCount']
-            else:
-                units = group['RunningInstanceCount'] * ec2_types[group['InstanceType']]
-            if units >= delta:
-                instance_groups.append({'InstanceGroupId': group['Id'], 'InstanceCount': units - delta})
-                break
-            else:
-                instance_groups.append({'InstanceGroupId': group['Id'],
-                                        'InstanceCount': 0})
-                delta -= units
-        logger.info(f'Instance groups modification: {instance_groups}')
-        if not dry_run:
-            emr_client.modify_instance_groups(ClusterId=cluster.id, InstanceGroups=instance_groups)
-
-    log_parameters(changes)
-
-    cluster.last_scale_in_ts = datetime.utcnow()
-    return True
+        return [ParameterChange(parameter='TargetOnDemandCapacity', before=fleet['TargetOnDemandCapacity'],
+                                after=str(new_od_capacity)),
+                ParameterChange(parameter='TargetSpotCapacity', before=fleet['TargetSpotCapacity'],
+                                after=str(new_spot_capacity))]
+    sorted_groups = sorted(snapshot.task_instance_groups, key=lambda x: 0 if x['Market'] == 'SPOT' else 1)
+    for group in sorted_groups:
+        if snapshot.managed_scaling_unit_type == 'Instances':
+            units_per_instance = 1
+        else:
+            units_per_instance = ec2_types[group['InstanceType']]
+        units = step if group['Market'] == 'SPOT' else min(step, od_room)
+        instances = units // units_per_instance
+        if instances > 0:
+            instance_count = group['RunningInstanceCount'] + instances
+            if not dry_run:
+                emr_client.modify_instance_groups(ClusterId=cluster.id,
+                                                  InstanceGroups=[{'InstanceGroupId': group['Id'],
+                                                                   'InstanceCount': instance_count}])
+            return [ParameterChange(parameter=f'InstanceCount {group["Id"]}', before=group['RunningInstanceCount'],
+                                    after=str(instance_count))]
+    return []
 
 
-def scale_out(cluster: Cluster, target_units, dry_run):
+def scale_out(cluster: Cluster, snapshot: ClusterSnapshot, target_units, dry_run) -> List[ParameterChange]:
     changes = [
-        ParameterChange(parameter='MaximumCapacityUnits', before=cluster.current_max_units,
+        ParameterChange(parameter='MaximumCapacityUnits', before=snapshot.current_max_units,
                         after=str(target_units))]
-    log_parameters(changes)
     cluster.modify_scaling_policy(max_units=target_units)
     # logger.info(f'New managed policy max units: {new_max_units}')
-    if not dry_run:
-        emr_client.put_managed_scaling_policy(ClusterId=cluster.id,
-                                              ManagedScalingPolicy=cluster.current_managed_scaling_policy)
-    flag = True
+    put_managed_scaling_policy(cluster, dry_run)
+    if snapshot.aggressive_scale_out:
+        changes.extend(bump_task_capacity(cluster, snapshot, target_units, dry_run))
     cluster.last_scale_out_ts = datetime.utcnow()
-    return flag
+    return changes
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import aiohttp
+
+from managed_scaling_enhanced.models import CpuUsage
+
+logger = logging.getLogger(__name__)
+
+
+async def request_cpu_time(session, instance, timeout=None) -> CpuUsage:
+    url = f'http://{instance.host_name}:9100/metrics'
+    async with session.get(url, timeout=timeout) as response:
+        response.raise_for_status()
+        total_seconds = 0
+        idle_seconds = 0
+        resp_text = await response.text()
+        for line in resp_text.splitlines():
+            if line.startswith('node_cpu_seconds_total'):
+                seconds = float(line.split(' ')[1])
+                total_seconds += seconds
+                if 'mode="idle"' in line:
+                    idle_seconds += seconds
+        cpu_usage = CpuUsage()
+        cpu_usage.cluster_id = instance.cluster_id
+        cpu_usage.instance_id = instance.instance_id
+        cpu_usage.total_seconds = total_seconds
+        cpu_usage.idle_seconds = idle_seconds
+        cpu_usage.event_time = datetime.utcnow()
+        return cpu_usage
+
+
+@dataclass
+class HostState:
+    failures: int = 0
+    open_until: float = 0
+
+
+@dataclass
+class ScrapeStats:
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    hedged: int = 0
+    open_hosts: list = field(default_factory=list)
+
+    @property
+    def coverage(self):
+        if self.total:
+            return self.succeeded / self.total
+
+
+class SharedSemaphore:
+    """Semaphore shared by the event loops of all threads, the sync engine runs a new loop per cluster.
+    Waiters are woken in FIFO order on their own loop."""
+
+    def __init__(self, value):
+        self.value = value
+        self.lock = threading.Lock()
+        self.waiters = deque()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.value > 0 and not self.waiters:
+                self.value -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self.waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.lock:
+                granted = waiter not in self.waiters
+                if not granted:
+                    self.waiters.remove(waiter)
+            if granted:
+                # release() handed this waiter the permit, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.value += 1
+                return
+            loop, future = self.waiters.popleft()
+        try:
+            loop.call_soon_threadsafe(self.grant, future)
+        except RuntimeError:
+            # The loop of the waiter is closed
+            self.release()
+
+    @staticmethod
+    def grant(future):
+        # A cancelled waiter releases the permit itself
+        if not future.done():
+            future.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class Scraper:
+    """Scrape node_exporter of many hosts with a global and a per-cluster concurrency limit.
+    A host failing `failure_threshold` times in a row is skipped until its backoff expires, the backoff doubles
+    each time the host fails again after it. With `hedge_after` set, a second request is sent to hosts that have
+    not answered after that many seconds and the first response wins."""
+
+    def __init__(self, concurrency=200, cluster_concurrency=50, connect_timeout=1.0, read_timeout=3.0,
+                 failure_threshold=3, base_backoff=30.0, max_backoff=600.0, hedge_after=None):
+        self.configure(concurrency=concurrency, cluster_concurrency=cluster_concurrency,
+                       connect_timeout=connect_timeout, read_timeout=read_timeout,
+                       failure_threshold=failure_threshold, base_backoff=base_backoff,
+                       max_backoff=max_backoff, hedge_after=hedge_after)
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        for key, value in kwargs.items():
+            if value is not None or key == 'hedge_after':
+                setattr(self, key, value)
+        if kwargs.get('concurrency') is not None:
+            # Requests in flight release the permits of the previous semaphore
+            self.semaphore = SharedSemaphore(self.concurrency)
+
+    @property
+    def timeout(self):
+        return aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+
+    def is_open(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            return state is not None and state.open_until > time.monotonic()
+
+    def record_success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def record_failure(self, host, error):
+        with self.lock:
+            state = self.hosts.setdefault(host, HostState())
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                backoff = min(self.base_backoff * 2 ** (state.failures - self.failure_threshold), self.max_backoff)
+                state.open_until = time.monotonic() + backoff
+                logger.warning(f'Scraping {host} failed {state.failures} times in a row, '
+                               f'skipping it for {backoff:.0f} seconds. Error: {error}')
+            else:
+                logger.info(f'Error get cpu usage of instance {host}. Error: {error}')
+
+    def export_state(self):
+        now = time.monotonic()
+        with self.lock:
+            return {host: {'failures': state.failures, 'open_for': max(state.open_until - now, 0)}
+                    for host, state in self.hosts.items()}
+
+    def restore_state(self, hosts, elapsed_seconds=0):
+        now = time.monotonic()
+        with self.lock:
+            for host, state in hosts.items():
+                open_for = state['open_for'] - elapsed_seconds
+                self.hosts[host] = HostState(failures=state['failures'], open_until=now + open_for if open_for > 0 else 0)
+
+    def prune(self):
+        """Drop breaker state of hosts that have not been retried for a long time, they are usually gone."""
+        expired = time.monotonic() - self.max_backoff
+        with self.lock:
+            for host in [host for host, state in self.hosts.items() if 0 < state.open_until < expired]:
+                del self.hosts[host]
+
+    async def fetch(self, session, instance, stats: ScrapeStats):
+        if self.hedge_after is None:
+            return await request_cpu_time(session, instance, self.timeout)
+        first = asyncio.ensure_future(request_cpu_time(session, instance, self.timeout))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        stats.hedged += 1
+        second = asyncio.ensure_future(request_cpu_time(session, instance, self.timeout))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    async def scrape_instance(self, session, instance, cluster_semaphore, stats: ScrapeStats):
+        if self.is_open(instance.host_name):
+            stats.skipped += 1
+            return None
+        async with self.semaphore, cluster_semaphore:
+            try:
+                cpu_usage = await self.fetch(session, instance, stats)
+            except Exception as e:
+                stats.failed += 1
+                self.record_failure(instance.host_name, repr(e))
+                return None
+        stats.succeeded += 1
+        self.record_success(instance.host_name)
+        return cpu_usage
+
+    async def scrape(self, session, instances):
+        self.prune()
+        stats = ScrapeStats(total=len(instances))
+        cluster_semaphore = asyncio.Semaphore(self.cluster_concurrency)
+        results = await asyncio.gather(*[self.scrape_instance(session, instance, cluster_semaphore, stats)
+                                         for instance in instances])
+        stats.open_hosts = [instance.host_name for instance in instances if self.is_open(instance.host_name)]
+        return [result for result in results if result is not None], stats
+
+    async def scrape_all(self, instances):
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency)) as session:
+            return await self.scrape(session, instances)
+
+
+scraper = Scraper()
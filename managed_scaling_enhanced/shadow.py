@@ -0,0 +1,90 @@
+import enum
+import threading
+
+from managed_scaling_enhanced.status import coerce_config
+
+# Cluster columns a shadow policy can override
+SHADOW_FIELDS = (
+    'resize_policy',
+    'cpu_usage_upper_bound',
+    'cpu_usage_lower_bound',
+    'scale_in_factor',
+    'scale_out_factor',
+    'scale_in_dead_band',
+    'scale_out_dead_band',
+    'min_scale_step',
+    'required_consecutive_evaluations',
+    'min_scrape_coverage',
+    'max_capacity_limit',
+)
+
+
+def shadow_overrides(policy: dict):
+    """Config values of a shadow policy converted to the python type of their column."""
+    overrides = {key: value for key, value in policy.items() if key != 'name'}
+    unknown = set(overrides) - set(SHADOW_FIELDS)
+    if unknown:
+        raise ValueError(f'Shadow policies cannot override {", ".join(sorted(unknown))}')
+    return coerce_config(overrides)
+
+
+def shadow_policy(name, overrides: dict):
+    """Validated shadow policy as stored in the `shadow_policies` JSON of a cluster."""
+    if not name:
+        raise ValueError('A shadow policy needs a name')
+    values = shadow_overrides(overrides)
+    return {'name': name, **{key: value.value if isinstance(value, enum.Enum) else value
+                             for key, value in values.items()}}
+
+
+class ShadowState:
+    """Pending scale direction and count of every shadow policy, the consecutive evaluations of a shadow are
+    counted apart from the real ones. Kept in memory only, a restart starts counting again."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def get(self, cluster_id, name):
+        with self.lock:
+            return self.pending.get(cluster_id, {}).get(name, (None, 0))
+
+    def set(self, cluster_id, name, direction, count):
+        with self.lock:
+            self.pending.setdefault(cluster_id, {})[name] = (direction, count)
+
+    def prune(self, cluster_id, names):
+        """Forget the shadow policies removed from the cluster."""
+        with self.lock:
+            pending = self.pending.get(cluster_id)
+            if pending is None:
+                return
+            for name in [name for name in pending if name not in names]:
+                del pending[name]
+            if not pending:
+                del self.pending[cluster_id]
+
+
+shadow_state = ShadowState()
+
+
+def shadow_summary(events, policies):
+    """Compare the recorded real decisions of a cluster with the ones of its shadow policies, one row each."""
+    stats = {'actual': []}
+    stats.update({policy['name']: [] for policy in policies or ()})
+    for event in events:
+        stats['actual'].append((event.action, event.target_max_units))
+        for shadow in (event.data or {}).get('shadows', ()):
+            stats.setdefault(shadow['name'], []).append((shadow['action'], shadow['target_max_units']))
+    overrides = {policy['name']: ', '.join(f'{key}={value}' for key, value in policy.items() if key != 'name')
+                 for policy in policies or ()}
+    rows = []
+    for name, decisions in stats.items():
+        targets = [target for _, target in decisions if target is not None]
+        rows.append({'Policy': name,
+                     'Overrides': overrides.get(name, '' if name == 'actual' else '(removed)'),
+                     'Evaluations': len(decisions),
+                     'Scale Out': sum(action == 'scale out' for action, _ in decisions),
+                     'Scale In': sum(action == 'scale in' for action, _ in decisions),
+                     'Mean Target Units': round(sum(targets) / len(targets), 1) if targets else None})
+    return rows
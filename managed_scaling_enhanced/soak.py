@@ -0,0 +1,492 @@
+import asyncio
+import gc
+import logging
+import math
+import os
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import boto3
+import orjson
+from aiohttp import web
+from sqlalchemy import create_engine
+
+from managed_scaling_enhanced import boto3_config
+from managed_scaling_enhanced import metrics, run, scale, scraper, status, windows
+from managed_scaling_enhanced.aws import client_pool
+from managed_scaling_enhanced.database import Base, Session
+from managed_scaling_enhanced.models import Cluster, CpuSource, upgrade_schema
+from managed_scaling_enhanced.spool import spool
+
+logger = logging.getLogger(__name__)
+
+# Ids of the simulated clusters, their rows are cleared before a load test step
+CLUSTER_ID_PREFIX = 'j-SOAK'
+VCORES_PER_NODE = 8
+MB_PER_NODE = 32768
+# The query of metrics.prometheus_cpu_query with the default selector
+PROMETHEUS_CPU_QUERY = re.compile(
+    r'1 - sum\(rate\(node_cpu_seconds_total\{mode="idle",cluster_id="(?P<cluster_id>[^"]+)"\}\[(?P<window>\d+)s\]\)\)'
+    r' / sum\(rate\(node_cpu_seconds_total\{cluster_id="(?P=cluster_id)"\}\[(?P=window)s\]\)\)')
+
+
+class SimulatedClock:
+    """Replace datetime in the control loop modules so days of cycles run in minutes."""
+
+    modules = (metrics, run, scale, scraper, status, windows)
+
+    def __init__(self, now: datetime = None):
+        self.now = now or datetime.utcnow()
+        self.start = self.now
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+    @property
+    def elapsed_seconds(self):
+        return (self.now - self.start).total_seconds()
+
+    def install(self):
+        clock = self
+
+        class SimulatedDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return clock.now
+
+        for module in self.modules:
+            module.datetime = SimulatedDatetime
+
+    def uninstall(self):
+        for module in self.modules:
+            module.datetime = datetime
+
+
+@dataclass
+class StubNode:
+    host: str
+    busy_seconds: float = 0
+    idle_seconds: float = 0
+
+    def metrics_text(self):
+        return (f'node_cpu_seconds_total{{cpu="0",mode="idle"}} {self.idle_seconds}\n'
+                f'node_cpu_seconds_total{{cpu="0",mode="user"}} {self.busy_seconds}\n')
+
+
+@dataclass
+class StubCluster:
+    id: str
+    master: StubNode
+    nodes: List[StubNode]
+    policy: dict
+    fleets: Optional[list] = None
+    groups: Optional[list] = None
+    phase: float = 0
+    utilization: float = 0.5
+
+    @property
+    def hosts(self):
+        return [self.master] + self.nodes
+
+    def yarn_metrics(self):
+        total_vcores = len(self.nodes) * VCORES_PER_NODE
+        total_mb = len(self.nodes) * MB_PER_NODE
+        allocated = min(self.utilization, 1.0)
+        pending = max(self.utilization - 0.9, 0)
+        return {'clusterMetrics': {
+            'appsPending': 1 if pending else 0, 'appsRunning': 3,
+            'reservedMB': 0, 'availableMB': int(total_mb * (1 - allocated)), 'pendingMB': int(total_mb * pending),
+            'allocatedMB': int(total_mb * allocated), 'totalMB': total_mb,
+            'pendingVirtualCores': int(total_vcores * pending), 'reservedVirtualCores': 0,
+            'allocatedVirtualCores': int(total_vcores * allocated),
+            'availableVirtualCores': int(total_vcores * (1 - allocated)), 'totalVirtualCores': total_vcores,
+            'activeNodes': len(self.nodes)}}
+
+    def yarn_nodes(self):
+        # Containers are packed on the first nodes, the others are idle
+        busy_nodes = math.ceil(len(self.nodes) * min(self.utilization, 1.0))
+        return {'nodes': {'node': [{
+            'id': f'{node.host}:8041', 'nodeHostName': node.host, 'state': 'RUNNING',
+            'numContainers': VCORES_PER_NODE if i < busy_nodes else 0,
+            'usedVirtualCores': int(VCORES_PER_NODE * self.utilization),
+            'availableVirtualCores': VCORES_PER_NODE - int(VCORES_PER_NODE * self.utilization),
+            'resourceUtilization': {'nodeCPUUsage': VCORES_PER_NODE * self.utilization}}
+            for i, node in enumerate(self.nodes)]}}
+
+    def instances(self):
+        """The master, one core node and task nodes, in the shape of ListInstances."""
+        instance_sets = self.fleets or self.groups
+        set_ids = {item.get('InstanceFleetType') or item.get('InstanceGroupType'): item['Id'] for item in instance_sets}
+        id_key = 'InstanceFleetId' if self.fleets else 'InstanceGroupId'
+        roles = [('MASTER', self.master)] + [('CORE' if i == 0 else 'TASK', node) for i, node in enumerate(self.nodes)]
+        return [{'Ec2InstanceId': f'i-{node.host}', 'PublicDnsName': node.host, 'PrivateDnsName': node.host,
+                 'PrivateIpAddress': node.host, id_key: set_ids.get(role, f'{self.id}-{role.lower()}'),
+                 'Market': 'ON_DEMAND' if role != 'TASK' else 'SPOT', 'InstanceType': 'm5.xlarge',
+                 'Status': {'State': 'RUNNING'}} for role, node in roles]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """EMR (JSON protocol), the instance proxy and the Prometheus query API."""
+
+    def send_json(self, status, data, content_type='application/json'):
+        body = orjson.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        env = self.server.environment
+        url = urlparse(self.path)
+        if url.path == '/portal/emrautoscaling':
+            cluster = env.clusters[parse_qs(url.query)['cluster_id'][0]]
+            env.count('ListInstances (proxy)')
+            self.send_json(200, {'MASTER': [cluster.master.host], 'CORE': [node.host for node in cluster.nodes]})
+        elif url.path == '/api/v1/query':
+            env.count('Prometheus query')
+            match = PROMETHEUS_CPU_QUERY.fullmatch(parse_qs(url.query).get('query', [''])[0])
+            if not match or int(match['window']) <= 0:
+                self.send_json(400, {'status': 'error', 'errorType': 'bad_data', 'error': 'unexpected query'})
+                return
+            cluster = env.clusters.get(match['cluster_id'])
+            result = [{'metric': {}, 'value': [time.time(), str(cluster.utilization)]}] if cluster else []
+            self.send_json(200, {'status': 'success', 'data': {'resultType': 'vector', 'result': result}})
+        else:
+            self.send_json(404, {})
+
+    def do_POST(self):
+        env = self.server.environment
+        action = self.headers.get('X-Amz-Target', '').split('.')[-1]
+        params = orjson.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        try:
+            result = env.emr(action, params)
+        except KeyError as e:
+            self.send_json(400, {'__type': 'InvalidRequestException', 'message': f'Unknown {e}'},
+                           'application/x-amz-json-1.1')
+            return
+        self.send_json(200, result, 'application/x-amz-json-1.1')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubEnvironment:
+    """Local EMR, YARN and node_exporter stubs for a number of simulated clusters. EMR listens on an ephemeral port,
+    ResourceManagers and node_exporters on their real ports of loopback addresses 127.<20 + cluster / 256>.
+    <cluster % 256>.<node>, all of them served by one event loop thread.
+    node_exporters answer after `node_latency` seconds (uniformly jittered by +-50%) and fail with a 503 at
+    `node_failure_rate`. Every request is counted by action in `requests`."""
+
+    def __init__(self, clusters=3, nodes=4, period_hours=6, node_latency=0.0, node_failure_rate=0.0, seed=0):
+        self.clusters = {}
+        self.masters = {}
+        self.nodes = {}
+        self.servers = []
+        self.period_seconds = period_hours * 3600
+        self.node_latency = node_latency
+        self.node_failure_rate = node_failure_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.emr_server = None
+        self.loop = None
+        self.runner = None
+        def status():
+            # EMR returns timelines, boto3 parses them into datetimes
+            return {'State': 'RUNNING', 'Timeline': {'CreationDateTime': time.time()}}
+
+        for i in range(clusters):
+            subnet = f'127.{20 + i // 256}.{i % 256}'
+            cluster_nodes = [StubNode(f'{subnet}.{j + 1}') for j in range(nodes)]
+            master = StubNode(f'{subnet}.250')
+            if i % 2 == 0:
+                policy = {'ComputeLimits': {'UnitType': 'InstanceFleetUnits', 'MinimumCapacityUnits': 1,
+                                            'MaximumCapacityUnits': 40, 'MaximumCoreCapacityUnits': 2,
+                                            'MaximumOnDemandCapacityUnits': 2}}
+                fleets = [{'Id': f'if-{i}-core', 'InstanceFleetType': 'CORE', 'TargetOnDemandCapacity': 2,
+                           'TargetSpotCapacity': 0, 'Status': status()},
+                          {'Id': f'if-{i}-task', 'InstanceFleetType': 'TASK', 'TargetOnDemandCapacity': 0,
+                           'TargetSpotCapacity': 20, 'Status': status()}]
+                cluster = StubCluster(f'{CLUSTER_ID_PREFIX}{i:04d}', master, cluster_nodes, policy, fleets=fleets)
+            else:
+                policy = {'ComputeLimits': {'UnitType': 'Instances', 'MinimumCapacityUnits': 1,
+                                            'MaximumCapacityUnits': 40, 'MaximumCoreCapacityUnits': 2,
+                                            'MaximumOnDemandCapacityUnits': 2}}
+                groups = [{'Id': f'ig-{i}-core', 'InstanceGroupType': 'CORE', 'Market': 'ON_DEMAND',
+                           'InstanceType': 'm5.xlarge', 'RunningInstanceCount': 2, 'Status': status()},
+                          {'Id': f'ig-{i}-task', 'InstanceGroupType': 'TASK', 'Market': 'SPOT',
+                           'InstanceType': 'm5.xlarge', 'RunningInstanceCount': 20, 'Status': status()}]
+                cluster = StubCluster(f'{CLUSTER_ID_PREFIX}{i:04d}', master, cluster_nodes, policy, groups=groups)
+            cluster.phase = 2 * math.pi * i / max(clusters, 1)
+            self.clusters[cluster.id] = cluster
+            self.masters[master.host] = cluster
+            for node in cluster.hosts:
+                self.nodes[node.host] = node
+
+    @property
+    def emr_endpoint(self):
+        return f'http://127.0.0.1:{self.emr_server.server_address[1]}'
+
+    def cluster_rows(self, cluster_group):
+        """Cluster rows of the simulated clusters, every third one reads its CPU utilization from the Prometheus
+        query API of the EMR stub."""
+        rows = []
+        for i, stub in enumerate(self.clusters.values()):
+            prometheus = i % 3 == 2
+            rows.append(Cluster(id=stub.id, cluster_name=stub.id, cluster_group=cluster_group,
+                                initial_managed_scaling_policy=stub.policy,
+                                current_managed_scaling_policy=stub.policy,
+                                max_capacity_limit=stub.policy['ComputeLimits']['MaximumCapacityUnits'],
+                                cpu_source=CpuSource.PROMETHEUS if prometheus else CpuSource.NODE_EXPORTER,
+                                prometheus_url=self.emr_endpoint if prometheus else None))
+        return rows
+
+    def serve(self, host, port):
+        server = ThreadingHTTPServer((host, port), StubHandler)
+        server.daemon_threads = True
+        server.environment = self
+        threading.Thread(target=server.serve_forever, daemon=True, name=f'mse-stub-{host}:{port}').start()
+        self.servers.append(server)
+        return server
+
+    def count(self, action):
+        with self.lock:
+            self.requests[action] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            requests = self.requests
+            self.requests = Counter()
+        return requests
+
+    async def node_metrics(self, request):
+        host = request.transport.get_extra_info('sockname')[0]
+        if host not in self.nodes:
+            raise web.HTTPNotFound()
+        self.count('node_exporter')
+        if self.node_latency:
+            await asyncio.sleep(self.node_latency * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.node_failure_rate:
+            raise web.HTTPServiceUnavailable()
+        return web.Response(text=self.nodes[host].metrics_text())
+
+    async def rm_metrics(self, request):
+        host = request.transport.get_extra_info('sockname')[0]
+        if host not in self.masters:
+            raise web.HTTPNotFound()
+        self.count('ResourceManager metrics')
+        return web.Response(body=orjson.dumps(self.masters[host].yarn_metrics()), content_type='application/json')
+
+    async def rm_nodes(self, request):
+        host = request.transport.get_extra_info('sockname')[0]
+        if host not in self.masters:
+            raise web.HTTPNotFound()
+        self.count('ResourceManager nodes')
+        return web.Response(body=orjson.dumps(self.masters[host].yarn_nodes()), content_type='application/json')
+
+    async def start_sites(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.node_metrics)
+        app.router.add_get('/ws/v1/cluster/metrics', self.rm_metrics)
+        app.router.add_get('/ws/v1/cluster/nodes', self.rm_nodes)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        for host in self.masters:
+            await web.TCPSite(self.runner, host, 8088).start()
+        for host in self.nodes:
+            await web.TCPSite(self.runner, host, 9100).start()
+
+    def start(self):
+        self.emr_server = self.serve('127.0.0.1', 0)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True, name='mse-stub-hosts').start()
+        asyncio.run_coroutine_threadsafe(self.start_sites(), self.loop).result()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    def advance(self, seconds, elapsed_seconds):
+        """Move every cluster along its load curve and accumulate node CPU time."""
+        for cluster in self.clusters.values():
+            cluster.utilization = 0.5 + 0.45 * math.sin(2 * math.pi * elapsed_seconds / self.period_seconds
+                                                        + cluster.phase)
+            for node in cluster.hosts:
+                node.busy_seconds += seconds * cluster.utilization
+                node.idle_seconds += seconds * (1 - cluster.utilization)
+            for instance_set in (cluster.fleets or cluster.groups):
+                instance_set['Status']['State'] = 'RUNNING'
+
+    def emr(self, action, params):
+        self.count(action)
+        cluster = self.clusters[params['ClusterId']]
+        if action == 'DescribeCluster':
+            return {'Cluster': {'Id': cluster.id, 'Name': cluster.id, 'Status': {'State': 'RUNNING'},
+                                'MasterPublicDnsName': cluster.master.host}}
+        if action == 'GetManagedScalingPolicy':
+            return {'ManagedScalingPolicy': cluster.policy}
+        if action == 'PutManagedScalingPolicy':
+            cluster.policy = params['ManagedScalingPolicy']
+            return {}
+        if action == 'ListInstanceFleets':
+            return {'InstanceFleets': cluster.fleets or []}
+        if action == 'ListInstanceGroups':
+            return {'InstanceGroups': cluster.groups or []}
+        if action == 'ModifyInstanceFleet':
+            fleet = next(f for f in cluster.fleets if f['Id'] == params['InstanceFleet']['InstanceFleetId'])
+            fleet.update({k: v for k, v in params['InstanceFleet'].items() if k.startswith('Target')})
+            fleet['Status']['State'] = 'RESIZING'
+            return {}
+        if action == 'ModifyInstanceGroups':
+            for change in params['InstanceGroups']:
+                group = next(g for g in cluster.groups if g['Id'] == change['InstanceGroupId'])
+                group['RunningInstanceCount'] = change['InstanceCount']
+                group['Status']['State'] = 'RESIZING'
+            return {}
+        if action == 'ListInstances':
+            return {'Instances': cluster.instances()}
+        raise KeyError(action)
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak RSS in KB on Linux, only an upper bound of the current one
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def object_counts():
+    gc.collect()
+    return Counter(f'{type(o).__module__}.{type(o).__qualname__}' for o in gc.get_objects())
+
+
+@dataclass
+class Sample:
+    cycle: int
+    rss: int
+    objects: int
+
+
+@dataclass
+class SoakReport:
+    cycles: int
+    seconds: float
+    simulated_hours: float
+    samples: List[Sample] = field(default_factory=list)
+    growing_types: list = field(default_factory=list)
+    failures: List[str] = field(default_factory=list)
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def format(self):
+        lines = [f'{self.cycles} cycles ({self.simulated_hours:.1f} simulated hours) in {self.seconds:.0f} seconds']
+        lines.extend(f'cycle {sample.cycle:>6}: rss {sample.rss / 2 ** 20:8.1f} MB, {sample.objects} objects'
+                     for sample in self.samples)
+        if self.growing_types:
+            lines.append('Object types grown since the warm up:')
+            lines.extend(f'  {name}: {before} -> {after} (+{after - before})' for name, before, after in self.growing_types)
+        lines.extend(f'FAILED: {failure}' for failure in self.failures)
+        lines.append('PASSED' if self.passed else 'FAILED')
+        return '\n'.join(lines)
+
+
+def start_spool():
+    """Spool to a temporary directory like `mse start` spools to its spool directory."""
+    spool.configure(directory=tempfile.mkdtemp(prefix='mse-spool-'))
+    spool.start()
+
+
+def soak(cycles=1000, clusters=3, nodes=4, interval=60, warmup=100, sample_every=100, max_rss_growth_mb=32,
+         max_object_growth=5000, top=15, db_conn_str=None, dry_run=False, use_spool=True) -> SoakReport:
+    """Run `run.run()` for `cycles` simulated scheduling intervals against local stubs. RSS and live object counts
+    are measured after `warmup` cycles and at the end, growth above the limits fails the soak, as does a cluster
+    whose evaluation raised.
+    The database is a temporary sqlite file unless `db_conn_str` is given. Rows are spooled unless `use_spool` is
+    False."""
+    if not db_conn_str:
+        db_conn_str = f'sqlite:///{tempfile.mkdtemp(prefix="mse-soak-")}/soak.db'
+    engine = create_engine(db_conn_str, echo=False,
+                           json_serializer=lambda x: orjson.dumps(x).decode('utf8'),
+                           json_deserializer=lambda x: orjson.loads(x))
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
+    Session.configure(bind=engine)
+
+    clock = SimulatedClock()
+    environment = StubEnvironment(clusters=clusters, nodes=nodes)
+    root_logger = logging.getLogger()
+    log_level = root_logger.level
+    report = SoakReport(cycles=cycles, seconds=0, simulated_hours=cycles * interval / 3600)
+    baseline = None
+    errors = {}
+    try:
+        clock.install()
+        environment.start()
+        emr_client = boto3.client('emr', endpoint_url=environment.emr_endpoint, region_name='us-east-1',
+                                  aws_access_key_id='soak', aws_secret_access_key='soak', config=boto3_config)
+        client_pool.register(emr_client, 'emr')
+        os.environ['api_host'] = environment.emr_endpoint.split('//')[1]
+        with Session() as session:
+            for row in environment.cluster_rows('soak'):
+                session.merge(row)
+            session.commit()
+        if use_spool:
+            start_spool()
+
+        root_logger.setLevel(logging.WARNING)
+        started = time.monotonic()
+        for cycle in range(1, cycles + 1):
+            clock.advance(interval)
+            environment.advance(interval, clock.elapsed_seconds)
+            run.run(dry_run, None)
+            with status.registry.lock:
+                for cluster_status in status.registry.clusters.values():
+                    if cluster_status.last_result == 'error' and cluster_status.cluster_id not in errors:
+                        errors[cluster_status.cluster_id] = cluster_status.last_error
+            if cycle == min(warmup, cycles) or cycle % sample_every == 0 or cycle == cycles:
+                counts = object_counts()
+                report.samples.append(Sample(cycle=cycle, rss=rss_bytes(), objects=sum(counts.values())))
+                if cycle == min(warmup, cycles):
+                    baseline = counts
+                    first = report.samples[-1]
+                if cycle == cycles:
+                    final = counts
+    finally:
+        spool.stop()
+        root_logger.setLevel(log_level)
+        environment.stop()
+        clock.uninstall()
+    report.seconds = time.monotonic() - started
+
+    growth = final - baseline
+    report.growing_types = [(name, baseline[name], final[name]) for name, _ in growth.most_common(top)]
+    last = report.samples[-1]
+    rss_growth_mb = (last.rss - first.rss) / 2 ** 20
+    if rss_growth_mb > max_rss_growth_mb:
+        report.failures.append(f'RSS grew {rss_growth_mb:.1f} MB after the warm up, limit {max_rss_growth_mb} MB')
+    if last.objects - first.objects > max_object_growth:
+        report.failures.append(f'{last.objects - first.objects} more live objects after the warm up, '
+                               f'limit {max_object_growth}')
+    report.failures.extend(f'Cluster {cluster_id} failed: {error}' for cluster_id, error in errors.items())
+    return report
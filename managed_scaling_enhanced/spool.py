@@ -0,0 +1,184 @@
+import atexit
+import itertools
+import logging
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import orjson
+from sqlalchemy import DateTime, insert
+
+from managed_scaling_enhanced.database import Session
+from managed_scaling_enhanced.models import AvgMetric, CpuUsage, Event, Metric
+
+logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """Append-only local log of metric, CPU usage, average metric and event rows, replayed to the database in
+    batches by a background thread so a slow or unavailable database never holds up a scaling decision.
+    Rows are appended to `active.log`, the writer fsyncs and seals it into a numbered segment every `flush_interval`
+    seconds, inserts the segment `batch_size` rows at a time and deletes it once committed. The offset of the last
+    committed batch is kept next to its segment and segments left by a previous process are replayed at startup, a
+    batch is inserted twice only when the process dies between its commit and the offset update. Rows appended since
+    the last seal are only flushed to the OS, a host crash loses at most that interval."""
+
+    models = {model.__tablename__: model for model in (Metric, CpuUsage, AvgMetric, Event)}
+
+    def __init__(self):
+        self.directory = None
+        self.batch_size = 1000
+        self.flush_interval = 1.0
+        self.max_backoff = 60.0
+        self.lock = threading.Lock()
+        self.file = None
+        self.sequence = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def configure(self, directory=None, batch_size=1000, flush_interval=1.0):
+        self.directory = Path(directory) if directory else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+    @property
+    def active_path(self):
+        return self.directory / 'active.log'
+
+    def segments(self):
+        return sorted(self.directory.glob('segment-*.log'))
+
+    @property
+    def running(self):
+        return self.file is not None
+
+    def start(self):
+        if self.directory is None or self.thread is not None:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        self.sequence = int(segments[-1].stem.split('-')[1]) if segments else 0
+        self.seal()
+        with self.lock:
+            self.file = open(self.active_path, 'ab')
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='mse-spool-writer')
+        self.thread.start()
+        atexit.register(self.stop)
+        logger.info(f'Spooling metrics and events to {self.directory}, {self.backlog_bytes()} bytes to replay.')
+
+    def stop(self, timeout=30):
+        """Replay what is spooled one last time, what is left is replayed by the next process."""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join(timeout)
+        self.thread = None
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def add(self, session, *rows):
+        """Spool the rows and return True, or add them to the session and return False when the spool is not
+        running, the caller then commits them as before."""
+        if self.file is None:
+            session.add_all(rows)
+            return False
+        data = b''.join(orjson.dumps({'table': row.__tablename__, 'row': row_values(row)}) + b'\n' for row in rows)
+        with self.lock:
+            if self.file is None:
+                session.add_all(rows)
+                return False
+            self.file.write(data)
+            self.file.flush()
+        return True
+
+    def seal(self):
+        """Turn the rows spooled so far into a segment to replay."""
+        with self.lock:
+            if not self.active_path.exists() or not self.active_path.stat().st_size:
+                return
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+            self.sequence += 1
+            self.active_path.rename(self.directory / f'segment-{self.sequence:012d}.log')
+            # Make the rename durable too
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            if self.file:
+                self.file = open(self.active_path, 'ab')
+
+    def backlog_bytes(self):
+        size = self.active_path.stat().st_size if self.active_path.exists() else 0
+        for segment in self.segments():
+            size += segment.stat().st_size - read_offset(segment)
+        return size
+
+    def run(self):
+        failures = 0
+        while True:
+            stopping = self.stop_event.wait(min(self.flush_interval * 2 ** failures, self.max_backoff))
+            try:
+                self.seal()
+                for segment in self.segments():
+                    self.replay(segment)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.warning(f'Replay spool {self.directory} error, {self.backlog_bytes()} bytes waiting: {e}')
+            if stopping:
+                break
+
+    def replay(self, segment: Path):
+        offset_path = segment.with_suffix('.offset')
+        with open(segment, 'rb') as f:
+            f.seek(read_offset(segment))
+            while True:
+                lines = list(itertools.islice(f, self.batch_size))
+                if not lines:
+                    break
+                self.insert(lines)
+                offset_path.write_text(str(f.tell()))
+        segment.unlink()
+        offset_path.unlink(missing_ok=True)
+
+    def insert(self, lines):
+        rows = {}
+        for line in lines:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # The last line of a segment is cut when the process died while appending it
+                logger.warning(f'Skipping truncated spool record {line[:100]}')
+                continue
+            rows.setdefault(record['table'], []).append(record['row'])
+        with Session() as session:
+            for table, values in rows.items():
+                model = self.models[table]
+                session.execute(insert(model), [decode_values(model, value) for value in values])
+            session.commit()
+
+
+def read_offset(segment: Path):
+    offset_path = segment.with_suffix('.offset')
+    return int(offset_path.read_text()) if offset_path.exists() else 0
+
+
+def row_values(row):
+    return {column.key: getattr(row, column.key) for column in row.__table__.columns if column.key != 'id'}
+
+
+def decode_values(model, values):
+    for column in model.__table__.columns:
+        if isinstance(column.type, DateTime) and values.get(column.key):
+            values[column.key] = datetime.fromisoformat(values[column.key])
+    return values
+
+
+spool = Spool()
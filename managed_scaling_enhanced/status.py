@@ -0,0 +1,209 @@
+import threading
+from collections import deque
+from dataclasses import dataclass, field, fields, asdict
+from datetime import datetime
+from typing import Optional
+
+from managed_scaling_enhanced.models import Cluster
+
+# Cluster columns that can be changed while the daemon is running
+CONFIG_FIELDS = (
+    'cpu_usage_upper_bound',
+    'cpu_usage_lower_bound',
+    'metrics_lookback_period_minutes',
+    'cool_down_period_minutes',
+    'max_capacity_limit',
+    'resize_policy',
+    'scale_in_factor',
+    'scale_out_factor',
+    'scale_in_dead_band',
+    'scale_out_dead_band',
+    'min_scale_step',
+    'required_consecutive_evaluations',
+    'active',
+    'cpu_source',
+    'prometheus_url',
+    'prometheus_selector',
+    'min_scrape_coverage',
+    'aggressive_scale_out',
+    'container_aware_scale_in',
+    'log_level',
+)
+
+
+@dataclass
+class Decision:
+    event_time: datetime
+    action: str
+    current_max_units: int
+    target_max_units: int
+    is_resizing: bool
+    is_cooling_down: bool
+
+
+@dataclass
+class ClusterStatus:
+    cluster_id: str
+    config: dict = field(default_factory=dict)
+    last_evaluation_time: Optional[datetime] = None
+    last_result: Optional[str] = None
+    last_error: Optional[str] = None
+    last_metrics: Optional[dict] = None
+    last_avg_metrics: Optional[dict] = None
+    last_scale_time: Optional[datetime] = None
+    cool_down_period_minutes: float = 0
+    scrape_total: int = 0
+    scrape_succeeded: int = 0
+    last_scrape_time: Optional[datetime] = None
+    node_cpu_utilization: Optional[dict] = None
+    decisions: deque = field(default_factory=deque)
+
+    @property
+    def cool_down_remaining_seconds(self):
+        if not self.last_scale_time:
+            return 0
+        elapsed = (datetime.utcnow() - self.last_scale_time).total_seconds()
+        return max(self.cool_down_period_minutes * 60 - elapsed, 0)
+
+    def to_dict(self, decisions=None):
+        d = {k: v for k, v in self.__dict__.items() if k != 'decisions'}
+        d['cool_down_remaining_seconds'] = self.cool_down_remaining_seconds
+        d['scrape_success_rate'] = self.scrape_succeeded / self.scrape_total if self.scrape_total else None
+        d['decisions'] = [asdict(decision) for decision in list(self.decisions)[-decisions:]] if decisions else []
+        return d
+
+    @classmethod
+    def from_state(cls, state: dict, max_decisions):
+        """Rebuild a status from the output of to_dict(), as stored in a checkpoint."""
+        names = {f.name for f in fields(cls)} - {'decisions'}
+        values = {k: v for k, v in state.items() if k in names}
+        for key in ('last_evaluation_time', 'last_scale_time', 'last_scrape_time'):
+            if values.get(key):
+                values[key] = datetime.fromisoformat(values[key])
+        status = cls(**values, decisions=deque(maxlen=max_decisions))
+        for decision in state.get('decisions', []):
+            status.decisions.append(Decision(**{**decision, 'event_time': datetime.fromisoformat(decision['event_time'])}))
+        return status
+
+
+def row_to_dict(row):
+    return {column: getattr(row, column) for column in row.__table__.columns.keys()}
+
+
+def coerce_config(changes: dict):
+    """Validate config changes and convert them to the python type of their column."""
+    config = {}
+    for key, value in changes.items():
+        if key not in CONFIG_FIELDS:
+            raise ValueError(f'Unknown or read only cluster config {key}')
+        if value is not None:
+            python_type = Cluster.__table__.columns[key].type.python_type
+            if python_type is bool and isinstance(value, str):
+                value = value.lower() in ('1', 'true', 'yes')
+            value = python_type(value)
+        config[key] = value
+    return config
+
+
+class StatusRegistry:
+    """Live state of the clusters evaluated by this process, shared between the control loop and the API."""
+
+    def __init__(self, max_decisions=100):
+        self.max_decisions = max_decisions
+        self.lock = threading.Lock()
+        self.clusters = {}
+        self.pending_configs = {}
+
+    def _get(self, cluster_id) -> ClusterStatus:
+        if cluster_id not in self.clusters:
+            self.clusters[cluster_id] = ClusterStatus(cluster_id=cluster_id,
+                                                      decisions=deque(maxlen=self.max_decisions))
+        return self.clusters[cluster_id]
+
+    def record_cluster(self, cluster: Cluster):
+        with self.lock:
+            status = self._get(cluster.id)
+            status.config = {key: getattr(cluster, key) for key in ('cluster_name', 'cluster_group', 'region', 'role_arn') + CONFIG_FIELDS}
+            status.cool_down_period_minutes = cluster.cool_down_period_minutes
+            status.last_scale_time = max(cluster.last_scale_in_ts, cluster.last_scale_out_ts)
+            status.last_evaluation_time = datetime.utcnow()
+
+    def record_result(self, cluster_id, result, error=None):
+        with self.lock:
+            status = self._get(cluster_id)
+            status.last_result = result
+            status.last_error = error
+
+    def record_metrics(self, cluster_id, metric=None, avg_metric=None):
+        with self.lock:
+            status = self._get(cluster_id)
+            if metric is not None:
+                status.last_metrics = row_to_dict(metric)
+            if avg_metric is not None:
+                status.last_avg_metrics = row_to_dict(avg_metric)
+
+    def record_scrape(self, cluster_id, total, succeeded, nodes=None):
+        with self.lock:
+            status = self._get(cluster_id)
+            status.scrape_total = total
+            status.scrape_succeeded = succeeded
+            status.last_scrape_time = datetime.utcnow()
+            status.node_cpu_utilization = nodes
+
+    def scrape_coverage(self, cluster_id):
+        with self.lock:
+            status = self.clusters.get(cluster_id)
+            if status and status.scrape_total:
+                return status.scrape_succeeded / status.scrape_total
+
+    def record_decision(self, cluster: Cluster, event):
+        with self.lock:
+            status = self._get(cluster.id)
+            status.decisions.append(Decision(event_time=event.event_time, action=event.action,
+                                             current_max_units=event.current_max_units,
+                                             target_max_units=event.target_max_units,
+                                             is_resizing=event.is_resizing,
+                                             is_cooling_down=event.is_cooling_down))
+            status.last_scale_time = max(cluster.last_scale_in_ts, cluster.last_scale_out_ts)
+
+    def queue_config(self, cluster_id, changes: dict):
+        config = coerce_config(changes)
+        with self.lock:
+            self.pending_configs.setdefault(cluster_id, {}).update(config)
+            return dict(self.pending_configs[cluster_id])
+
+    def apply_pending_config(self, cluster: Cluster):
+        """Apply config changes received by the API since the last evaluation of the cluster."""
+        with self.lock:
+            config = self.pending_configs.pop(cluster.id, {})
+        for key, value in config.items():
+            setattr(cluster, key, value)
+        return config
+
+    def export_state(self):
+        with self.lock:
+            return {'clusters': [status.to_dict(decisions=self.max_decisions) for status in self.clusters.values()],
+                    'pending_configs': {cluster_id: dict(config) for cluster_id, config in self.pending_configs.items()}}
+
+    def restore_state(self, state: dict):
+        clusters = [ClusterStatus.from_state(status, self.max_decisions) for status in state['clusters']]
+        pending_configs = {cluster_id: coerce_config(config) for cluster_id, config in state['pending_configs'].items()}
+        with self.lock:
+            for status in clusters:
+                self.clusters.setdefault(status.cluster_id, status)
+            for cluster_id, config in pending_configs.items():
+                self.pending_configs.setdefault(cluster_id, {}).update(config)
+
+    def get(self, cluster_id, decisions=0):
+        with self.lock:
+            if cluster_id in self.clusters:
+                d = self.clusters[cluster_id].to_dict(decisions)
+                d['pending_config'] = self.pending_configs.get(cluster_id, {})
+                return d
+
+    def list(self):
+        with self.lock:
+            return [status.to_dict() for status in self.clusters.values()]
+
+
+registry = StatusRegistry()
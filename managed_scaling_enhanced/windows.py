@@ -0,0 +1,97 @@
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from managed_scaling_enhanced.models import Cluster
+
+
+@dataclass
+class CpuSample:
+    instance_id: str
+    total_seconds: float
+    busy_seconds: float
+    event_time: datetime
+
+
+@dataclass
+class Window:
+    started: datetime
+    seeded_lookback: timedelta = timedelta(0)
+    metrics: deque = field(default_factory=deque)
+    cpu_samples: deque = field(default_factory=deque)
+
+
+class MetricWindows:
+    """Metrics and CPU usages of the lookback period of every cluster kept in memory while the spool is running, so
+    a decision averages the sample of its own evaluation without reading it back from the database. A window is
+    seeded from the database once, or again after the lookback grew, and is complete without a seed once it has been
+    fed for the whole lookback period."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def _get(self, cluster_id) -> Window:
+        if cluster_id not in self.windows:
+            self.windows[cluster_id] = Window(started=datetime.utcnow())
+        return self.windows[cluster_id]
+
+    def needs_seed(self, cluster: Cluster):
+        lookback = timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        with self.lock:
+            window = self._get(cluster.id)
+            return window.seeded_lookback < lookback and datetime.utcnow() - window.started < lookback
+
+    def seed(self, cluster: Cluster, metrics, cpu_usages):
+        """Add the persisted rows older than the first sample fed to the window."""
+        with self.lock:
+            window = self._get(cluster.id)
+            first_metric = window.metrics[0].event_time if window.metrics else datetime.max
+            window.metrics.extendleft(reversed([metric for metric in metrics if metric.event_time < first_metric]))
+            first_cpu = window.cpu_samples[0].event_time if window.cpu_samples else datetime.max
+            window.cpu_samples.extendleft(reversed([
+                CpuSample(cpu_usage.instance_id, cpu_usage.total_seconds, cpu_usage.busy_seconds, cpu_usage.event_time)
+                for cpu_usage in cpu_usages if cpu_usage.event_time < first_cpu]))
+            window.seeded_lookback = timedelta(minutes=cluster.metrics_lookback_period_minutes)
+
+    def add_metric(self, cluster: Cluster, metric):
+        since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        with self.lock:
+            metrics = self._get(cluster.id).metrics
+            metrics.append(metric)
+            while metrics and metrics[0].event_time <= since:
+                metrics.popleft()
+
+    def add_cpu_usages(self, cluster: Cluster, cpu_usages):
+        since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        with self.lock:
+            samples = self._get(cluster.id).cpu_samples
+            samples.extend(CpuSample(cpu_usage.instance_id, cpu_usage.total_seconds, cpu_usage.busy_seconds,
+                                     cpu_usage.event_time) for cpu_usage in cpu_usages)
+            while samples and samples[0].event_time <= since:
+                samples.popleft()
+
+    def lookback_metrics(self, cluster: Cluster):
+        since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        with self.lock:
+            return [metric for metric in self._get(cluster.id).metrics if metric.event_time > since]
+
+    def cpu_baselines(self, cluster: Cluster):
+        """The oldest CPU usage of each instance within the lookback period, like metrics.cpu_baselines_statement."""
+        since = datetime.utcnow() - timedelta(minutes=cluster.metrics_lookback_period_minutes)
+        baselines = {}
+        with self.lock:
+            for sample in self._get(cluster.id).cpu_samples:
+                if sample.event_time > since:
+                    baselines.setdefault(sample.instance_id, sample)
+        return list(baselines.values())
+
+    def prune(self, cluster_ids):
+        """Drop the windows of clusters that are no longer managed."""
+        with self.lock:
+            for cluster_id in set(self.windows) - set(cluster_ids):
+                del self.windows[cluster_id]
+
+
+metric_windows = MetricWindows()
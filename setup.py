@@ -19,6 +19,9 @@ setup(
         'pymysql',
         'aiohttp'
     ],
+    extras_require={
+        'async': ['sqlalchemy[asyncio]', 'aiosqlite', 'aiomysql'],
+    },
     entry_points={
         'console_scripts': [
             'mse=managed_scaling_enhanced.cli:cli',
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# The package opens the database, creates boto3 clients and reads ec2_types.json from the working directory at
+# import, so the tests run in a scratch directory with their own database.
+WORK_DIR = Path(tempfile.mkdtemp(prefix='mse-tests-'))
+shutil.copy(Path(__file__).resolve().parent.parent / 'ec2_types.json', WORK_DIR)
+os.chdir(WORK_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['DB_CONN_STR'] = f'sqlite:///{WORK_DIR / "data.db"}'
+
+import boto3  # noqa: E402
+
+from managed_scaling_enhanced import boto3_config  # noqa: E402
+from managed_scaling_enhanced.aws import client_pool  # noqa: E402
+from managed_scaling_enhanced.models import Cluster, column_default  # noqa: E402
+
+INSTANCES_POLICY = {'ComputeLimits': {'UnitType': 'Instances', 'MinimumCapacityUnits': 1,
+                                      'MaximumCapacityUnits': 20, 'MaximumCoreCapacityUnits': 2,
+                                      'MaximumOnDemandCapacityUnits': 2}}
+
+
+def make_cluster(**values) -> Cluster:
+    """An unsaved cluster with the column defaults a saved row would have."""
+    defaults = {column.key: column_default(column) for column in Cluster.__table__.columns
+                if column_default(column) is not None}
+    return Cluster(**{**defaults, 'id': 'j-TEST', 'initial_managed_scaling_policy': INSTANCES_POLICY,
+                      'current_managed_scaling_policy': INSTANCES_POLICY, **values})
+
+
+@pytest.fixture(scope='session')
+def stub_environment():
+    """The EMR, YARN, node_exporter and Prometheus stubs of the soak test, EMR calls of the package go to them."""
+    from managed_scaling_enhanced.soak import StubEnvironment
+    environment = StubEnvironment(clusters=3, nodes=4)
+    environment.start()
+    client_pool.register(boto3.client('emr', endpoint_url=environment.emr_endpoint, region_name='us-east-1',
+                                      aws_access_key_id='test', aws_secret_access_key='test',
+                                      config=boto3_config), 'emr')
+    yield environment
+    with client_pool.lock:
+        client_pool.clients.pop(('emr', None, None), None)
+    environment.stop()
@@ -0,0 +1,56 @@
+from managed_scaling_enhanced.groups import Proposal, allocate, water_fill
+
+
+def proposal(cluster_id, current_units, request_units, weight=1):
+    return Proposal(cluster_id=cluster_id, current_units=current_units, request_units=request_units, weight=weight,
+                    plan=None)
+
+
+def test_water_fill_within_demands():
+    assert water_fill(30, {'a': 10, 'b': 5}, {'a': 1, 'b': 1}) == {'a': 10, 'b': 5}
+
+
+def test_water_fill_by_weight():
+    assert water_fill(6, {'a': 10, 'b': 10}, {'a': 1, 'b': 2}) == {'a': 2, 'b': 4}
+
+
+def test_water_fill_hands_on_unneeded_units():
+    assert water_fill(10, {'a': 1, 'b': 20}, {'a': 1, 'b': 1}) == {'a': 1, 'b': 9}
+
+
+def test_water_fill_rounding():
+    grants = water_fill(5, {'a': 10, 'b': 10, 'c': 10}, {'a': 1, 'b': 1, 'c': 1})
+    assert sum(grants.values()) == 5
+    assert sorted(grants.values()) == [1, 2, 2]
+
+
+def test_water_fill_nothing():
+    assert water_fill(0, {'a': 3}, {'a': 1}) == {'a': 0}
+    assert water_fill(5, {}, {}) == {}
+
+
+def test_allocate_within_budget():
+    proposals = {'a': proposal('a', 4, 8), 'b': proposal('b', 6, 4)}
+    assert allocate(20, proposals) == {'a': 8, 'b': 4}
+
+
+def test_allocate_caps_scale_out():
+    # b keeps its 6 units, a grows from 4 into the 2 units left
+    proposals = {'a': proposal('a', 4, 10), 'b': proposal('b', 6, 6)}
+    assert allocate(12, proposals) == {'a': 6, 'b': 6}
+
+
+def test_allocate_counts_held_units():
+    proposals = {'a': proposal('a', 4, 10)}
+    assert allocate(12, proposals, held_units=6) == {'a': 6}
+
+
+def test_allocate_by_weight():
+    proposals = {'a': proposal('a', 2, 12, weight=1), 'b': proposal('b', 2, 12, weight=2)}
+    assert allocate(10, proposals) == {'a': 4, 'b': 6}
+
+
+def test_allocate_over_budget_does_not_lower_members():
+    # Members that do not ask for more are only lowered by their own decisions
+    proposals = {'a': proposal('a', 10, 10), 'b': proposal('b', 8, 6), 'c': proposal('c', 2, 5)}
+    assert allocate(12, proposals) == {'a': 10, 'b': 6, 'c': 2}
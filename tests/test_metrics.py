@@ -0,0 +1,85 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+
+from conftest import make_cluster
+from managed_scaling_enhanced.metrics import (parse_yarn_nodes, get_prometheus_cpu_utilization,
+                                              fetch_prometheus_cpu_utilization, prometheus_cpu_query, YarnNode)
+from managed_scaling_enhanced.models import CpuSource
+from managed_scaling_enhanced.status import registry
+
+
+def prometheus_cluster_row():
+    return make_cluster(id='j-PROM', cpu_source=CpuSource.PROMETHEUS, metrics_lookback_period_minutes=10)
+
+
+def prometheus_cluster(environment):
+    cluster = next(row for row in environment.cluster_rows('test') if row.cpu_source == CpuSource.PROMETHEUS)
+    cluster.metrics_lookback_period_minutes = 15
+    return cluster
+
+
+def test_parse_yarn_nodes():
+    data = {'nodes': {'node': [
+        {'id': 'ip-10-0-0-1.ec2.internal:8041', 'nodeHostName': 'ip-10-0-0-1.ec2.internal', 'state': 'RUNNING',
+         'numContainers': 3},
+        {'id': 'ip-10-0-0-2.ec2.internal:8041', 'state': 'DECOMMISSIONING'},
+    ]}}
+    assert parse_yarn_nodes(data) == [YarnNode(host='ip-10-0-0-1.ec2.internal', state='RUNNING', containers=3),
+                                      YarnNode(host='ip-10-0-0-2.ec2.internal', state='DECOMMISSIONING',
+                                               containers=0)]
+
+
+def test_parse_yarn_nodes_without_nodes():
+    assert parse_yarn_nodes({'nodes': None}) == []
+    assert parse_yarn_nodes({}) == []
+
+
+def test_prometheus_cpu_query():
+    cluster = prometheus_cluster_row()
+    assert prometheus_cpu_query(cluster) == (
+        '1 - sum(rate(node_cpu_seconds_total{mode="idle",cluster_id="j-PROM"}[600s]))'
+        ' / sum(rate(node_cpu_seconds_total{cluster_id="j-PROM"}[600s]))')
+    cluster.prometheus_selector = 'job="emr",cluster="{cluster_id}"'
+    assert 'node_cpu_seconds_total{mode="idle",job="emr",cluster="j-PROM"}[600s]' in prometheus_cpu_query(cluster)
+
+
+def test_prometheus_cpu_utilization(stub_environment):
+    cluster = prometheus_cluster(stub_environment)
+    stub_environment.clusters[cluster.id].utilization = 0.73
+    assert get_prometheus_cpu_utilization(cluster) == pytest.approx(0.73)
+    assert registry.scrape_coverage(cluster.id) == 1
+
+
+def test_prometheus_cpu_utilization_async(stub_environment):
+    cluster = prometheus_cluster(stub_environment)
+    stub_environment.clusters[cluster.id].utilization = 0.21
+
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            return await fetch_prometheus_cpu_utilization(session, cluster)
+
+    assert asyncio.run(fetch()) == pytest.approx(0.21)
+
+
+def test_prometheus_cpu_utilization_without_series(stub_environment):
+    cluster = prometheus_cluster(stub_environment)
+    cluster.id = 'j-UNKNOWN'
+    assert get_prometheus_cpu_utilization(cluster) is None
+    assert registry.scrape_coverage(cluster.id) == 0
+
+
+def test_prometheus_cpu_utilization_bad_query(stub_environment):
+    cluster = prometheus_cluster(stub_environment)
+    cluster.prometheus_selector = 'job="emr"'
+    with pytest.raises(requests.HTTPError):
+        get_prometheus_cpu_utilization(cluster)
+
+
+def test_prometheus_cpu_utilization_without_url(monkeypatch):
+    monkeypatch.delenv('PROMETHEUS_URL', raising=False)
+    cluster = prometheus_cluster_row()
+    with pytest.raises(ValueError, match='prometheus-url'):
+        get_prometheus_cpu_utilization(cluster)
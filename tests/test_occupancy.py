@@ -0,0 +1,39 @@
+from managed_scaling_enhanced.occupancy import get_occupancy
+
+
+def group_cluster(environment, utilization):
+    """The first simulated cluster of instance groups with its master and topology as described by EMR."""
+    cluster = next(row for row in environment.cluster_rows('test')
+                   if row.current_managed_scaling_policy['ComputeLimits']['UnitType'] == 'Instances')
+    stub = environment.clusters[cluster.id]
+    stub.utilization = utilization
+    cluster.master_dns_name = stub.master.host
+    cluster.instance_groups = stub.groups
+    return cluster
+
+
+def test_get_occupancy(stub_environment):
+    # 4 nodes at half utilization: the core node and the first task node run containers, two task nodes are idle
+    cluster = group_cluster(stub_environment, 0.5)
+    occupancy = get_occupancy(cluster, cluster.snapshot())
+    assert occupancy.running_units == 4
+    assert [node.containers for node in occupancy.task_nodes] == [8, 0, 0]
+    assert {node.market for node in occupancy.task_nodes} == {'SPOT'}
+    assert occupancy.idle_units() == 2
+    assert occupancy.idle_units(market='ON_DEMAND') == 0
+    assert occupancy.headroom_units(20) == 16
+    assert occupancy.removable_units(20) == 18
+
+
+def test_get_occupancy_busy(stub_environment):
+    cluster = group_cluster(stub_environment, 1.0)
+    occupancy = get_occupancy(cluster, cluster.snapshot())
+    assert occupancy.idle_nodes() == []
+    assert occupancy.removable_units(4) == 0
+
+
+def test_get_occupancy_without_resource_manager(stub_environment):
+    cluster = group_cluster(stub_environment, 0.5)
+    # Nothing listens on this loopback address
+    cluster.master_dns_name = '127.19.0.1'
+    assert get_occupancy(cluster, cluster.snapshot()) is None
@@ -0,0 +1,48 @@
+from collections import deque
+from datetime import datetime, timedelta
+
+from conftest import make_cluster
+from managed_scaling_enhanced.models import Metric
+from managed_scaling_enhanced.sampler import YarnSampler
+
+
+def sampler_with(cluster, *seconds_ago, interval=10):
+    sampler = YarnSampler(interval=interval)
+    now = datetime.utcnow()
+    sampler.samples[cluster.id] = deque(Metric(cluster_id=cluster.id, event_time=now - timedelta(seconds=seconds),
+                                               yarn_app_pending=seconds)
+                                        for seconds in sorted(seconds_ago, reverse=True))
+    return sampler
+
+
+def test_window_disabled():
+    cluster = make_cluster(metrics_lookback_period_minutes=5)
+    sampler = sampler_with(cluster, 290, 150, 10, interval=0)
+    assert sampler.window(cluster) == []
+
+
+def test_window_spanning_lookback():
+    cluster = make_cluster(metrics_lookback_period_minutes=5)
+    # The oldest buffered sample starts within two sampling intervals of the lookback period
+    sampler = sampler_with(cluster, 285, 150, 10)
+    assert [metric.yarn_app_pending for metric in sampler.window(cluster)] == [285, 150, 10]
+
+
+def test_window_drops_samples_before_lookback():
+    cluster = make_cluster(metrics_lookback_period_minutes=5)
+    sampler = sampler_with(cluster, 310, 295, 10)
+    assert [metric.yarn_app_pending for metric in sampler.window(cluster)] == [295, 10]
+
+
+def test_window_not_spanning_lookback():
+    # After a start, or when the lookback grew, the persisted metrics are averaged instead
+    cluster = make_cluster(metrics_lookback_period_minutes=5)
+    assert sampler_with(cluster, 200, 100, 10).window(cluster) == []
+    assert YarnSampler(interval=10).window(cluster) == []
+
+
+def test_window_after_longer_lookback():
+    cluster = make_cluster(metrics_lookback_period_minutes=5)
+    sampler = sampler_with(cluster, 290, 150, 10)
+    cluster.metrics_lookback_period_minutes = 10
+    assert sampler.window(cluster) == []
@@ -0,0 +1,46 @@
+from conftest import make_cluster
+from managed_scaling_enhanced.scale import stabilize
+
+
+def snapshot(**values):
+    # current max units are 20
+    return make_cluster(**values).snapshot()
+
+
+def test_stabilize_acts_on_change():
+    assert stabilize(snapshot(), 25) == (25, 'scale out', 1)
+    assert stabilize(snapshot(), 12) == (12, 'scale in', 1)
+
+
+def test_stabilize_without_change():
+    assert stabilize(snapshot(pending_scale_direction='scale out', pending_scale_count=3), 20) == (20, None, 0)
+
+
+def test_stabilize_below_minimum_step():
+    assert stabilize(snapshot(min_scale_step=3), 22) == (20, None, 0)
+    assert stabilize(snapshot(min_scale_step=3), 23) == (23, 'scale out', 1)
+
+
+def test_stabilize_dead_band():
+    # 10% of 20 units
+    assert stabilize(snapshot(scale_in_dead_band=0.1), 19) == (20, None, 0)
+    assert stabilize(snapshot(scale_in_dead_band=0.1), 18) == (18, 'scale in', 1)
+    assert stabilize(snapshot(scale_in_dead_band=0.1), 21) == (21, 'scale out', 1)
+
+
+def test_stabilize_consecutive_evaluations():
+    first = snapshot(required_consecutive_evaluations=2)
+    assert stabilize(first, 25) == (20, 'scale out', 1)
+    second = first.replace(pending_scale_direction='scale out', pending_scale_count=1)
+    assert stabilize(second, 24) == (24, 'scale out', 2)
+
+
+def test_stabilize_direction_change_restarts_count():
+    current = snapshot(required_consecutive_evaluations=2, pending_scale_direction='scale out', pending_scale_count=1)
+    assert stabilize(current, 15) == (20, 'scale in', 1)
+
+
+def test_stabilize_logs_deferral():
+    messages = []
+    stabilize(snapshot(required_consecutive_evaluations=3), 25, log=messages.append)
+    assert messages == ['Deferring scale out of cluster j-TEST: 1/3 consecutive evaluations.']
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from managed_scaling_enhanced.metrics import Instance
+from managed_scaling_enhanced.models import CpuUsage
+from managed_scaling_enhanced.scraper import Scraper
+
+
+@pytest.fixture
+def scraper(monkeypatch):
+    """A scraper whose requests to hosts named `bad*` fail."""
+    scraper = Scraper(failure_threshold=2, base_backoff=30, max_backoff=100)
+    fetched = []
+
+    async def fetch(session, instance, stats):
+        fetched.append(instance.host_name)
+        if instance.host_name.startswith('bad'):
+            raise ConnectionError(instance.host_name)
+        return CpuUsage(instance_id=instance.instance_id, total_seconds=10, idle_seconds=5)
+
+    monkeypatch.setattr(scraper, 'fetch', fetch)
+    scraper.fetched = fetched
+    return scraper
+
+
+def instances(*hosts):
+    return [Instance(cluster_id='j-TEST', instance_id=f'i-{host}', host_name=host) for host in hosts]
+
+
+def test_breaker_opens_after_threshold(scraper):
+    scraper.record_failure('host', 'error')
+    assert not scraper.is_open('host')
+    scraper.record_failure('host', 'error')
+    assert scraper.is_open('host')
+    assert scraper.export_state()['host']['open_for'] == pytest.approx(30, abs=1)
+
+
+def test_backoff_doubles_up_to_max(scraper):
+    for _ in range(3):
+        scraper.record_failure('host', 'error')
+    assert scraper.export_state()['host']['open_for'] == pytest.approx(60, abs=1)
+    scraper.record_failure('host', 'error')
+    assert scraper.export_state()['host']['open_for'] == pytest.approx(100, abs=1)
+
+
+def test_success_closes_breaker(scraper):
+    scraper.record_failure('host', 'error')
+    scraper.record_success('host')
+    scraper.record_failure('host', 'error')
+    assert not scraper.is_open('host')
+
+
+def test_scrape_skips_open_hosts(scraper):
+    hosts = instances('good-1', 'bad-1', 'good-2')
+    for _ in range(2):
+        cpu_usages, stats = asyncio.run(scraper.scrape(None, hosts))
+        assert (stats.total, stats.succeeded, stats.failed, stats.skipped) == (3, 2, 1, 0)
+    assert stats.open_hosts == ['bad-1']
+    scraper.fetched.clear()
+    cpu_usages, stats = asyncio.run(scraper.scrape(None, hosts))
+    assert scraper.fetched == ['good-1', 'good-2']
+    assert [cpu_usage.instance_id for cpu_usage in cpu_usages] == ['i-good-1', 'i-good-2']
+    assert (stats.succeeded, stats.failed, stats.skipped) == (2, 0, 1)
+    assert stats.coverage == pytest.approx(2 / 3)
+
+
+def test_restore_state(scraper):
+    scraper.restore_state({'open': {'failures': 2, 'open_for': 50}, 'expired': {'failures': 2, 'open_for': 10}},
+                          elapsed_seconds=20)
+    assert scraper.is_open('open')
+    assert not scraper.is_open('expired')
+    assert scraper.export_state()['open']['open_for'] == pytest.approx(30, abs=1)
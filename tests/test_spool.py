@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+from sqlalchemy import select
+
+from managed_scaling_enhanced.database import Session
+from managed_scaling_enhanced.models import Event, Metric
+from managed_scaling_enhanced.spool import Spool, row_values
+
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = Spool()
+    spool.configure(tmp_path / 'spool', batch_size=2, flush_interval=0.05)
+    yield spool
+    spool.stop()
+
+
+def metric(cluster_id, minutes_ago=0, pending=0):
+    return Metric(cluster_id=cluster_id, event_time=datetime.utcnow() - timedelta(minutes=minutes_ago),
+                  yarn_app_pending=pending, yarn_total_mem=1024)
+
+
+def record(row):
+    return orjson.dumps({'table': row.__tablename__, 'row': row_values(row)}) + b'\n'
+
+
+def stored_metrics(cluster_id):
+    with Session() as session:
+        return session.scalars(select(Metric).where(Metric.cluster_id == cluster_id)
+                               .order_by(Metric.yarn_app_pending)).all()
+
+
+def test_add_without_running_spool(spool):
+    with Session() as session:
+        row = metric('j-SPOOL-OFF')
+        assert spool.add(session, row) is False
+        assert row in session.new
+        session.rollback()
+    assert not spool.running
+
+
+def test_replay_from_offset(spool):
+    spool.directory.mkdir(parents=True)
+    segment = spool.directory / 'segment-000000000001.log'
+    rows = [metric('j-SPOOL-REPLAY', minutes_ago=i, pending=i) for i in range(5)]
+    # The first row was committed by a previous process, the last record was cut by a crash
+    segment.write_bytes(b''.join(record(row) for row in rows) + b'{"table": "emr_met')
+    segment.with_suffix('.offset').write_text(str(len(record(rows[0]))))
+    spool.replay(segment)
+    stored = stored_metrics('j-SPOOL-REPLAY')
+    assert [row.yarn_app_pending for row in stored] == [1, 2, 3, 4]
+    assert stored[0].event_time == rows[1].event_time
+    assert not segment.exists()
+    assert not segment.with_suffix('.offset').exists()
+
+
+def test_insert_routes_rows_by_table(spool):
+    event = Event(cluster_id='j-SPOOL-INSERT', event_time=datetime.utcnow(), action='scale in',
+                  current_max_units=10, target_max_units=8)
+    spool.insert([record(metric('j-SPOOL-INSERT')), record(event)])
+    assert len(stored_metrics('j-SPOOL-INSERT')) == 1
+    with Session() as session:
+        stored = session.scalars(select(Event).where(Event.cluster_id == 'j-SPOOL-INSERT')).one()
+    assert (stored.action, stored.target_max_units) == ('scale in', 8)
+
+
+def test_spooled_rows_are_written_on_stop(spool):
+    spool.start()
+    assert spool.running
+    with Session() as session:
+        assert spool.add(session, *[metric('j-SPOOL-RUN', pending=i) for i in range(3)]) is True
+        assert not session.new
+    spool.stop()
+    assert [row.yarn_app_pending for row in stored_metrics('j-SPOOL-RUN')] == [0, 1, 2]
+    assert spool.segments() == []
+    assert spool.backlog_bytes() == 0
+
+
+def test_segments_of_previous_process_are_replayed(spool):
+    spool.directory.mkdir(parents=True)
+    (spool.directory / 'active.log').write_bytes(record(metric('j-SPOOL-LEFT')))
+    spool.start()
+    spool.stop()
+    assert len(stored_metrics('j-SPOOL-LEFT')) == 1